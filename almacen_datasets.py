@@ -0,0 +1,268 @@
+# almacen_datasets.py
+# Almacén de DataFrames por sesión/ID. Cada dataset se escribe una sola vez como archivo
+# Arrow IPC (sin comprimir) en /dev/shm o en una carpeta local, y todos los workers y
+# threads lo abren con memory maps de solo lectura: las páginas se comparten entre
+# procesos en lugar de duplicarse. Delante hay una caché LRU de DataFrames acotada.
+
+import os
+import json
+import time
+import uuid
+import errno
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pyarrow as pa
+
+from tipos_compactos import ATTR_NULOS_NONE, ARROW_STRINGS, TIPO_TEXTO_ARROW
+
+logger = logging.getLogger(__name__)
+
+
+def _carpeta_shm_por_defecto():
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm/dbcheck_datasets'
+    return 'datasets'
+
+
+# Carpeta principal (memoria compartida si existe) y carpeta local de respaldo si se llena
+DATASETS_FOLDER = os.environ.get('DATASETS_FOLDER', _carpeta_shm_por_defecto())
+DATASETS_FALLBACK_FOLDER = os.environ.get('DATASETS_FALLBACK_FOLDER', 'datasets')
+DATASETS_MEMORY_MB = int(os.environ.get('DATASETS_MEMORY_MB', '128'))
+DATASETS_TTL_SECONDS = int(os.environ.get('DATASETS_TTL_SECONDS', str(24 * 3600)))
+# Segundos sin uso tras los que un proceso suelta el memory map de un dataset
+DATASETS_MMAP_IDLE_SECONDS = int(os.environ.get('DATASETS_MMAP_IDLE_SECONDS', '600'))
+
+# Metadato con las columnas de texto cuyos nulos son None (el resto se restaura como NaN)
+_META_NULOS_NONE = b'dbcheck_nulos_none'
+
+
+def df_a_tabla_arrow(df):
+    """
+    Convierte el DataFrame a tabla Arrow conservando los metadatos de pandas (Int64,
+    índice). Las columnas object con tipos mezclados que Arrow no admite se guardan
+    como texto, manteniendo los nulos.
+    """
+    df_salida = df
+    # Columnas compactadas (category / cadenas Arrow) cuyos nulos eran None
+    nulos_none = [str(col) for col in df.attrs.get(ATTR_NULOS_NONE, []) if col in df.columns]
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        nulos = df[col][df[col].isna()]
+        if len(nulos) and nulos.iloc[0] is None:
+            nulos_none.append(str(col))
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            if df_salida is df:
+                df_salida = df.copy()
+            df_salida[col] = df[col].astype(object).where(df[col].isna(), df[col].astype(str))
+    tabla = pa.Table.from_pandas(df_salida)
+    metadata = dict(tabla.schema.metadata or {})
+    metadata[_META_NULOS_NONE] = json.dumps(nulos_none).encode('utf-8')
+    return tabla.replace_schema_metadata(metadata)
+
+
+def tabla_arrow_a_df(tabla):
+    nulos_none = set(json.loads((tabla.schema.metadata or {}).get(_META_NULOS_NONE, b'[]')))
+    # Con ARROW_STRINGS el texto vuelve como cadenas Arrow con nulos NaN (no string[python])
+    tipos = {pa.string(): TIPO_TEXTO_ARROW, pa.large_string(): TIPO_TEXTO_ARROW}.get if ARROW_STRINGS else None
+    df = tabla.to_pandas(types_mapper=tipos)
+    # Arrow devuelve los nulos de texto como None; se restaura NaN donde era NaN
+    for col in df.columns:
+        if df[col].dtype == object and str(col) not in nulos_none and df[col].isna().any():
+            df[col] = df[col].where(df[col].notna(), np.nan)
+    df.attrs[ATTR_NULOS_NONE] = sorted(c for c in nulos_none if c in df.columns and df[c].dtype != object)
+    return df
+
+
+class _TablaMapeada:
+    """Tabla Arrow abierta sobre un memory map, con contador de referencias del proceso."""
+    def __init__(self, ruta):
+        self.mapa = pa.memory_map(ruta, 'r')
+        self.tabla = pa.ipc.open_file(self.mapa).read_all()
+        self.referencias = 0
+        self.ultimo_uso = time.time()
+
+    def cerrar(self):
+        self.tabla = None
+        self.mapa.close()
+
+
+class AlmacenDatasets:
+    def __init__(self, carpetas, presupuesto_bytes, ttl_segundos):
+        self.carpetas = list(dict.fromkeys(carpetas))
+        self.presupuesto_bytes = presupuesto_bytes
+        self.ttl_segundos = ttl_segundos
+        self._cache = OrderedDict()  # dataset_id -> (DataFrame, bytes)
+        self._bytes_cache = 0
+        self._mapas = {}  # dataset_id -> _TablaMapeada
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        for carpeta in self.carpetas:
+            os.makedirs(carpeta, exist_ok=True)
+
+    @staticmethod
+    def _id_valido(dataset_id):
+        return bool(dataset_id) and all(c in '0123456789abcdef' for c in dataset_id)
+
+    def _ruta(self, dataset_id):
+        for carpeta in self.carpetas:
+            ruta = os.path.join(carpeta, f"{dataset_id}.arrow")
+            if os.path.exists(ruta):
+                return ruta
+        return None
+
+    def _cachear(self, dataset_id, df):
+        tamano = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            anterior = self._cache.pop(dataset_id, None)
+            if anterior is not None:
+                self._bytes_cache -= anterior[1]
+            if tamano > self.presupuesto_bytes:
+                return  # Demasiado grande para la caché: se materializa desde el memory map
+            self._cache[dataset_id] = (df, tamano)
+            self._bytes_cache += tamano
+            while self._bytes_cache > self.presupuesto_bytes:
+                _, (_, tamano_expulsado) = self._cache.popitem(last=False)
+                self._bytes_cache -= tamano_expulsado
+
+    def _escribir(self, tabla, dataset_id):
+        for carpeta in self.carpetas:
+            ruta = os.path.join(carpeta, f"{dataset_id}.arrow")
+            temporal = f"{ruta}.{os.getpid()}.tmp"
+            try:
+                with pa.OSFile(temporal, 'wb') as sink:
+                    with pa.ipc.new_file(sink, tabla.schema) as writer:
+                        writer.write_table(tabla)
+                os.replace(temporal, ruta)
+                return ruta
+            except OSError as e:
+                if os.path.exists(temporal):
+                    os.remove(temporal)
+                # /dev/shm lleno: probar la siguiente carpeta
+                if e.errno != errno.ENOSPC and 'No space' not in str(e):
+                    raise
+                logger.warning(f"Sin espacio en {carpeta} para el dataset {dataset_id}, usando la siguiente carpeta")
+        raise OSError(errno.ENOSPC, "No hay espacio para guardar el dataset")
+
+    def guardar(self, df):
+        """
+        Escribe el DataFrame una sola vez como Arrow IPC y devuelve su ID. El DataFrame
+        guardado no debe modificarse después (se comparte desde la caché).
+        """
+        self.purgar_vencidos()
+        dataset_id = uuid.uuid4().hex
+        ruta = self._escribir(df_a_tabla_arrow(df), dataset_id)
+        self._cachear(dataset_id, df)
+        logger.info(f"Dataset guardado: {dataset_id} {df.shape} en {ruta}")
+        return dataset_id
+
+    @contextmanager
+    def abrir_tabla(self, dataset_id):
+        """
+        Entrega la tabla Arrow del dataset sobre un memory map (sin copiar a memoria del
+        proceso) mientras dure el bloque 'with'. Entrega None si el dataset no existe.
+        """
+        mapeada = None
+        if self._id_valido(dataset_id):
+            with self._lock:
+                mapeada = self._mapas.get(dataset_id)
+                if mapeada is None:
+                    ruta = self._ruta(dataset_id)
+                    if ruta is not None:
+                        mapeada = self._mapas[dataset_id] = _TablaMapeada(ruta)
+                if mapeada is not None:
+                    mapeada.referencias += 1
+        try:
+            yield mapeada.tabla if mapeada is not None else None
+        finally:
+            if mapeada is not None:
+                with self._lock:
+                    mapeada.referencias -= 1
+                    mapeada.ultimo_uso = time.time()
+                self.liberar_mapas_inactivos()
+
+    def obtener(self, dataset_id):
+        """Devuelve el DataFrame del ID (caché en memoria o memory map) o None si no existe."""
+        if not self._id_valido(dataset_id):
+            return None
+        with self._lock:
+            entrada = self._cache.get(dataset_id)
+            if entrada is not None:
+                self._cache.move_to_end(dataset_id)
+                self.aciertos += 1
+                return entrada[0]
+            self.fallos += 1
+        with self.abrir_tabla(dataset_id) as tabla:
+            if tabla is None:
+                return None
+            df = tabla_arrow_a_df(tabla)
+        self._cachear(dataset_id, df)
+        return df
+
+    def liberar_mapas_inactivos(self, forzar_ids=()):
+        """Cierra los memory maps sin referencias que llevan DATASETS_MMAP_IDLE_SECONDS sin uso."""
+        limite = time.time() - DATASETS_MMAP_IDLE_SECONDS
+        with self._lock:
+            for dataset_id, mapeada in list(self._mapas.items()):
+                if mapeada.referencias == 0 and (dataset_id in forzar_ids or mapeada.ultimo_uso < limite):
+                    mapeada.cerrar()
+                    del self._mapas[dataset_id]
+
+    def eliminar(self, dataset_id):
+        """
+        Borra el dataset. Los procesos que aún lo tengan mapeado siguen leyéndolo sin
+        problema (el archivo desaparece del directorio pero no de sus mapas).
+        """
+        if not self._id_valido(dataset_id):
+            return
+        with self._lock:
+            entrada = self._cache.pop(dataset_id, None)
+            if entrada is not None:
+                self._bytes_cache -= entrada[1]
+        self.liberar_mapas_inactivos(forzar_ids={dataset_id})
+        ruta = self._ruta(dataset_id)
+        if ruta is not None:
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+
+    def purgar_vencidos(self):
+        """Elimina los datasets con más de ttl_segundos sin escribirse."""
+        limite = time.time() - self.ttl_segundos
+        for carpeta in self.carpetas:
+            for nombre in os.listdir(carpeta):
+                if not nombre.endswith('.arrow'):
+                    continue
+                try:
+                    if os.path.getmtime(os.path.join(carpeta, nombre)) < limite:
+                        self.eliminar(nombre[:-len('.arrow')])
+                except OSError:
+                    continue
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'carpetas': self.carpetas,
+                'datasets_en_memoria': len(self._cache),
+                'bytes_en_memoria': self._bytes_cache,
+                'presupuesto_bytes': self.presupuesto_bytes,
+                'datasets_mapeados': len(self._mapas),
+                'bytes_mapeados': sum(m.tabla.nbytes for m in self._mapas.values()),
+                'aciertos': self.aciertos,
+                'fallos': self.fallos
+            }
+
+
+almacen_datasets = AlmacenDatasets(
+    [DATASETS_FOLDER, DATASETS_FALLBACK_FOLDER],
+    DATASETS_MEMORY_MB * 1024 * 1024,
+    DATASETS_TTL_SECONDS
+)
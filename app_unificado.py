@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for, session
+from flask import Flask, Request, render_template, request, jsonify, send_file, flash, redirect, url_for, session, Response, has_request_context
 import pandas as pd
 import io
 from datetime import datetime
@@ -10,15 +10,37 @@ from werkzeug.utils import secure_filename
 import json
 import shutil
 import zipfile
-import tempfile
+import gzip
+import hashlib
+import codecs
+import csv
+import re
+import threading
 import duckdb
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 # Importar módulos separados
-from validadores_errores import aplicar_filtro, obtener_funciones_validacion
+from validadores_errores import aplicar_filtro, confirmar_historial, obtener_contexto, obtener_funciones_validacion, ATTR_AVISOS
+from historial_dx import DX_HISTORY_DB, HistorialNoDisponible, eliminar_historial
+from validacion_sql import VALIDATION_BACKEND, confirmar_historial_tabla, validar_tabla
 from funciones_procesamiento import procesar_dataframe, formatear_fechas, preparar_datos_para_frontend
+from edades import calcular_edades, grupo_edad
+from tipos_compactos import compactar_tipos, ATTR_NULOS_NONE
+from exportacion import generar_archivo_temporal, escribir_exportacion, stream_archivo, stream_csv, eliminar_temporal, leer_dataset_arrow
+from almacen_datasets import almacen_datasets
+from cache_subidas import cache_subidas, clave_contenido, HashingSpooledFile
+from tareas import (registrar_tarea, crear_trabajo, encolar_trabajo, obtener_trabajo, reportar_progreso,
+                    registrar_mensaje, carpeta_trabajo, carpeta_entrada, ESTADO_COMPLETADO, celery_app)
 from config_tipos import INTEGER_COLUMNS, DECIMAL_COLUMNS, STRING_COLUMNS, DATE_COLUMNS, FINAL_COLUMNS
 
+class HashingRequest(Request):
+    """Request cuyos archivos subidos calculan su SHA-256 mientras se reciben."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpooledFile()
+
 app = Flask(__name__, static_folder='static')
+app.request_class = HashingRequest
 app.secret_key = 'your_secret_key_here'
 
 # Directorios
@@ -31,8 +53,23 @@ os.makedirs(DATA_FOLDER, exist_ok=True)
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Variable global para almacenar el DataFrame (para validación de errores)
-df_global = None
+# Datasets de validación por sesión (ver almacen_datasets): cualquier worker puede servirlos
+SESSION_DATASET_KEY = 'dataset_id'
+SESSION_FILTERED_KEY = 'filtrado_id'
+# Último consolidado y sus maestros dinámicos (base del modo incremental)
+SESSION_CONSOLIDATED_KEY = 'consolidado_id'
+SESSION_DYNAMIC_MASTERS_KEY = 'maestros_dinamicos'
+
+# Clave de fila para no duplicar registros al agregar tramas a un consolidado existente
+ROW_KEY_COLUMNS = ['Id_Cita', 'Id_Correlativo', 'Codigo_Item']
+
+# Tipos MIME de los formatos de exportación del consolidado
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file'
+}
 
 # --- CONFIGURACIÓN PARA CONSOLIDACIÓN ---
 APP_CONFIG = {
@@ -70,7 +107,11 @@ APP_CONFIG = {
                 'Fecha_Nacimiento': 'Fecha_Nacimiento_Registrador'
             },
             'identifier_cols': ['Id_Registrador', 'Numero_Documento', 'Nombres_Registrador', 'Apellido_Paterno_Registrador'],
-            'multiple_files': False
+            'multiple_files': False,
+            'static_joins': [
+                {'master': 'tipo_doc', 'left_on': 'Id_Tipo_Documento_Registrador', 'right_on': 'Id_Tipo_Documento',
+                 'cols': {'Descripcion_Tipo_Documento': 'Descripcion_Tipo_Documento_Registrador', 'Abrev_Tipo_Doc': 'Abrev_Tipo_Doc_Registrador'}}
+            ]
         },
         'MaestroPaciente': {
             'type': 'paciente',
@@ -84,7 +125,13 @@ APP_CONFIG = {
             },
             'identifier_cols': ['Id_Paciente', 'Numero_Documento', 'Nombres_Paciente', 'Genero', 'Apellido_Paterno_Paciente'],
             'multiple_files': False,
-            'additional_cols': ['Domicilio_Declarado', 'Referencia_Domicilio']
+            'additional_cols': ['Domicilio_Declarado', 'Referencia_Domicilio'],
+            'static_joins': [
+                {'master': 'etnia', 'left_on': 'Id_Etnia', 'right_on': 'Id_Etnia',
+                 'cols': {'Descripcion_Etnia': 'Descripcion_Etnia'}},
+                {'master': 'tipo_doc', 'left_on': 'Id_Tipo_Documento_Paciente', 'right_on': 'Id_Tipo_Documento',
+                 'cols': {'Descripcion_Tipo_Documento': 'Descripcion_Tipo_Documento_Paciente', 'Abrev_Tipo_Doc': 'Abrev_Tipo_Doc_Paciente'}}
+            ]
         },
         'MaestroPersonal': {
             'type': 'personal',
@@ -99,11 +146,51 @@ APP_CONFIG = {
                 'Numero_Colegiatura': 'Numero_Colegiatura_Personal'
             },
             'identifier_cols': ['Id_Personal', 'Id_Profesion', 'Nombres_Personal', 'Apellido_Paterno_Personal'],
-            'multiple_files': False
+            'multiple_files': False,
+            'static_joins': [
+                {'master': 'condicion_contrato', 'left_on': 'Id_Condicion_Personal', 'right_on': 'Id_Condicion',
+                 'cols': {'Descripcion_Condicion': 'Descripcion_Condicion'}},
+                {'master': 'profesion', 'left_on': 'Id_Profesion_Personal', 'right_on': 'Id_Profesion',
+                 'cols': {'Descripcion_Profesion': 'Descripcion_Profesion'}},
+                {'master': 'colegio', 'left_on': 'Id_Colegio_Personal', 'right_on': 'Id_Colegio',
+                 'cols': {'Descripcion_Colegio': 'Descripcion_Colegio'}},
+                {'master': 'tipo_doc', 'left_on': 'Id_Tipo_Documento_Personal', 'right_on': 'Id_Tipo_Documento',
+                 'cols': {'Descripcion_Tipo_Documento': 'Descripcion_Tipo_Documento_Personal', 'Abrev_Tipo_Doc': 'Abrev_Tipo_Doc_Personal'}}
+            ],
+            # Columnas del maestro que se vuelcan sobre la columna final del consolidado
+            'final_rename': {
+                'Id_Condicion_Personal': 'Id_Condicion',
+                'Id_Profesion_Personal': 'Id_Profesion',
+                'Id_Colegio_Personal': 'Id_Colegio',
+                'Numero_Colegiatura_Personal': 'Numero_Colegiatura'
+            }
         }
     }
 }
 
+# Tipo DuckDB de las columnas tipadas en config_tipos (el resto se maneja como texto).
+# Si una columna está en varias listas prevalece el entero, igual que en sql_cast_expression.
+SQL_COLUMN_TYPES = {
+    **{col: 'TIMESTAMP' for col in DATE_COLUMNS},
+    **{col: 'DOUBLE' for col in DECIMAL_COLUMNS},
+    **{col: 'BIGINT' for col in INTEGER_COLUMNS},
+}
+
+# Columnas de la trama que se dejan como texto al leerla aunque tengan tipo: son claves
+# de unión con los maestros o destino de un final_rename y se comparan como texto
+SCAN_TEXT_COLUMNS = {
+    col
+    for config in list(APP_CONFIG['STATIC_MASTERS'].values()) + list(APP_CONFIG['DYNAMIC_MASTERS'].values())
+    for col in [config.get('merge_on')] + list(config.get('final_rename', {}).values())
+    if col
+}
+
+# Columnas por cada máscara de fallos de conversión (bits de un BIGINT)
+CAST_FAILURE_BITS = 62
+
+# Atributo del consolidado con los conteos de fallos de conversión por columna
+ATTR_CAST_FAILURES = 'fallos_conversion'
+
 # --- FUNCIONES DUCKDB ---
 def get_duckdb_connection():
     return duckdb.connect()
@@ -153,6 +240,8 @@ def limpiar_archivos_especificos(archivos_a_eliminar):
         try:
             if os.path.exists(file_path):
                 os.remove(file_path)
+                with _upload_hashes_lock:
+                    _upload_hashes.pop(file_path, None)
                 app.logger.info(f"Archivo eliminado: {os.path.basename(file_path)}")
             else:
                 app.logger.warning(f"Archivo no encontrado: {file_path}")
@@ -160,75 +249,266 @@ def limpiar_archivos_especificos(archivos_a_eliminar):
             app.logger.warning(f"No se pudo eliminar {file_path}: {e}")
     app.logger.info("Eliminación de archivos específicos completada")
 
+def notificar(message, category='info'):
+    """
+    Equivalente a flash() que también funciona fuera de un request (trabajos en segundo
+    plano): en ese caso el mensaje se registra en el log y en el estado del trabajo.
+    """
+    if has_request_context():
+        flash(message, category)
+    else:
+        app.logger.log(logging.ERROR if category == 'error' else logging.WARNING, message)
+    registrar_mensaje(message, category)
+
+# --- ARCHIVOS SUBIDOS SIN EXTRAER A DISCO (ZIP / GZIP) ---
+class UploadedCsv:
+    """
+    CSV subido que se lee directamente desde el stream del upload (miembro de un ZIP o
+    archivo .csv.gz) sin escribirlo en uploads/. Cada llamada a open() devuelve un nuevo
+    stream binario descomprimido desde el inicio. 'content_key' identifica su contenido
+    (hash del archivo subido + nombre) para la caché de archivos procesados.
+    """
+    def __init__(self, name, opener, content_key=None):
+        self.name = name
+        self._opener = opener
+        self.content_key = content_key
+        self.profile = None
+
+    def open(self):
+        return self._opener()
+
+    def __repr__(self):
+        return f"UploadedCsv({self.name!r})"
+
+def uploaded_csvs_from_zip(stream, digest=None):
+    """
+    Devuelve un UploadedCsv por cada .csv dentro del ZIP. Los miembros se descomprimen
+    bajo demanda desde el stream original (Werkzeug solo vuelca a un temporal acotado
+    los uploads grandes).
+    """
+    digest = digest or getattr(stream, 'sha256', None)
+    zip_ref = zipfile.ZipFile(stream, 'r')
+    return [
+        UploadedCsv(
+            os.path.basename(info.filename),
+            lambda info=info: zip_ref.open(info),
+            content_key=clave_contenido(digest, info.filename) if digest else None
+        )
+        for info in zip_ref.infolist()
+        if not info.is_dir() and info.filename.lower().endswith('.csv')
+    ]
+
+def uploaded_csv_from_gzip(name, stream, digest=None):
+    def opener():
+        stream.seek(0)
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    digest = digest or getattr(stream, 'sha256', None)
+    csv_name = name[:-len('.gz')]
+    return UploadedCsv(csv_name, opener, content_key=clave_contenido(digest, csv_name) if digest else None)
+
+# Hash de contenido de los CSV guardados en disco, por ruta y firma del archivo
+_upload_hashes = {}
+_upload_hashes_lock = threading.Lock()
+
+def register_upload_hash(filepath, digest):
+    """Registra el hash calculado al recibir el archivo, para no volver a leerlo."""
+    with _upload_hashes_lock:
+        _upload_hashes[filepath] = (_file_signature(filepath), digest)
+
+def upload_content_key(source):
+    """Clave de la caché de archivos procesados para una fuente (ruta o UploadedCsv)."""
+    if isinstance(source, UploadedCsv):
+        return source.content_key
+    signature = _file_signature(source)
+    with _upload_hashes_lock:
+        known = _upload_hashes.get(source)
+    if known and known[0] == signature:
+        digest = known[1]
+    else:
+        digest = _file_sha256(source)
+        with _upload_hashes_lock:
+            _upload_hashes[source] = (signature, digest)
+    return clave_contenido(digest, os.path.basename(source))
+
+def source_name(source):
+    return source.name if isinstance(source, UploadedCsv) else os.path.basename(source)
+
+def open_source(source):
+    return source.open() if isinstance(source, UploadedCsv) else open(source, 'rb')
+
 # --- FUNCIONES PARA CONSOLIDACIÓN ---
+# --- PERFILADO DE ARCHIVOS CSV ---
+# Se leen una sola vez los primeros KB de cada archivo para conocer encoding, BOM,
+# separador, cabecera y tipo de maestro. El perfil se cachea por ruta (y firma del archivo).
+PROFILE_SAMPLE_BYTES = 64 * 1024
+_file_profiles = {}
+_file_profiles_lock = threading.Lock()
+
+def _detect_master_type(basename, columns):
+    basename = basename.lower()
+    if any(keyword in basename for keyword in ['trama', 'plano', 'nominal']):
+        return 'plano', 'por palabras clave en nombre'
+
+    for original_key, config in APP_CONFIG['DYNAMIC_MASTERS'].items():
+        if original_key.lower() in basename:
+            return config['type'], 'detección inicial por nombre'
+
+    for original_key, config in APP_CONFIG['DYNAMIC_MASTERS'].items():
+        identifier_cols = config.get('identifier_cols', [])
+        if identifier_cols and all(col in columns for col in identifier_cols):
+            return config['type'], f'detección por columnas: {identifier_cols}'
+
+    return None, None
+
+def profile_file(filepath):
+    """
+    Perfila un CSV (ruta o UploadedCsv) leyendo solo su muestra inicial.
+
+    Returns:
+        dict: encoding, bom, separator, columns, master_type y detection (motivo de la detección)
+    """
+    if isinstance(filepath, UploadedCsv):
+        if filepath.profile is None:
+            with filepath.open() as f:
+                filepath.profile = _build_profile(filepath.name, f.read(PROFILE_SAMPLE_BYTES))
+        return filepath.profile
+
+    signature = _file_signature(filepath)
+    with _file_profiles_lock:
+        cached = _file_profiles.get(filepath)
+        if cached and cached['signature'] == signature:
+            return cached['profile']
+
+    with open(filepath, 'rb') as f:
+        profile = _build_profile(os.path.basename(filepath), f.read(PROFILE_SAMPLE_BYTES))
+    with _file_profiles_lock:
+        _file_profiles[filepath] = {'signature': signature, 'profile': profile}
+    return profile
+
+def _build_profile(basename, sample):
+
+    bom = sample.startswith(codecs.BOM_UTF8)
+    try:
+        # Decodificador incremental: tolera un carácter multibyte cortado al final de la muestra
+        text = codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        encoding = 'utf-8-sig' if bom else 'utf-8'
+        if bom:
+            text = text[1:]
+    except UnicodeDecodeError:
+        text = sample.decode('latin1')
+        encoding = 'latin1'
+
+    first_line = text.splitlines()[0] if text else ''
+    if ';' in first_line:
+        separator = ';'
+    elif ',' in first_line:
+        separator = ','
+    elif '\t' in first_line:
+        separator = '\t'
+    else:
+        separator = ','
+
+    columns = [col.strip() for col in next(csv.reader([first_line], delimiter=separator), [])]
+    columns = ['Id_Cita' if col == 'ï»¿Id_Cita' else col for col in columns]
+    master_type, detection = _detect_master_type(basename, columns)
+
+    return {
+        'encoding': encoding,
+        'bom': bom,
+        'separator': separator,
+        'columns': columns,
+        'master_type': master_type,
+        'detection': detection
+    }
+
 def detect_separator(filepath):
     try:
-        with open(filepath, 'r', encoding='latin1') as f:
-            first_line = f.readline()
-            if ';' in first_line:
-                return ';'
-            elif ',' in first_line:
-                return ','
-            elif '\t' in first_line:
-                return '\t'
+        return profile_file(filepath)['separator']
     except Exception as e:
-        app.logger.debug(f"DEBUG: Error al detectar separador para {filepath} con latin1: {e}")
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                first_line = f.readline()
-                if ';' in first_line:
-                    return ';'
-                elif ',' in first_line:
-                    return ','
-                elif '\t' in first_line:
-                    return '\t'
-        except Exception as e_utf8:
-            app.logger.debug(f"DEBUG: Error al detectar separador para {filepath} con utf-8: {e_utf8}")
+        app.logger.debug(f"DEBUG: Error al detectar separador para {filepath}: {e}")
     return ','
 
-def load_and_preprocess_csv(filepath, expected_cols=None, rename_map=None, fill_zfill=None, use_custom_load=False):
-    separator = detect_separator(filepath)
-    app.logger.debug(f"DEBUG: Separador detectado para {os.path.basename(filepath)}: '{separator}'")
+# --- NORMALIZACIÓN DE TEXTO Y ENCODING ---
+# Correcciones para texto UTF-8 que fue leído como Latin-1/CP1252 (doble codificación)
+ENCODING_CORRECTIONS = [
+    # Caracteres más comunes en español
+    ('Ã¡', 'á'), ('Ã©', 'é'), ('Ã\xad', 'í'), ('Ã³', 'ó'), ('Ãº', 'ú'),
+    ('Ã\x81', 'Á'), ('Ã‰', 'É'), ('Ã\x8d', 'Í'), ('Ã“', 'Ó'), ('Ãš', 'Ú'),
+    ('Ã±', 'ñ'), ('Ã‘', 'Ñ'), ('Ã¼', 'ü'), ('Ãœ', 'Ü'),
+    ('Â¿', '¿'), ('Â¡', '¡'), ('Â°', '°'), ('Âº', 'º'), ('Âª', 'ª'),
+
+    # Patrones específicos encontrados en los datos
+    ('aÃ±os', 'años'), ('aÃ±o', 'año'),
+    ('CONSEJERÃ\x8dA', 'CONSEJERÍA'), ('PREVENCIÃ“N', 'PREVENCIÓN'),
+
+    # Caracteres individuales problemáticos
+    ('Ã', 'í'), ('Â', ''), ('\x8d', ''), ('\x93', ''),
+
+    # Caracteres de control y espacios raros
+    ('\xa0', ' '), ('\r\n', ' '), ('\n', ' '), ('\t', ' '),
+]
+_ENCODING_MAP = dict(ENCODING_CORRECTIONS)
+# Una sola expresión regular; las secuencias más largas se prueban primero
+_ENCODING_PATTERN = re.compile('|'.join(
+    re.escape(wrong) for wrong in sorted(_ENCODING_MAP, key=len, reverse=True)
+))
+
+def normalize_text_value(value):
+    """
+    Normaliza un valor de texto: quita espacios, convierte 'nan' en vacío, elimina el '.0'
+    de los enteros leídos como decimales y repara caracteres mal codificados.
+    """
+    value = value.strip()
+    if value == 'nan':
+        return ''
+    if value.endswith('.0'):
+        value = value.split('.')[0]
+    return _ENCODING_PATTERN.sub(lambda match: _ENCODING_MAP[match.group(0)], value)
+
+def normalize_text_column(series):
+    """
+    Aplica normalize_text_value a una columna trabajando solo sobre sus valores distintos.
+
+    Las columnas de descripciones y códigos repiten muchísimo sus valores, por lo que se
+    factoriza la columna, se normaliza cada valor único una sola vez y se reconstruye la
+    columna con un 'take' vectorizado.
 
-    df = None
-    encoding_used = None
+    Returns:
+        tuple: (columna normalizada, cantidad de valores distintos con corrección de encoding)
+    """
+    codes, uniques = pd.factorize(series.astype(str), sort=False)
+    uniques = np.asarray(uniques, dtype=object)
+    normalized = np.array([normalize_text_value(value) for value in uniques], dtype=object)
+    corrected_values = sum(1 for value in uniques if _ENCODING_PATTERN.search(value))
+    return pd.Series(normalized.take(codes), index=series.index, name=series.name), corrected_values
 
+def load_and_preprocess_csv(filepath, expected_cols=None, rename_map=None, fill_zfill=None, use_custom_load=False):
     try:
-        if use_custom_load and expected_cols:
-            app.logger.debug(f"DEBUG: Usando carga personalizada para {os.path.basename(filepath)}: Nombres = {expected_cols}, usecols = {list(range(len(expected_cols)))}")
-            # PRIMERO intentar con UTF-8
-            try:
-                df = pd.read_csv(filepath, sep=separator, encoding='utf-8', dtype=str, keep_default_na=False, 
-                                 engine='python', names=expected_cols, usecols=list(range(len(expected_cols))), header=None)
-                encoding_used = 'utf-8'
-                app.logger.debug(f"DEBUG: Carga personalizada exitosa con UTF-8: {os.path.basename(filepath)}")
-            except UnicodeDecodeError:
-                # Si falla UTF-8, intentar con latin1
-                df = pd.read_csv(filepath, sep=separator, encoding='latin1', dtype=str, keep_default_na=False, 
-                                 engine='python', names=expected_cols, usecols=list(range(len(expected_cols))), header=None)
-                encoding_used = 'latin1'
-                app.logger.debug(f"DEBUG: Carga personalizada con latin1: {os.path.basename(filepath)}")
-        else:
-            # PRIMERO intentar con UTF-8 explícitamente
-            try:
-                df = pd.read_csv(filepath, sep=separator, encoding='utf-8', dtype=str, keep_default_na=False, engine='python')
-                encoding_used = 'utf-8'
-                app.logger.debug(f"DEBUG: Cargado exitosamente con UTF-8: {os.path.basename(filepath)}")
-            except UnicodeDecodeError:
-                # Si falla UTF-8, intentar con latin1
-                try:
-                    df = pd.read_csv(filepath, sep=separator, encoding='latin1', dtype=str, keep_default_na=False, engine='python')
-                    encoding_used = 'latin1'
-                    app.logger.debug(f"DEBUG: Cargado con latin1: {os.path.basename(filepath)}")
-                except Exception as e:
-                    app.logger.error(f"Error con latin1 para {os.path.basename(filepath)}: {e}")
-                    return None
+        profile = profile_file(filepath)
     except Exception as e:
-        app.logger.error(f"Error al cargar {os.path.basename(filepath)}: {e}")
+        app.logger.error(f"Error al leer {source_name(filepath)}: {e}")
         return None
-    
-    if df is None:
-        app.logger.error(f"No se pudo cargar el archivo {os.path.basename(filepath)} con los encodings probados.")
+    separator = profile['separator']
+    encoding_used = profile['encoding']
+    app.logger.debug(f"DEBUG: Perfil de {source_name(filepath)}: separador '{separator}', encoding '{encoding_used}'")
+
+    read_kwargs = {'sep': separator, 'dtype': str, 'keep_default_na': False, 'engine': 'c', 'low_memory': False}
+    if use_custom_load and expected_cols:
+        app.logger.debug(f"DEBUG: Usando carga personalizada para {source_name(filepath)}: Nombres = {expected_cols}, usecols = {list(range(len(expected_cols)))}")
+        read_kwargs.update(names=expected_cols, usecols=list(range(len(expected_cols))), header=None)
+
+    try:
+        try:
+            with open_source(filepath) as stream:
+                df = pd.read_csv(stream, encoding=encoding_used, **read_kwargs)
+        except UnicodeDecodeError:
+            # La muestra era UTF-8 válido pero el resto del archivo no: releer como latin1
+            encoding_used = 'latin1'
+            profile['encoding'] = encoding_used
+            with open_source(filepath) as stream:
+                df = pd.read_csv(stream, encoding=encoding_used, **read_kwargs)
+    except Exception as e:
+        app.logger.error(f"Error al cargar {source_name(filepath)}: {e}")
         return None
 
     df.columns = df.columns.str.strip()
@@ -242,147 +522,187 @@ def load_and_preprocess_csv(filepath, expected_cols=None, rename_map=None, fill_
         df.rename(columns=rename_map, inplace=True)
         renamed_actual = {old: new for old, new in rename_map.items() if old in original_cols and new in df.columns}
         if renamed_actual:
-            app.logger.debug(f"DEBUG: Columnas de {os.path.basename(filepath)} renombradas: {renamed_actual}")
+            app.logger.debug(f"DEBUG: Columnas de {source_name(filepath)} renombradas: {renamed_actual}")
 
     if fill_zfill and fill_zfill in df.columns:
         df[fill_zfill] = df[fill_zfill].fillna('').astype(str).str.strip().str.zfill(6)
-        app.logger.debug(f"DEBUG: Columna '{fill_zfill}' en {os.path.basename(filepath)} formateada con zfill(6).")
+        app.logger.debug(f"DEBUG: Columna '{fill_zfill}' en {source_name(filepath)} formateada con zfill(6).")
 
     if not use_custom_load and expected_cols:
         for col in expected_cols:
             if col not in df.columns:
                 df[col] = ''
 
-    # SOLUCIÓN DEFINITIVA PARA CARACTERES MAL CODIFICADOS
-    def fix_encoding(text):
-        """Función para corregir encoding de texto"""
-        if not isinstance(text, str):
-            return text
-            
-        # Correcciones específicas para caracteres UTF-8 mal interpretados como Latin-1
-        encoding_corrections = [
-            # Caracteres más comunes en español
-            ('Ã¡', 'á'), ('Ã©', 'é'), ('Ã­', 'í'), ('Ã³', 'ó'), ('Ãº', 'ú'),
-            ('Ã', 'Á'), ('Ã‰', 'É'), ('Ã', 'Í'), ('Ã“', 'Ó'), ('Ãš', 'Ú'),
-            ('Ã±', 'ñ'), ('Ã‘', 'Ñ'), ('Ã¼', 'ü'), ('Ãœ', 'Ü'),
-            ('Â¿', '¿'), ('Â¡', '¡'), ('Â°', '°'), ('Âº', 'º'), ('Âª', 'ª'),
-            
-            # Patrones específicos encontrados en tus datos
-            ('aÃ±os', 'años'), ('aÃ±o', 'año'),
-            ('CONSEJERÃA', 'CONSEJERÍA'), ('PREVENCIÃ“N', 'PREVENCIÓN'),
-            ('RIESGOS EN SALUD MENTAL', 'RIESGOS EN SALUD MENTAL'),
-            
-            # Caracteres individuales problemáticos
-            ('Ã', 'í'), ('Â', ''), ('', ''), ('', ''),
-            ('Ã“', 'Ó'), ('Ã“', 'Ó'), ('Ã‰', 'É'),
-            
-            # Corrección para el caso específico de "Ã±" -> "ñ"
-            ('Ã±', 'ñ'), ('Ã‘', 'Ñ'),
-            
-            # Caracteres de control y espacios raros
-            ('\xa0', ' '), ('\r\n', ' '), ('\n', ' '), ('\t', ' '),
-        ]
-        
-        result = text
-        for wrong, correct in encoding_corrections:
-            result = result.replace(wrong, correct)
-            
-        return result
-
-    # Aplicar corrección de encoding a todas las columnas de texto
+    # Limpieza y corrección de encoding de todas las columnas de texto (una pasada por columna)
     app.logger.info("Aplicando corrección de encoding a todas las columnas de texto...")
     
     for col in df.columns:
         if col in STRING_COLUMNS or df[col].dtype == 'object':
-            # Primero limpieza básica
-            df[col] = df[col].astype(str).fillna('').str.strip()
-            df[col] = df[col].replace('nan', '', regex=False)
-            
-            # Eliminar .0 de números enteros
-            if df[col].apply(lambda x: isinstance(x, str) and x.endswith('.0')).any():
-                df[col] = df[col].apply(lambda x: x.split('.')[0] if isinstance(x, str) and x.endswith('.0') else x)
-            
-            # Verificar si hay caracteres problemáticos
-            has_problematic_chars = df[col].str.contains('Ã|Â||', na=False).any()
-            
-            if has_problematic_chars:
-                # Contar ocurrencias antes de corregir
-                count_años = df[col].str.contains('aÃ±os', na=False).sum()
-                count_consejeria = df[col].str.contains('CONSEJERÃ', na=False).sum()
-                count_prevencion = df[col].str.contains('PREVENCIÃ', na=False).sum()
-                
-                # Aplicar corrección
-                df[col] = df[col].apply(fix_encoding)
-                
-                # Log de correcciones aplicadas
-                if count_años > 0 or count_consejeria > 0 or count_prevencion > 0:
-                    app.logger.info(f"✅ Correcciones en '{col}': aÃ±os({count_años}), CONSEJERÃ({count_consejeria}), PREVENCIÃ({count_prevencion})")
-
-    # VERIFICACIÓN FINAL ESPECÍFICA
-    app.logger.info("Realizando verificación final de correcciones...")
-    
-    # Columnas donde esperamos encontrar los problemas
-    check_columns = ['Grupo_Edad', 'Descripcion_Item', 'Descripcion_Profesion', 
-                    'Descripcion_Condicion', 'Descripcion_Ups', 'Descripcion_Etnia']
-    
-    for col in check_columns:
-        if col in df.columns:
-            # Verificar si aún quedan caracteres problemáticos
-            still_problematic = df[col].str.contains('aÃ±os|CONSEJERÃ|PREVENCIÃ', na=False).any()
-            
-            if still_problematic:
-                app.logger.warning(f"❌ Aún hay problemas en '{col}'. Aplicando corrección forzada...")
-                # Corrección forzada adicional
-                df[col] = df[col].str.replace('aÃ±os', 'años', regex=False)
-                df[col] = df[col].str.replace('aÃ±o', 'año', regex=False)
-                df[col] = df[col].str.replace('CONSEJERÃA', 'CONSEJERÍA', regex=False)
-                df[col] = df[col].str.replace('PREVENCIÃ“N', 'PREVENCIÓN', regex=False)
-                df[col] = df[col].str.replace('Ã±', 'ñ', regex=False)
-                df[col] = df[col].str.replace('Ã“', 'Ó', regex=False)
-                df[col] = df[col].str.replace('Ã‰', 'É', regex=False)
-            
-            # Mostrar muestra de valores corregidos
-            sample_values = df[col].dropna().unique()[:2]
-            app.logger.debug(f"DEBUG: Valores corregidos en '{col}': {sample_values}")
+            df[col], corrected_values = normalize_text_column(df[col])
+            if corrected_values:
+                app.logger.info(f"✅ Correcciones de encoding en '{col}': {corrected_values} valores distintos corregidos")
 
-    app.logger.info(f"{os.path.basename(filepath)} cargado y procesado ({df.shape[0]} filas, {df.shape[1]} columnas) con encoding '{encoding_used}'")
+    app.logger.info(f"{source_name(filepath)} cargado y procesado ({df.shape[0]} filas, {df.shape[1]} columnas) con encoding '{encoding_used}'")
     
     return df
 
+# --- CACHÉ DE MAESTROS ESTÁTICOS ---
+# Los maestros estáticos cambian pocas veces al año: cada worker los carga y limpia una
+# sola vez y solo los recarga cuando cambia el archivo. Los DataFrames cacheados se
+# comparten entre requests, por lo que NO deben modificarse in-place.
+_static_masters_cache = {}
+_static_masters_lock = threading.Lock()
+
+def _file_signature(filepath):
+    stat = os.stat(filepath)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _file_sha256(filepath, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def get_static_master(filename, config):
+    """
+    Devuelve el maestro estático ya cargado y preprocesado, usando la caché del proceso.
+
+    El archivo se vuelve a leer solo si cambió su mtime/tamaño y, además, su hash SHA-256
+    (un simple 'touch' o una copia idéntica no provocan recarga).
+    """
+    master_path = os.path.join(DATA_FOLDER, filename)
+    try:
+        signature = _file_signature(master_path)
+    except OSError as e:
+        app.logger.error(f"No se pudo acceder al maestro estático {filename}: {e}")
+        return None
+
+    with _static_masters_lock:
+        entry = _static_masters_cache.get(filename)
+        if entry and entry['signature'] == signature:
+            return entry['df']
+
+        sha256 = _file_sha256(master_path)
+        if entry and entry['sha256'] == sha256:
+            entry['signature'] = signature
+            app.logger.info(f"Maestro estático {filename} con nuevo mtime pero mismo contenido. Se mantiene en caché.")
+            return entry['df']
+
+        df = load_and_preprocess_csv(
+            master_path,
+            expected_cols=config.get('cols'),
+            rename_map=None,
+            fill_zfill='Id_Establecimiento' if filename == 'MAESTRO_HIS_ESTABLECIMIENTO.csv' else None,
+            use_custom_load=config.get('use_custom_load', False)
+        )
+        if df is None:
+            return None
+
+        _static_masters_cache[filename] = {
+            'df': df,
+            'signature': signature,
+            'sha256': sha256,
+            'loaded_at': datetime.now()
+        }
+        app.logger.info(f"Maestro estático {filename} {'recargado' if entry else 'cargado'} en caché ({df.shape[0]} filas).")
+        return df
+
+def get_static_masters_status():
+    with _static_masters_lock:
+        return [
+            {
+                'archivo': filename,
+                'filas': int(entry['df'].shape[0]),
+                'columnas': int(entry['df'].shape[1]),
+                'sha256': entry['sha256'],
+                'mtime': datetime.fromtimestamp(entry['signature'][0] / 1e9).isoformat(timespec='seconds'),
+                'tamano_bytes': entry['signature'][1],
+                'cargado_en': entry['loaded_at'].isoformat(timespec='seconds')
+            }
+            for filename, entry in sorted(_static_masters_cache.items())
+        ]
+
 def identify_dynamic_master(filepath):
-    basename = os.path.basename(filepath).lower()
-    
-    if any(keyword in basename for keyword in ['trama', 'plano', 'nominal']):
-        app.logger.info(f"Archivo {basename} identificado como: plano (por palabras clave en nombre)")
-        return 'plano'
-    
-    for original_key, config in APP_CONFIG['DYNAMIC_MASTERS'].items():
-        if original_key.lower() in basename.lower():
-            app.logger.info(f"Archivo {basename} identificado como: {config['type']} (detección inicial por nombre)")
-            return config['type']
+    basename = source_name(filepath).lower()
     
     try:
-        # Usar UTF-8 como primera opción también aquí
-        try:
-            temp_df = pd.read_csv(filepath, sep=detect_separator(filepath), encoding='utf-8', nrows=5, dtype=str, keep_default_na=False, engine='python')
-        except UnicodeDecodeError:
-            temp_df = pd.read_csv(filepath, sep=detect_separator(filepath), encoding='latin1', nrows=5, dtype=str, keep_default_na=False, engine='python')
-            
-        temp_df.columns = temp_df.columns.str.strip()
-        if 'ï»¿Id_Cita' in temp_df.columns:
-            temp_df.rename(columns={'ï»¿Id_Cita': 'Id_Cita'}, inplace=True)
-            
-        for original_key, config in APP_CONFIG['DYNAMIC_MASTERS'].items():
-            identifier_cols = config.get('identifier_cols', [])
-            if identifier_cols and all(col in temp_df.columns for col in identifier_cols):
-                app.logger.info(f"Archivo {basename} identificado como: {config['type']} (detección por columnas: {identifier_cols})")
-                return config['type']
+        profile = profile_file(filepath)
     except Exception as e:
         app.logger.warning(f"No se pudo leer el archivo {basename} para identificar por columnas: {e}")
+        return None
+
+    if profile['master_type']:
+        app.logger.info(f"Archivo {basename} identificado como: {profile['master_type']} ({profile['detection']})")
+        return profile['master_type']
 
     app.logger.warning(f"No se pudo identificar el tipo de maestro para el archivo: {basename}")
     return None
 
+def _sql_string(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def build_tramas_scan_sql(conn, trama_files_paths):
+    """
+    Construye una única consulta DuckDB que lee todas las tramas en un solo escaneo paralelo.
+
+    Las columnas se alinean por nombre (union_by_name), por lo que no importa el orden de
+    columnas de cada archivo, y se agrega 'Archivo_Origen' con el nombre del archivo fuente.
+    Si hay archivos con distinto separador, se agrupan por separador y se unen por nombre.
+    Las tramas que llegan dentro de un ZIP/GZIP (UploadedCsv) se leen en streaming con
+    pyarrow y DuckDB las consume directamente, sin extraerlas a disco.
+    """
+    files_by_separator = {}
+    streamed_sources = []
+    for trama_path in trama_files_paths:
+        if isinstance(trama_path, UploadedCsv):
+            streamed_sources.append(trama_path)
+        else:
+            files_by_separator.setdefault(detect_separator(trama_path), []).append(trama_path)
+
+    scans = []
+    for separator, paths in files_by_separator.items():
+        file_list = ', '.join(_sql_string(path) for path in paths)
+        scans.append(f"""
+            SELECT * EXCLUDE (filename), parse_filename(filename) AS Archivo_Origen
+            FROM read_csv([{file_list}],
+            delim={_sql_string(separator)},
+            header=true,
+            all_varchar=true,
+            ignore_errors=true,
+            union_by_name=true,
+            filename=true)
+        """)
+
+    for i, source in enumerate(streamed_sources):
+        view_name = f"trama_stream_{i}"
+        conn.register(view_name, open_csv_stream_reader(source))
+        scans.append(f"SELECT *, {_sql_string(source.name)} AS Archivo_Origen FROM {view_name}")
+
+    return '\nUNION ALL BY NAME\n'.join(scans)
+
+def open_csv_stream_reader(source):
+    """
+    Abre un UploadedCsv como RecordBatchReader de pyarrow (todas las columnas como texto,
+    vacíos como NULL y filas mal formadas descartadas, igual que read_csv de DuckDB).
+    """
+    profile = profile_file(source)
+    encoding = 'utf8' if profile['encoding'].startswith('utf-8') else profile['encoding']
+    return pa_csv.open_csv(
+        source.open(),
+        read_options=pa_csv.ReadOptions(encoding=encoding),
+        parse_options=pa_csv.ParseOptions(
+            delimiter=profile['separator'],
+            newlines_in_values=True,
+            invalid_row_handler=lambda row: 'skip'
+        ),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={col: pa.string() for col in profile['columns']},
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True
+        )
+    )
+
 def consolidate_multiple_tramas_duckdb(trama_files_paths):
     if not trama_files_paths:
         return None
@@ -390,32 +710,8 @@ def consolidate_multiple_tramas_duckdb(trama_files_paths):
     conn = get_duckdb_connection()
     
     try:
-        for i, trama_path in enumerate(trama_files_paths):
-            separator = detect_separator(trama_path)
-            app.logger.info(f"Procesando trama {i+1}/{len(trama_files_paths)} con DuckDB: {os.path.basename(trama_path)}")
-            
-            if i == 0:
-                conn.execute(f"""
-                    CREATE OR REPLACE TABLE consolidated_tramas AS 
-                    SELECT * FROM read_csv_auto('{trama_path}', 
-                    delim='{separator}',
-                    header=true,
-                    all_varchar=true,
-                    ignore_errors=true)
-                """)
-                app.logger.info(f"Primera trama cargada con DuckDB. Filas: {conn.execute('SELECT COUNT(*) FROM consolidated_tramas').fetchone()[0]}")
-            else:
-                conn.execute(f"""
-                    INSERT INTO consolidated_tramas 
-                    SELECT * FROM read_csv_auto('{trama_path}', 
-                    delim='{separator}',
-                    header=true,
-                    all_varchar=true,
-                    ignore_errors=true)
-                """)
-                app.logger.info(f"Trama adicional agregada con DuckDB. Total acumulado: {conn.execute('SELECT COUNT(*) FROM consolidated_tramas').fetchone()[0]} filas")
-        
-        result = conn.execute("SELECT * FROM consolidated_tramas").df()
+        app.logger.info(f"Leyendo {len(trama_files_paths)} tramas con DuckDB en un solo escaneo: {[source_name(p) for p in trama_files_paths]}")
+        result = conn.execute(build_tramas_scan_sql(conn, trama_files_paths)).df()
         result.columns = result.columns.str.strip()
         if 'ï»¿Id_Cita' in result.columns:
             result.rename(columns={'ï»¿Id_Cita': 'Id_Cita'}, inplace=True)
@@ -434,13 +730,12 @@ def consolidate_multiple_tramas(trama_files_paths):
 
 def calcular_edades_y_grupo(df):
     """
-    Calcula las edades en diferentes unidades y el grupo etario
+    Calcula las edades exactas (días, meses y años cumplidos) a la fecha de atención y a
+    la fecha actual, y el grupo etario, con el motor vectorizado de edades.py
     """
     app.logger.info("Calculando edades y grupo etario...")
     
-    # Asegurarse de que las fechas estén en formato datetime
     if 'Fecha_Nacimiento_Paciente' in df.columns and 'Fecha_Atencion' in df.columns:
-        
         # Convertir a datetime si no lo están
         if not pd.api.types.is_datetime64_any_dtype(df['Fecha_Nacimiento_Paciente']):
             df['Fecha_Nacimiento_Paciente'] = pd.to_datetime(df['Fecha_Nacimiento_Paciente'], errors='coerce')
@@ -448,67 +743,17 @@ def calcular_edades_y_grupo(df):
         if not pd.api.types.is_datetime64_any_dtype(df['Fecha_Atencion']):
             df['Fecha_Atencion'] = pd.to_datetime(df['Fecha_Atencion'], errors='coerce')
         
-        # Fecha actual para cálculos
-        fecha_actual = datetime.now()
-        
-        # Calcular edades en relación a Fecha_Atencion
-        mask_fechas_validas = df['Fecha_Nacimiento_Paciente'].notna() & df['Fecha_Atencion'].notna()
-        mask_fecha_atencion_mayor = mask_fechas_validas & (df['Fecha_Atencion'] >= df['Fecha_Nacimiento_Paciente'])
-        
-        # Edades respecto a Fecha_Atencion
-        df['Edad_Dias_Paciente_FechaAtencion'] = 0
-        df['Edad_Meses_Paciente_FechaAtencion'] = 0
-        df['Edad_Anios_Paciente_FechaAtencion'] = 0
-        
-        df.loc[mask_fecha_atencion_mayor, 'Edad_Dias_Paciente_FechaAtencion'] = (
-            df.loc[mask_fecha_atencion_mayor, 'Fecha_Atencion'] - 
-            df.loc[mask_fecha_atencion_mayor, 'Fecha_Nacimiento_Paciente']
-        ).dt.days
-        
-        # Calcular meses y años (aproximados)
-        df.loc[mask_fecha_atencion_mayor, 'Edad_Anios_Paciente_FechaAtencion'] = (
-            (df.loc[mask_fecha_atencion_mayor, 'Fecha_Atencion'].dt.year - 
-             df.loc[mask_fecha_atencion_mayor, 'Fecha_Nacimiento_Paciente'].dt.year) -
-            ((df.loc[mask_fecha_atencion_mayor, 'Fecha_Atencion'].dt.month - 
-              df.loc[mask_fecha_atencion_mayor, 'Fecha_Nacimiento_Paciente'].dt.month) < 0)
-        )
-        
-        df.loc[mask_fecha_atencion_mayor, 'Edad_Meses_Paciente_FechaAtencion'] = (
-            df.loc[mask_fecha_atencion_mayor, 'Edad_Anios_Paciente_FechaAtencion'] * 12 +
-            (df.loc[mask_fecha_atencion_mayor, 'Fecha_Atencion'].dt.month - 
-             df.loc[mask_fecha_atencion_mayor, 'Fecha_Nacimiento_Paciente'].dt.month)
-        )
+        edad_atencion, edad_actual = calcular_edades(df['Fecha_Nacimiento_Paciente'], df['Fecha_Atencion'])
         
-        # Edades respecto a Fecha Actual
-        mask_fecha_nacimiento_valida = df['Fecha_Nacimiento_Paciente'].notna()
-        mask_fecha_actual_mayor = mask_fecha_nacimiento_valida & (pd.Timestamp(fecha_actual) >= df['Fecha_Nacimiento_Paciente'])
+        # Las filas sin fechas válidas (o con nacimiento posterior) quedan en 0
+        for sufijo, edad in (('FechaAtencion', edad_atencion), ('FechaActual', edad_actual)):
+            df[f'Edad_Dias_Paciente_{sufijo}'] = edad['dias_totales']
+            df[f'Edad_Meses_Paciente_{sufijo}'] = edad['meses']
+            df[f'Edad_Anios_Paciente_{sufijo}'] = edad['anios']
         
-        df['Edad_Dias_Paciente_FechaActual'] = 0
-        df['Edad_Meses_Paciente_FechaActual'] = 0
-        df['Edad_Anios_Paciente_FechaActual'] = 0
-        
-        df.loc[mask_fecha_actual_mayor, 'Edad_Dias_Paciente_FechaActual'] = (
-            pd.Timestamp(fecha_actual) - 
-            df.loc[mask_fecha_actual_mayor, 'Fecha_Nacimiento_Paciente']
-        ).dt.days
-        
-        # Calcular meses y años actuales (aproximados)
-        df.loc[mask_fecha_actual_mayor, 'Edad_Anios_Paciente_FechaActual'] = (
-            (fecha_actual.year - 
-             df.loc[mask_fecha_actual_mayor, 'Fecha_Nacimiento_Paciente'].dt.year) -
-            ((fecha_actual.month - 
-              df.loc[mask_fecha_actual_mayor, 'Fecha_Nacimiento_Paciente'].dt.month) < 0)
-        )
-        
-        df.loc[mask_fecha_actual_mayor, 'Edad_Meses_Paciente_FechaActual'] = (
-            df.loc[mask_fecha_actual_mayor, 'Edad_Anios_Paciente_FechaActual'] * 12 +
-            (fecha_actual.month - 
-             df.loc[mask_fecha_actual_mayor, 'Fecha_Nacimiento_Paciente'].dt.month)
-        )
-        
-        app.logger.info(f"Edades calculadas: {mask_fecha_atencion_mayor.sum()} registros con fechas válidas")
+        app.logger.info(f"Edades calculadas: {int(edad_atencion['valida'].sum())} registros con fechas válidas")
     
-    # Calcular Grupo_Edad - CORREGIDO
+    # Grupo_Edad según la edad registrada en años (Tipo_Edad == 'A')
     df['Grupo_Edad'] = ''
     
     if 'Tipo_Edad' in df.columns and 'Edad_Reg' in df.columns:
@@ -516,452 +761,405 @@ def calcular_edades_y_grupo(df):
         if not pd.api.types.is_numeric_dtype(df['Edad_Reg']):
             df['Edad_Reg'] = pd.to_numeric(df['Edad_Reg'], errors='coerce')
         
-        # Aplicar lógica de grupos etarios - USAR MÉTODO MÁS SIMPLE
-        mask_edad_años = (df['Tipo_Edad'] == 'A') & df['Edad_Reg'].notna()
-        
-        # Crear una copa del DataFrame para trabajar con las condiciones
-        df_temp = df.loc[mask_edad_años].copy()
-        
-        if not df_temp.empty:
-            # Aplicar condiciones directamente
-            condiciones = [
-                df_temp['Edad_Reg'].between(0, 11),
-                df_temp['Edad_Reg'].between(12, 17),
-                df_temp['Edad_Reg'].between(18, 29),
-                df_temp['Edad_Reg'].between(30, 59),
-                df_temp['Edad_Reg'] >= 60
-            ]
-            
-            opciones = [
-                '0 a 11 años',
-                '12 a 17 años', 
-                '18 a 29 años',
-                '30 a 59 años',
-                '60 años a más'
-            ]
-            
-            # Usar np.select en el DataFrame temporal
-            grupo_edad_temp = np.select(condiciones, opciones, default='')
-            
-            # Asignar los resultados al DataFrame original
-            df.loc[mask_edad_años, 'Grupo_Edad'] = grupo_edad_temp
+        df['Grupo_Edad'] = grupo_edad(df['Edad_Reg'], (df['Tipo_Edad'] == 'A').to_numpy(dtype=bool, na_value=False))
         
         app.logger.info(f"Grupos etarios calculados: {(df['Grupo_Edad'] != '').sum()} registros asignados")
     
     return df
 
-def process_dynamic_masters_pandas(consolidado, all_masters):
-    app.logger.info("Pre-procesando maestros dinámicos y uniéndolos con sus estáticos específicos...")
+def _sql_ident(name):
+    return '"' + str(name).replace('"', '""') + '"'
 
-    if 'paciente' in all_masters['dynamic']:
-        df_paciente = all_masters['dynamic']['paciente'].copy()
-        original_key_paciente = next((k for k, v in APP_CONFIG['DYNAMIC_MASTERS'].items() if v['type'] == 'paciente'), None)
-        
-        if original_key_paciente: 
-            config_paciente = APP_CONFIG['DYNAMIC_MASTERS'][original_key_paciente] 
-            
-            renamed_cols_paciente = {}
-            for original_col, desired_col in config_paciente.get('rename_before_merge', {}).items():
-                if original_col in df_paciente.columns:
-                    df_paciente.rename(columns={original_col: desired_col}, inplace=True)
-                    renamed_cols_paciente[original_col] = desired_col
-            if renamed_cols_paciente:
-                app.logger.debug(f"DEBUG: Renombres aplicados en maestro 'paciente': {renamed_cols_paciente}")
-
-            # AGREGAR CAMPOS ADICIONALES DEL PACIENTE (sin Domicilio_declarado)
-            additional_cols = config_paciente.get('additional_cols', [])
-            # Remover Domicilio_declarado si está presente
-            if 'Domicilio_declarado' in additional_cols:
-                additional_cols.remove('Domicilio_declarado')
-            for col in additional_cols:
-                if col not in df_paciente.columns:
-                    df_paciente[col] = ''
-                    app.logger.debug(f"DEBUG: Columna adicional '{col}' agregada a maestro paciente")
-
-            if 'etnia' in all_masters['static'] and 'Id_Etnia' in df_paciente.columns:
-                df_paciente = pd.merge(df_paciente, all_masters['static']['etnia'][['Id_Etnia', 'Descripcion_Etnia']],
-                                    on='Id_Etnia', how='left')
-                app.logger.info("Maestro 'etnia' unido a 'paciente'.")
-            
-            if 'tipo_doc' in all_masters['static'] and 'Id_Tipo_Documento_Paciente' in df_paciente.columns:
-                df_tipo_doc_paciente_temp = all_masters['static']['tipo_doc'][['Id_Tipo_Documento', 'Descripcion_Tipo_Documento', 'Abrev_Tipo_Doc']].copy()
-                df_tipo_doc_paciente_temp.rename(columns={
-                    'Descripcion_Tipo_Documento': 'Descripcion_Tipo_Documento_Paciente',
-                    'Abrev_Tipo_Doc': 'Abrev_Tipo_Doc_Paciente'
-                }, inplace=True)
-                df_paciente = pd.merge(df_paciente, df_tipo_doc_paciente_temp,
-                                    left_on='Id_Tipo_Documento_Paciente', right_on='Id_Tipo_Documento', how='left')
-                df_paciente.drop(columns=['Id_Tipo_Documento'], inplace=True, errors='ignore')
-                app.logger.info("Maestro 'tipo_doc' unido a 'paciente' para sus descripciones.")
-            
-            all_masters['dynamic']['paciente'] = df_paciente
+def _sql_trimmed(expr):
+    return f"NULLIF(trim(CAST({expr} AS VARCHAR)), '')"
 
-    if 'personal' in all_masters['dynamic']:
-        df_personal = all_masters['dynamic']['personal'].copy()
-        original_key_personal = next((k for k, v in APP_CONFIG['DYNAMIC_MASTERS'].items() if v['type'] == 'personal'), None)
-        
-        if original_key_personal: 
-            config_personal = APP_CONFIG['DYNAMIC_MASTERS'][original_key_personal] 
-            
-            renamed_cols_personal = {}
-            for original_col, desired_col in config_personal.get('rename_before_merge', {}).items():
-                if original_col in df_personal.columns:
-                    df_personal.rename(columns={original_col: desired_col}, inplace=True)
-                    renamed_cols_personal[original_col] = desired_col
-            if renamed_cols_personal:
-                app.logger.debug(f"DEBUG: Renombres aplicados en maestro 'personal': {renamed_cols_personal}")
-            
-            if 'condicion_contrato' in all_masters['static'] and 'Id_Condicion_Personal' in df_personal.columns:
-                df_personal = pd.merge(df_personal, all_masters['static']['condicion_contrato'][['Id_Condicion', 'Descripcion_Condicion']],
-                                    left_on='Id_Condicion_Personal', right_on='Id_Condicion', how='left')
-                df_personal.drop(columns=['Id_Condicion'], inplace=True, errors='ignore')
-                app.logger.info("Maestro 'condicion_contrato' unido a 'personal'.")
-
-            if 'profesion' in all_masters['static'] and 'Id_Profesion_Personal' in df_personal.columns:
-                df_personal = pd.merge(df_personal, all_masters['static']['profesion'][['Id_Profesion', 'Descripcion_Profesion']],
-                                    left_on='Id_Profesion_Personal', right_on='Id_Profesion', how='left')
-                df_personal.drop(columns=['Id_Profesion'], inplace=True, errors='ignore')
-                app.logger.info("Maestro 'profesion' unido a 'personal'.")
-
-            if 'colegio' in all_masters['static'] and 'Id_Colegio_Personal' in df_personal.columns:
-                df_personal = pd.merge(df_personal, all_masters['static']['colegio'][['Id_Colegio', 'Descripcion_Colegio']],
-                                    left_on='Id_Colegio_Personal', right_on='Id_Colegio', how='left')
-                df_personal.drop(columns=['Id_Colegio'], inplace=True, errors='ignore')
-                app.logger.info("Maestro 'colegio' unido a 'personal'.")
-
-            if 'tipo_doc' in all_masters['static'] and 'Id_Tipo_Documento_Personal' in df_personal.columns:
-                df_tipo_doc_personal_temp = all_masters['static']['tipo_doc'][['Id_Tipo_Documento', 'Descripcion_Tipo_Documento', 'Abrev_Tipo_Doc']].copy()
-                df_tipo_doc_personal_temp.rename(columns={
-                    'Descripcion_Tipo_Documento': 'Descripcion_Tipo_Documento_Personal',
-                    'Abrev_Tipo_Doc': 'Abrev_Tipo_Doc_Personal'
-                }, inplace=True)
-                df_personal = pd.merge(df_personal, df_tipo_doc_personal_temp,
-                                    left_on='Id_Tipo_Documento_Personal', right_on='Id_Tipo_Documento', how='left')
-                df_personal.drop(columns=['Id_Tipo_Documento'], inplace=True, errors='ignore')
-                app.logger.info("Maestro 'tipo_doc' unido a 'personal' para sus descripciones.")
-            
-            all_masters['dynamic']['personal'] = df_personal
+def sql_cast_expression(expr, col):
+    """
+    Devuelve la expresión SQL que convierte 'expr' al tipo de 'col' según config_tipos.
+    Los valores que no se pueden convertir quedan en NULL (equivalente a errors='coerce').
+    """
+    if expr is None:
+        expr = 'NULL'
+    value = _sql_trimmed(expr)
+    if col in INTEGER_COLUMNS:
+        return f"CASE WHEN TRY_CAST({value} AS DOUBLE) % 1 = 0 THEN CAST(TRY_CAST({value} AS DOUBLE) AS BIGINT) END"
+    if col in DECIMAL_COLUMNS:
+        return f"TRY_CAST({value} AS DOUBLE)"
+    if col in DATE_COLUMNS:
+        return f"COALESCE(TRY_CAST({value} AS TIMESTAMP), try_strptime({value}, '%d/%m/%Y'))"
+    return expr
+
+def get_dynamic_master_config(master_type):
+    return next((v for v in APP_CONFIG['DYNAMIC_MASTERS'].values() if v['type'] == master_type), {})
+
+def build_dynamic_master_sql(master_type, master_columns, static_available):
+    """
+    Construye la subconsulta de un maestro dinámico (paciente, personal, registrador) con
+    sus renombres y los LEFT JOIN a sus maestros estáticos específicos (etnia, tipo_doc...).
 
-    if 'registrador' in all_masters['dynamic']:
-        df_registrador = all_masters['dynamic']['registrador'].copy()
-        original_key_registrador = next((k for k, v in APP_CONFIG['DYNAMIC_MASTERS'].items() if v['type'] == 'registrador'), None)
-        
-        if original_key_registrador: 
-            config_registrador = APP_CONFIG['DYNAMIC_MASTERS'][original_key_registrador]
-            
-            renamed_cols_registrador = {}
-            for original_col, desired_col in config_registrador.get('rename_before_merge', {}).items():
-                if original_col in df_registrador.columns:
-                    df_registrador.rename(columns={original_col: desired_col}, inplace=True)
-                    renamed_cols_registrador[original_col] = desired_col
-            if renamed_cols_registrador:
-                app.logger.debug(f"DEBUG: Renombres aplicados en maestro 'registrador': {renamed_cols_registrador}")
-
-            if 'tipo_doc' in all_masters['static'] and 'Id_Tipo_Documento_Registrador' in df_registrador.columns:
-                df_tipo_doc_registrador_temp = all_masters['static']['tipo_doc'][['Id_Tipo_Documento', 'Descripcion_Tipo_Documento', 'Abrev_Tipo_Doc']].copy()
-                df_tipo_doc_registrador_temp.rename(columns={
-                    'Descripcion_Tipo_Documento': 'Descripcion_Tipo_Documento_Registrador',
-                    'Abrev_Tipo_Doc': 'Abrev_Tipo_Doc_Registrador'
-                }, inplace=True)
-                df_registrador = pd.merge(df_registrador, df_tipo_doc_registrador_temp,
-                                        left_on='Id_Tipo_Documento_Registrador', right_on='Id_Tipo_Documento', how='left')
-                df_registrador.drop(columns=['Id_Tipo_Documento'], inplace=True, errors='ignore')
-                app.logger.info("Maestro 'tipo_doc' unido a 'registrador' para sus descripciones.")
-            
-            all_masters['dynamic']['registrador'] = df_registrador
+    Returns:
+        tuple: (sql, columnas resultantes)
+    """
+    config = get_dynamic_master_config(master_type)
+    rename_map = {orig: new for orig, new in config.get('rename_before_merge', {}).items() if orig in master_columns}
+    if rename_map:
+        app.logger.debug(f"DEBUG: Renombres aplicados en maestro '{master_type}': {rename_map}")
 
-    dynamic_masters_to_merge = {
-        'paciente': 'Id_Paciente',
-        'personal': 'Id_Personal',
-        'registrador': 'Id_Registrador'
-    }
+    renamed_columns = [rename_map.get(col, col) for col in master_columns]
+    select_parts = [f"d.{_sql_ident(col)}" for col in renamed_columns]
+    result_columns = list(renamed_columns)
+    join_clauses = []
 
-    for master_name, merge_col in dynamic_masters_to_merge.items():
-        df_dynamic = all_masters['dynamic'].get(master_name)
-        if df_dynamic is None or df_dynamic.empty:
-            app.logger.warning(f"Maestro dinámico '{master_name}' no disponible o vacío. Saltando unión.")
+    for i, join in enumerate(config.get('static_joins', [])):
+        if join['master'] not in static_available or join['left_on'] not in renamed_columns:
             continue
-        
-        if merge_col not in consolidado.columns:
-            app.logger.warning(f"No se pudo unir con maestro dinámico '{master_name}'. Columna de unión '{merge_col}' no encontrada en el consolidado.")
+        alias = f"j{i}"
+        join_clauses.append(
+            f"LEFT JOIN static_{join['master']} {alias} "
+            f"ON d.{_sql_ident(join['left_on'])} = {alias}.{_sql_ident(join['right_on'])}"
+        )
+        for src_col, dest_col in join['cols'].items():
+            select_parts.append(f"{alias}.{_sql_ident(src_col)} AS {_sql_ident(dest_col)}")
+            result_columns.append(dest_col)
+        app.logger.info(f"Maestro '{join['master']}' unido a '{master_type}'.")
+
+    renamed_source = ', '.join(
+        f"{_sql_ident(orig)} AS {_sql_ident(rename_map.get(orig, orig))}" for orig in master_columns
+    )
+    sql = f"""
+        SELECT {', '.join(select_parts)}
+        FROM (SELECT {renamed_source} FROM dynamic_{master_type}) d
+        {' '.join(join_clauses)}
+    """
+    return sql, result_columns
+
+def build_consolidation_sql(plano_columns, static_masters, dynamic_masters, typed_columns=()):
+    """
+    Construye la consulta única de consolidación: trama + maestros estáticos + maestros
+    dinámicos, con renombres, lógica de Ficha_Familiar, conversión de tipos y proyección
+    a FINAL_COLUMNS. Todo se resuelve en un solo plan de DuckDB.
+
+    Args:
+        plano_columns (list): Columnas de la tabla 'plano' (trama consolidada)
+        static_masters (dict): Nombre lógico -> columnas de cada maestro estático registrado
+        dynamic_masters (dict): Tipo -> columnas de cada maestro dinámico registrado
+        typed_columns: Columnas de 'plano' que ya vienen tipadas desde la lectura
+
+    Returns:
+        str: Consulta SQL
+    """
+    # Columna de salida -> expresión SQL. La trama tiene prioridad sobre los maestros.
+    exprs = {col: f"p.{_sql_ident(col)}" for col in plano_columns}
+    join_clauses = []
+
+    for filename, config in APP_CONFIG['STATIC_MASTERS'].items():
+        logical_name = os.path.splitext(filename)[0].replace('MAESTRO_HIS_', '').replace('MAESTRO_', '').lower()
+        merge_col = config.get('merge_on')
+        if logical_name not in static_masters or not merge_col or merge_col not in plano_columns:
+            continue
+
+        alias = f"s_{logical_name}"
+        rename_map = config.get('rename', {})
+        selected = False
+        for col in config.get('cols', []):
+            out_col = rename_map.get(col, col)
+            if col == merge_col or out_col in exprs:
+                continue
+            exprs[out_col] = f"{alias}.{_sql_ident(col)}"
+            selected = True
+        if selected:
+            join_clauses.append(
+                f"LEFT JOIN static_{logical_name} {alias} ON p.{_sql_ident(merge_col)} = {alias}.{_sql_ident(merge_col)}"
+            )
+            app.logger.info(f"✅ JOIN agregado para {filename}")
+
+    for master_type in ['paciente', 'personal', 'registrador']:
+        config = get_dynamic_master_config(master_type)
+        merge_col = config.get('merge_on')
+        master_columns = dynamic_masters.get(master_type)
+        if not master_columns:
+            app.logger.warning(f"Maestro dinámico '{master_type}' no disponible o vacío. Saltando unión.")
+            continue
+        if merge_col not in plano_columns:
+            app.logger.warning(f"No se pudo unir con maestro dinámico '{master_type}'. Columna de unión '{merge_col}' no encontrada en el consolidado.")
             continue
-        if merge_col not in df_dynamic.columns:
-            app.logger.warning(f"No se pudo unir con maestro dinámico '{master_name}'. Columna de unión '{merge_col}' no encontrada en el maestro dinámico.")
+        if merge_col not in master_columns:
+            app.logger.warning(f"No se pudo unir con maestro dinámico '{master_type}'. Columna de unión '{merge_col}' no encontrada en el maestro dinámico.")
             continue
 
-        consolidado[merge_col] = consolidado[merge_col].astype(str).str.strip()
-        df_dynamic[merge_col] = df_dynamic[merge_col].astype(str).str.strip()
-
-        # PARA PACIENTE: INCLUIR CAMPOS ADICIONALES (sin Domicilio_declarado)
-        cols_to_keep_from_dynamic = [col for col in df_dynamic.columns if col in FINAL_COLUMNS or col == merge_col]
-        if master_name == 'paciente':
-            config_paciente = APP_CONFIG['DYNAMIC_MASTERS'].get('MaestroPaciente', {})
-            additional_cols = config_paciente.get('additional_cols', [])
-            # Remover Domicilio_declarado si está presente
-            if 'Domicilio_declarado' in additional_cols:
-                additional_cols.remove('Domicilio_declarado')
-            cols_to_keep_from_dynamic.extend(additional_cols)
-            app.logger.debug(f"DEBUG: Campos adicionales para paciente: {additional_cols}")
-        
-        if master_name == 'personal':
-             cols_to_keep_from_dynamic.extend(['Id_Condicion_Personal', 'Id_Profesion_Personal', 'Id_Colegio_Personal', 'Numero_Colegiatura_Personal'])
-        
-        df_dynamic_filtered = df_dynamic[list(set(cols_to_keep_from_dynamic))]
+        alias = f"d_{master_type}"
+        master_sql, result_columns = build_dynamic_master_sql(master_type, master_columns, static_masters)
+        final_rename = config.get('final_rename', {})
 
-        app.logger.info(f"- Uniendo con maestro dinámico '{master_name}' en '{merge_col}'...")
-        initial_rows = consolidado.shape[0]
-        
-        original_consolidado_cols = consolidado.columns.tolist()
-        
-        consolidado = pd.merge(consolidado, df_dynamic_filtered, on=merge_col, how='left', suffixes=('', f'_{master_name}_drop'))
-        
-        for col in consolidado.columns:
-            if col.endswith(f'_{master_name}_drop'):
-                base_col = col.replace(f'_{master_name}_drop', '')
-                if base_col in original_consolidado_cols or base_col not in FINAL_COLUMNS:
-                    consolidado.drop(columns=[col], inplace=True)
-            
-        app.logger.info(f"Unión con '{master_name}' completada. Filas antes: {initial_rows}, Filas después: {consolidado.shape[0]}.")
+        selected = False
+        for col in result_columns:
+            if col == merge_col:
+                continue
+            if col in final_rename:
+                final_col = final_rename[col]
+                if final_col in exprs:
+                    exprs[final_col] = f"COALESCE(NULLIF({exprs[final_col]}, ''), {alias}.{_sql_ident(col)}, '')"
+                else:
+                    exprs[final_col] = f"{alias}.{_sql_ident(col)}"
+                selected = True
+            elif col in FINAL_COLUMNS and col not in exprs:
+                exprs[col] = f"{alias}.{_sql_ident(col)}"
+                selected = True
+        if selected:
+            join_clauses.append(
+                f"LEFT JOIN ({master_sql}) {alias} "
+                f"ON trim(p.{_sql_ident(merge_col)}) = trim({alias}.{_sql_ident(merge_col)})"
+            )
+            app.logger.info(f"- Uniendo con maestro dinámico '{master_type}' en '{merge_col}'...")
+
+    # Lógica específica para Ficha_Familiar: si no hay ficha ni documento, se usa Id_Paciente
+    def trimmed_or_empty(col):
+        return f"COALESCE(trim(CAST({exprs[col]} AS VARCHAR)), '')" if col in exprs else "''"
+
+    ficha = trimmed_or_empty('Ficha_Familiar')
+    documento = trimmed_or_empty('Numero_Documento_Paciente')
+    id_paciente = trimmed_or_empty('Id_Paciente')
+    exprs['Numero_Documento_Paciente'] = documento
+    exprs['Ficha_Familiar'] = (
+        f"CASE WHEN {ficha} = '' AND {documento} = '' AND {id_paciente} <> '' "
+        f"THEN {id_paciente} ELSE {ficha} END"
+    )
+
+    missing_cols = [col for col in FINAL_COLUMNS if col not in exprs]
+    if missing_cols:
+        app.logger.warning(f"Columnas FALTANTES: {missing_cols}")
 
-    app.logger.info("Realizando limpieza final, conversión de tipos y selección de columnas...")
-    
-    column_mapping_for_personal = {
-        'Id_Condicion_Personal': 'Id_Condicion',
-        'Id_Profesion_Personal': 'Id_Profesion',
-        'Id_Colegio_Personal': 'Id_Colegio',
-        'Numero_Colegiatura_Personal': 'Numero_Colegiatura'
-    }
+    # Las columnas de la trama ya tipadas al leerla se proyectan sin volver a convertirlas
+    typed_exprs = {f"p.{_sql_ident(col)}" for col in typed_columns}
+    select_list = ',\n            '.join(
+        f"{exprs[col] if exprs.get(col) in typed_exprs else sql_cast_expression(exprs.get(col), col)} AS {_sql_ident(col)}"
+        for col in FINAL_COLUMNS
+    )
+    return f"""
+        SELECT {select_list}
+        FROM plano p
+        {' '.join(join_clauses)}
+        ORDER BY p.__fila
+    """
 
-    for original_col, final_col in column_mapping_for_personal.items():
-        if original_col in consolidado.columns:
-            if final_col in consolidado.columns:
-                consolidado[final_col] = consolidado[final_col].replace('', np.nan)
-                consolidado[final_col].fillna(consolidado[original_col], inplace=True)
-                consolidado[final_col] = consolidado[final_col].fillna('')
-                app.logger.debug(f"DEBUG: Consolidando datos de '{original_col}' en '{final_col}'.")
-            else:
-                consolidado[final_col] = consolidado[original_col]
-                app.logger.debug(f"DEBUG: Copiando '{original_col}' a nueva columna '{final_col}'.")
-            consolidado.drop(columns=[original_col], errors='ignore', inplace=True)
+def load_tramas_table(conn, trama_files_paths):
+    """
+    Carga todas las tramas en la tabla DuckDB 'plano' (sin pasar por pandas), normalizando
+    los nombres de columna y el Id_Establecimiento con ceros a la izquierda (zfill 6).
 
-    # CALCULAR EDADES Y GRUPO ETARIO
-    consolidado = calcular_edades_y_grupo(consolidado)
+    Las columnas con tipo en config_tipos se convierten en la misma lectura (trim +
+    TRY_CAST, ver sql_cast_expression); los valores no vacíos que no se pueden convertir
+    quedan en NULL y se cuentan por columna.
 
-    # CONVERSIÓN DE TIPOS DE DATOS SEGÚN SQL SERVER
-    app.logger.info("Convirtiendo tipos de datos según SQL Server...")
-    
-    # Campos enteros
-    for col in INTEGER_COLUMNS:
-        if col in consolidado.columns:
-            consolidado[col] = consolidado[col].astype(str).str.strip()
-            consolidado[col] = consolidado[col].replace({'nan': '', 'None': '', '<NA>': ''}, regex=False)
-            # Convertir a numérico, manejar errores y luego a Int64 (que soporta NaN)
-            consolidado[col] = pd.to_numeric(consolidado[col], errors='coerce')
-            consolidado[col] = consolidado[col].astype('Int64')  # Int64 permite valores nulos
-            app.logger.debug(f"DEBUG: Columna '{col}' convertida a entero.")
-        else:
-            consolidado[col] = pd.NA  # Usar pd.NA para enteros
-            app.logger.warning(f"Columna entera '{col}' no encontrada.")
-
-    # Campos decimales
-    for col in DECIMAL_COLUMNS:
-        if col in consolidado.columns:
-            consolidado[col] = consolidado[col].astype(str).str.strip()
-            consolidado[col] = consolidado[col].replace({'nan': '', 'None': '', '<NA>': ''}, regex=False)
-            consolidado[col] = pd.to_numeric(consolidado[col], errors='coerce')
-            app.logger.debug(f"DEBUG: Columna '{col}' convertida a decimal.")
-        else:
-            consolidado[col] = None
-            app.logger.warning(f"Columna decimal '{col}' no encontrada.")
-
-    # Campos de fecha
-    app.logger.info("Preparando columnas de fecha para el formato de Excel...")
-    for col in DATE_COLUMNS:
-        if col in consolidado.columns:
-            consolidado[col] = consolidado[col].astype(str).str.strip()
-            consolidado[col] = consolidado[col].replace({'nan': '', 'None': '', '<NA>': ''}, regex=False)
-            consolidado[col] = pd.to_datetime(consolidado[col], errors='coerce')
-            app.logger.debug(f"DEBUG: Columna '{col}' convertida a datetime.")
+    Returns:
+        tuple: (columnas de 'plano', columnas tipadas, {columna: valores no convertibles})
+    """
+    conn.execute(f"CREATE OR REPLACE TEMP VIEW tramas_raw AS {build_tramas_scan_sql(conn, trama_files_paths)}")
+    raw_columns = [desc[0] for desc in conn.execute("DESCRIBE tramas_raw").fetchall()]
+
+    select_parts = []
+    plano_columns = []
+    typed_columns = []
+    failure_checks = []
+    for raw_col in raw_columns:
+        col = raw_col.strip().replace('ï»¿', '').replace('﻿', '')
+        if col == 'Id_Establecimiento':
+            value = f"COALESCE(trim({_sql_ident(raw_col)}), '')"
+            select_parts.append(
+                f"CASE WHEN length({value}) >= 6 THEN {value} ELSE lpad({value}, 6, '0') END AS {_sql_ident(col)}"
+            )
+        elif col in SQL_COLUMN_TYPES and col not in SCAN_TEXT_COLUMNS and col not in typed_columns:
+            cast = sql_cast_expression(_sql_ident(raw_col), col)
+            select_parts.append(f"{cast} AS {_sql_ident(col)}")
+            failure_checks.append(f"{_sql_trimmed(_sql_ident(raw_col))} IS NOT NULL AND {cast} IS NULL")
+            typed_columns.append(col)
         else:
-            consolidado[col] = pd.NaT
-            app.logger.warning(f"Columna de fecha '{col}' no encontrada.")
-
-    # Lógica específica para Ficha_Familiar
-    app.logger.info("Aplicando lógica específica para 'Ficha_Familiar'...")
-    
-    if 'Ficha_Familiar' in consolidado.columns:
-        consolidado['Ficha_Familiar'] = consolidado['Ficha_Familiar'].astype(str).str.strip().replace('nan', '', regex=False)
-    else:
-        consolidado['Ficha_Familiar'] = ''
-
-    if 'Id_Paciente' in consolidado.columns:
-        consolidado['Id_Paciente'] = consolidado['Id_Paciente'].astype(str).str.strip().replace('nan', '', regex=False)
-    else:
-        consolidado['Id_Paciente'] = ''
+            select_parts.append(f"{_sql_ident(raw_col)} AS {_sql_ident(col)}")
+        plano_columns.append(col)
+
+    # Fallos de conversión de cada fila como máscaras de bits (una por cada CAST_FAILURE_BITS columnas)
+    for mask_index, start in enumerate(range(0, len(failure_checks), CAST_FAILURE_BITS)):
+        bits = ' | '.join(
+            f"CASE WHEN {check} THEN {1 << bit} ELSE 0 END"
+            for bit, check in enumerate(failure_checks[start:start + CAST_FAILURE_BITS])
+        )
+        select_parts.append(f"CAST({bits} AS BIGINT) AS __fallos_{mask_index}")
 
-    if 'Numero_Documento_Paciente' in consolidado.columns:
-        consolidado['Numero_Documento_Paciente'] = consolidado['Numero_Documento_Paciente'].astype(str).str.strip().replace('nan', '', regex=False)
+    if 'Id_Establecimiento' not in plano_columns:
+        app.logger.warning("Columna 'Id_Establecimiento' NO encontrada en trama.")
+        select_parts.append("'' AS Id_Establecimiento")
+        plano_columns.append('Id_Establecimiento')
     else:
-        consolidado['Numero_Documento_Paciente'] = ''
-
-    condition_ficha_empty = (consolidado['Ficha_Familiar'] == '') | (consolidado['Ficha_Familiar'].isna())
-    condition_doc_empty = (consolidado['Numero_Documento_Paciente'] == '') | (consolidado['Numero_Documento_Paciente'].isna())
-    condition_id_paciente_not_empty = (consolidado['Id_Paciente'] != '') & (consolidado['Id_Paciente'].notna())
-
-    consolidado.loc[condition_ficha_empty & condition_doc_empty & condition_id_paciente_not_empty, 'Ficha_Familiar'] = consolidado['Id_Paciente']
-    
-    app.logger.info("Lógica de 'Ficha_Familiar' aplicada.")
-
-    # REINDEX
-    app.logger.info(f"Columnas ANTES del reindex: {list(consolidado.columns)}")
-    missing_cols = [col for col in FINAL_COLUMNS if col not in consolidado.columns]
-    if missing_cols:
-        app.logger.warning(f"Columnas FALTANTES: {missing_cols}")
-        for col in missing_cols:
-            # Asignar tipo correcto según la categoría de la columna
-            if col in INTEGER_COLUMNS:
-                consolidado[col] = pd.NA
-            elif col in DECIMAL_COLUMNS:
-                consolidado[col] = None
-            elif col in DATE_COLUMNS:
-                consolidado[col] = pd.NaT
-            else:
-                consolidado[col] = ''
-    consolidado = consolidado.reindex(columns=FINAL_COLUMNS)
-    
-    app.logger.info("🎉 CONSOLIDACIÓN FINALIZADA: {} registros, {} columnas".format(consolidado.shape[0], consolidado.shape[1]))
-    return consolidado
+        app.logger.info("Id_Establecimiento en trama (plano) formateado con zfill(6) antes del JOIN.")
+
+    # '__fila' conserva el orden original de las tramas, que los JOIN en paralelo no garantizan
+    conn.execute(f"CREATE OR REPLACE TEMP TABLE plano AS SELECT {', '.join(select_parts)}, row_number() OVER () AS __fila FROM tramas_raw")
+    total_rows = conn.execute("SELECT COUNT(*) FROM plano").fetchone()[0]
+    app.logger.info(f"Tramas cargadas en DuckDB: {total_rows} filas, {len(plano_columns)} columnas")
+    app.logger.info(f"Columnas en trama (plano): {plano_columns}")
+
+    cast_failures = {}
+    if typed_columns:
+        counts = conn.execute("SELECT " + ', '.join(
+            f"SUM((__fallos_{i // CAST_FAILURE_BITS} >> {i % CAST_FAILURE_BITS}) & 1)"
+            for i in range(len(typed_columns))
+        ) + " FROM plano").fetchone()
+        cast_failures = {col: int(count) for col, count in zip(typed_columns, counts) if count}
+        if cast_failures:
+            app.logger.warning(f"Valores no convertibles al tipo de su columna (quedan vacíos): {cast_failures}")
+    return plano_columns, typed_columns, cast_failures
+
+def remove_existing_rows(conn, base_df, typed_columns=()):
+    """
+    Modo incremental: elimina de 'plano' las filas cuya clave (ROW_KEY_COLUMNS), convertida
+    al mismo tipo que en el consolidado, ya existe en 'base_df'. Devuelve cuántas quitó.
+    """
+    conn.register('base_keys', base_df[ROW_KEY_COLUMNS])
+    conditions = ' AND '.join(
+        f"k.{_sql_ident(col)} IS NOT DISTINCT FROM "
+        + (f"p.{_sql_ident(col)}" if col in typed_columns else sql_cast_expression(f'p.{_sql_ident(col)}', col))
+        for col in ROW_KEY_COLUMNS
+    )
+    before = conn.execute("SELECT COUNT(*) FROM plano").fetchone()[0]
+    conn.execute(f"DELETE FROM plano p WHERE EXISTS (SELECT 1 FROM base_keys k WHERE {conditions})")
+    after = conn.execute("SELECT COUNT(*) FROM plano").fetchone()[0]
+    return before - after
+
+def generate_consolidated_data_duckdb(uploaded_files_paths, on_progress=None, base_df=None,
+                                      cached_dynamic_masters=None, dynamic_masters_out=None):
+    """
+    Genera el consolidado. 'on_progress(etapa, porcentaje)' recibe el avance por etapas
+    (lo usan los trabajos en segundo plano).
 
-def generate_consolidated_data_duckdb(uploaded_files_paths):
+    Modo incremental: con 'base_df' (consolidado anterior) solo se consolidan las filas de
+    las tramas nuevas cuya clave no está en la base, y se agregan al final. Los maestros
+    dinámicos que no vengan en esta subida se toman de 'cached_dynamic_masters'.
+    Si se pasa 'dynamic_masters_out' (dict), se llena con los maestros dinámicos usados.
+    """
+    progress = on_progress or (lambda stage, percent: None)
     conn = get_duckdb_connection()
     
     try:
-        all_masters = {'static': {}, 'dynamic': {}}
+        static_masters = {}
         
         # Cargar maestros estáticos
+        progress('maestros_estaticos', 5)
         app.logger.info("Cargando maestros estáticos...")
         for filename, config in APP_CONFIG['STATIC_MASTERS'].items():
-            master_path = os.path.join(DATA_FOLDER, filename)
-            df = load_and_preprocess_csv(
-                master_path,
-                expected_cols=config.get('cols'),
-                rename_map=None,
-                fill_zfill='Id_Establecimiento' if filename == 'MAESTRO_HIS_ESTABLECIMIENTO.csv' else None,
-                use_custom_load=config.get('use_custom_load', False)
-            )
+            df = get_static_master(filename, config)
             if df is None:
-                flash(f"Error al cargar el archivo estático: {filename}. No se pudo generar el consolidado.", "error")
+                notificar(f"Error al cargar el archivo estático: {filename}. No se pudo generar el consolidado.", "error")
                 return None
             logical_name = os.path.splitext(filename)[0].replace('MAESTRO_HIS_', '').replace('MAESTRO_', '').lower()
-            all_masters['static'][logical_name] = df
-            
-            table_name = f"static_{logical_name}"
-            conn.register(table_name, df)
+            static_masters[logical_name] = df.columns.tolist()
+            conn.register(f"static_{logical_name}", df)
         
         # Identificar y cargar maestros dinámicos
+        progress('identificando_archivos', 15)
         app.logger.info("Identificando y cargando maestros dinámicos (subidos por el usuario)...")
         
         trama_files = []
         other_dynamic_files = {}
+        preloaded_masters = {}
+        cache_keys = {}
         
         for upload_path in uploaded_files_paths:
+            # Mismo contenido ya procesado antes: se omite identificación y parseo
+            cache_key = upload_content_key(upload_path)
+            cached = cache_subidas.obtener(cache_key) if cache_key else None
+            if cached is not None:
+                master_type, df = cached
+                app.logger.info(f"Archivo {source_name(upload_path)} reutilizado desde la caché por contenido ({master_type})")
+                preloaded_masters[master_type] = df
+                continue
+
             master_type = identify_dynamic_master(upload_path)
             if master_type:
                 if master_type == 'plano':
                     trama_files.append(upload_path)
                 else:
                     other_dynamic_files[master_type] = upload_path
+                    cache_keys[master_type] = cache_key
             else:
-                flash(f"No se pudo identificar el tipo de archivo para: {os.path.basename(upload_path)}. Saltando archivo.", "warning")
+                notificar(f"No se pudo identificar el tipo de archivo para: {source_name(upload_path)}. Saltando archivo.", "warning")
         
-        # Consolidar tramas con DuckDB
-        if trama_files:
-            app.logger.info(f"Encontrados {len(trama_files)} archivos de trama/plano. Consolidando con DuckDB...")
-            plano_df = consolidate_multiple_tramas_duckdb(trama_files)
-            if plano_df is None:
-                flash("Error al consolidar los archivos de trama/plano.", "error")
-                return None
-            all_masters['dynamic']['plano'] = plano_df
-
-            if 'Id_Establecimiento' in plano_df.columns:
-                plano_df['Id_Establecimiento'] = plano_df['Id_Establecimiento'].fillna('').astype(str).str.strip().str.zfill(6)
-                app.logger.info("Id_Establecimiento en trama (plano) formateado con zfill(6) antes del JOIN.")
-            else:
-                app.logger.warning("Columna 'Id_Establecimiento' NO encontrada en trama.")
-                plano_df['Id_Establecimiento'] = ''
-
-            conn.register('plano', plano_df)
-
-            app.logger.info(f"Columnas en trama (plano): {list(plano_df.columns)}")
-            sample_ids = plano_df['Id_Establecimiento'].dropna().unique()[:5].tolist()
-            app.logger.info(f"Ejemplos de Id_Establecimiento en trama (zfill): {sample_ids}")
+        if not trama_files:
+            notificar("No se encontraron archivos de trama/plano. Son requeridos para la consolidación.", "error")
+            return None
 
-        else:
-            flash("No se encontraron archivos de trama/plano. Son requeridos para la consolidación.", "error")
+        # Cargar tramas directamente en DuckDB
+        progress('cargando_tramas', 25)
+        app.logger.info(f"Encontrados {len(trama_files)} archivos de trama/plano. Consolidando con DuckDB...")
+        try:
+            plano_columns, typed_columns, cast_failures = load_tramas_table(conn, trama_files)
+        except Exception as e:
+            app.logger.error(f"Error en consolidación de tramas con DuckDB: {e}")
+            notificar("Error al consolidar los archivos de trama/plano.", "error")
             return None
+        if cast_failures:
+            detalle = ', '.join(f"{col}: {count}" for col, count in cast_failures.items())
+            notificar(f"Valores que no se pudieron convertir al tipo de su columna (quedan vacíos): {detalle}", "warning")
         
-        # Cargar otros maestros dinámicos
+        if base_df is not None:
+            removed = remove_existing_rows(conn, base_df, typed_columns)
+            new_rows = conn.execute("SELECT COUNT(*) FROM plano").fetchone()[0]
+            app.logger.info(f"Modo incremental: {removed} filas ya consolidadas descartadas, {new_rows} filas nuevas")
+            if new_rows == 0:
+                notificar("Las tramas subidas no tienen filas nuevas respecto al consolidado anterior.", "warning")
+
+        # Cargar otros maestros dinámicos (los de esta subida reemplazan a los de caché)
+        progress('maestros_dinamicos', 40)
+        dynamic_frames = dict(cached_dynamic_masters or {})
+        dynamic_frames.update(preloaded_masters)
         for master_type, file_path in other_dynamic_files.items():
             df = load_and_preprocess_csv(file_path)
             if df is None:
-                flash(f"Error al cargar el archivo dinámico: {os.path.basename(file_path)}. No se pudo generar el consolidado.", "error")
+                notificar(f"Error al cargar el archivo dinámico: {source_name(file_path)}. No se pudo generar el consolidado.", "error")
                 return None
-            all_masters['dynamic'][master_type] = df
+            dynamic_frames[master_type] = df
+            if cache_keys.get(master_type):
+                cache_subidas.guardar(cache_keys[master_type], master_type, df)
+
+        dynamic_masters = {}
+        for master_type, df in dynamic_frames.items():
+            if df is None or df.empty:
+                continue
+            dynamic_masters[master_type] = df.columns.tolist()
             conn.register(f"dynamic_{master_type}", df)
+            if dynamic_masters_out is not None:
+                dynamic_masters_out[master_type] = df
         
-        # Realizar la consolidación principal con DuckDB
+        # Consolidación completa (joins, renombres, tipos y columnas finales) en un solo plan
+        progress('consolidando', 55)
         app.logger.info("Iniciando consolidación principal con DuckDB...")
-        
-        select_columns = ["p.*"]
-        join_clauses = []
-        
-        # Usar alias únicos para cada tabla
-        for filename, config in APP_CONFIG['STATIC_MASTERS'].items():
-            logical_name = os.path.splitext(filename)[0].replace('MAESTRO_HIS_', '').replace('MAESTRO_', '').lower()
-            merge_col = config.get('merge_on')
-            
-            if merge_col and merge_col in plano_df.columns:
-                table_name = f"static_{logical_name}"
-                alias = f"s_{logical_name}"  # Alias único para cada tabla
-                cols_to_select_temp = []
-                
-                app.logger.info(f"Procesando maestro estático: {logical_name} | merge_on: {merge_col}")
-                
-                for col in config.get('cols', []):
-                    if col == merge_col:
-                        continue
-                    cols_to_select_temp.append(f'{alias}."{col}"')
-                    app.logger.debug(f"SELECCIONANDO: {alias}.\"{col}\"")
-                
-                if cols_to_select_temp:
-                    select_columns.extend(cols_to_select_temp)
-                    join_clauses.append(f'''
-                        LEFT JOIN {table_name} {alias}
-                        ON p."{merge_col}" = {alias}."{merge_col}"
-                    ''')
-                    app.logger.info(f"✅ JOIN agregado para {filename}")
-        
-        base_query = f"""
-            SELECT {', '.join(select_columns)}
-            FROM plano p
-            {' '.join(join_clauses)}
-        """
-        
-        app.logger.info("Ejecutando consulta de consolidación con DuckDB...")
-        app.logger.debug(f"QUERY:\n{base_query}")
-        consolidado = conn.execute(base_query).df()
-        app.logger.info(f"✅ Consolidación principal completada. DataFrame intermedio: {consolidado.shape}")
-        
-        # Aplicar renombres después del JOIN
-        for filename, config in APP_CONFIG['STATIC_MASTERS'].items():
-            rename_map = config.get('rename', {})
-            for old_col, new_col in rename_map.items():
-                if old_col in consolidado.columns:
-                    consolidado.rename(columns={old_col: new_col}, inplace=True)
-                    app.logger.debug(f"RENOMBRADO POST-JOIN: {old_col} → {new_col}")
-        
-        consolidado = process_dynamic_masters_pandas(consolidado, all_masters)
-        
+        query = build_consolidation_sql(plano_columns, static_masters, dynamic_masters, typed_columns)
+        app.logger.debug(f"QUERY:\n{query}")
+        consolidado = conn.execute(query).df()
+        app.logger.info(f"✅ Consolidación principal completada. DataFrame: {consolidado.shape}")
+
+        # DuckDB entrega los enteros con nulos como float64: pasarlos a Int64 (admite nulos)
+        for col in INTEGER_COLUMNS:
+            if col in consolidado.columns:
+                consolidado[col] = consolidado[col].astype('Int64')
+
+        # CALCULAR EDADES Y GRUPO ETARIO
+        progress('calculando_edades', 75)
+        consolidado = calcular_edades_y_grupo(consolidado)
+        for col in ['Edad_Dias_Paciente_FechaAtencion', 'Edad_Meses_Paciente_FechaAtencion', 'Edad_Anios_Paciente_FechaAtencion',
+                    'Edad_Dias_Paciente_FechaActual', 'Edad_Meses_Paciente_FechaActual', 'Edad_Anios_Paciente_FechaActual']:
+            consolidado[col] = consolidado[col].astype('Int64')
+
+        if base_df is not None:
+            app.logger.info(f"Modo incremental: agregando {len(consolidado)} filas nuevas a {len(base_df)} existentes")
+            consolidado = pd.concat([base_df, consolidado], ignore_index=True)
+            consolidado.attrs[ATTR_NULOS_NONE] = list(base_df.attrs.get(ATTR_NULOS_NONE, []))
+
+        # Texto de pocos valores distintos como category (la concatenación incremental
+        # de categorías distintas devuelve object: se vuelve a compactar el total)
+        consolidado = compactar_tipos(consolidado)
+        consolidado.attrs[ATTR_CAST_FAILURES] = cast_failures
+
+        app.logger.info("🎉 CONSOLIDACIÓN FINALIZADA: {} registros, {} columnas".format(consolidado.shape[0], consolidado.shape[1]))
         return consolidado
         
     except Exception as e:
@@ -971,8 +1169,103 @@ def generate_consolidated_data_duckdb(uploaded_files_paths):
     finally:
         conn.close()
 
-def generate_consolidated_data(uploaded_files_paths):
-    return generate_consolidated_data_duckdb(uploaded_files_paths)
+def generate_consolidated_data(uploaded_files_paths, on_progress=None, **incremental):
+    return generate_consolidated_data_duckdb(uploaded_files_paths, on_progress=on_progress, **incremental)
+
+# --- CONSOLIDACIÓN EN SEGUNDO PLANO ---
+def open_saved_uploads(folder):
+    """
+    Convierte los archivos subidos guardados tal cual (zip, csv.gz, csv) en fuentes para
+    generate_consolidated_data. Devuelve (fuentes, streams abiertos a cerrar al terminar).
+    """
+    sources = []
+    streams = []
+    for filename in sorted(os.listdir(folder)):
+        path = os.path.join(folder, filename)
+        name_lower = filename.lower()
+        if name_lower.endswith('.zip'):
+            stream = open(path, 'rb')
+            streams.append(stream)
+            sources.extend(uploaded_csvs_from_zip(stream, digest=_file_sha256(path)))
+        elif name_lower.endswith('.csv.gz'):
+            stream = open(path, 'rb')
+            streams.append(stream)
+            sources.append(uploaded_csv_from_gzip(filename, stream, digest=_file_sha256(path)))
+        elif name_lower.endswith('.csv'):
+            sources.append(path)
+    return sources, streams
+
+@registrar_tarea('consolidar')
+def consolidar_trabajo(job_id, params):
+    sources, streams = open_saved_uploads(carpeta_entrada(job_id))
+    try:
+        if not sources:
+            raise ValueError("No se encontraron archivos .csv válidos dentro de los ZIPs o subidos.")
+        consolidated_df = generate_consolidated_data(sources, on_progress=reportar_progreso)
+    finally:
+        for stream in streams:
+            stream.close()
+
+    if consolidated_df is None or consolidated_df.empty:
+        raise ValueError("No se pudo generar el consolidado (posiblemente falta archivo de trama/plano).")
+
+    export_format = params.get('export_format', 'xlsx')
+    reportar_progreso('exportando', 90)
+    output_filename = f"Consolidado_Final.{export_format}"
+    escribir_exportacion(consolidated_df, export_format, os.path.join(carpeta_trabajo(job_id), output_filename))
+    return {
+        'archivo': output_filename,
+        'formato': export_format,
+        'registros': int(consolidated_df.shape[0]),
+        'columnas': int(consolidated_df.shape[1]),
+        'fallos_conversion': consolidated_df.attrs.get(ATTR_CAST_FAILURES, {})
+    }
+
+
+# --- DATASETS DE LA SESIÓN ---
+def _session_dataset_ids():
+    ids = {session.get(key) for key in (SESSION_DATASET_KEY, SESSION_FILTERED_KEY, SESSION_CONSOLIDATED_KEY)}
+    ids.update(session.get(SESSION_DYNAMIC_MASTERS_KEY, {}).values())
+    return ids
+
+def _replace_session_id(key, dataset_id, subkey=None):
+    """Asocia el ID a la sesión y borra el anterior si ya no lo usa ninguna otra clave."""
+    if subkey is None:
+        previous_id = session.get(key)
+        session[key] = dataset_id
+    else:
+        ids = dict(session.get(key, {}))
+        previous_id = ids.get(subkey)
+        ids[subkey] = dataset_id
+        session[key] = ids
+    if previous_id and previous_id not in _session_dataset_ids():
+        almacen_datasets.eliminar(previous_id)
+
+def set_session_dataset(key, df, *also_keys):
+    """
+    Guarda el DataFrame en el almacén y lo asocia a la sesión bajo 'key' (y 'also_keys'),
+    reemplazando el anterior.
+    """
+    dataset_id = almacen_datasets.guardar(df)
+    for session_key in (key,) + also_keys:
+        _replace_session_id(session_key, dataset_id)
+    return dataset_id
+
+def get_session_dataset(key):
+    return almacen_datasets.obtener(session.get(key))
+
+def set_session_dynamic_masters(frames):
+    """Guarda los maestros dinámicos usados en la consolidación (para el modo incremental)."""
+    for master_type, df in frames.items():
+        _replace_session_id(SESSION_DYNAMIC_MASTERS_KEY, almacen_datasets.guardar(df), subkey=master_type)
+
+def get_session_dynamic_masters():
+    frames = {}
+    for master_type, dataset_id in session.get(SESSION_DYNAMIC_MASTERS_KEY, {}).items():
+        df = almacen_datasets.obtener(dataset_id)
+        if df is not None:
+            frames[master_type] = df
+    return frames
 
 # --- RUTAS PRINCIPALES ---
 @app.route('/')
@@ -984,6 +1277,32 @@ def clear_cache():
     session.pop('_flashes', None)
     return jsonify({'success': True, 'message': 'Cache limpiado correctamente'})
 
+@app.route('/maestros_estado')
+def maestros_estado():
+    maestros = get_static_masters_status()
+    return jsonify({
+        'success': True,
+        'worker_pid': os.getpid(),
+        'total_maestros': len(maestros),
+        'maestros': maestros
+    })
+
+@app.route('/datasets_estado')
+def datasets_estado():
+    return jsonify({
+        'success': True,
+        'worker_pid': os.getpid(),
+        **almacen_datasets.estadisticas()
+    })
+
+@app.route('/cache_subidas_estado')
+def cache_subidas_estado():
+    return jsonify({
+        'success': True,
+        'worker_pid': os.getpid(),
+        **cache_subidas.estadisticas()
+    })
+
 @app.route('/limpiar_uploads')
 def limpiar_uploads():
     try:
@@ -1007,7 +1326,6 @@ def validar():
 
 @app.route('/upload_consolidar', methods=['POST'])
 def upload_consolidar():
-    global df_global
 
     if 'files[]' not in request.files:
         return "Error: No se seleccionaron archivos", 400
@@ -1018,41 +1336,50 @@ def upload_consolidar():
 
     # OBTENER FORMATO DE EXPORTACIÓN
     export_format = request.form.get('export_format', 'xlsx')  # Por defecto Excel
+    # MODO INCREMENTAL: agregar solo las tramas nuevas al último consolidado de la sesión
+    incremental = request.form.get('modo') == 'incremental'
+    base_df = None
+    if incremental:
+        base_df = get_session_dataset(SESSION_CONSOLIDATED_KEY)
+        if base_df is None:
+            return "Error: No hay un consolidado previo en la sesión al cual agregar tramas.", 400
 
     uploaded_files_paths = []
-    temp_dirs_to_cleanup = []
+    saved_files_paths = []
+    export_path = None
 
     try:
         for file in files:
             if file.filename == '':
                 continue
 
-            if file.filename.lower().endswith('.zip'):
+            filename_lower = file.filename.lower()
+            if filename_lower.endswith('.zip'):
                 try:
-                    temp_dir = tempfile.mkdtemp(prefix='zip_extract_', dir=UPLOAD_FOLDER)
-                    temp_dirs_to_cleanup.append(temp_dir)
-                    with zipfile.ZipFile(file.stream, 'r') as zip_ref:
-                        zip_ref.extractall(temp_dir)
-                        app.logger.info(f"ZIP extraído en: {temp_dir}")
-
-                    for root, _, filenames in os.walk(temp_dir):
-                        for filename in filenames:
-                            if filename.lower().endswith('.csv'):
-                                csv_path = os.path.join(root, filename)
-                                uploaded_files_paths.append(csv_path)
+                    # Los miembros del ZIP se leen en streaming, sin extraerlos a uploads/
+                    zip_sources = uploaded_csvs_from_zip(file.stream)
+                    app.logger.info(f"ZIP {file.filename}: {len(zip_sources)} CSVs leídos sin extraer")
+                    uploaded_files_paths.extend(zip_sources)
                 except zipfile.BadZipFile:
                     return f"Error: {file.filename} no es un ZIP válido.", 400
                 except Exception as e:
                     app.logger.error(f"Error procesando ZIP {file.filename}: {e}")
                     return f"Error al procesar ZIP {file.filename}: {str(e)}", 400
 
-            elif file.filename.lower().endswith('.csv'):
+            elif filename_lower.endswith('.csv.gz'):
+                uploaded_files_paths.append(uploaded_csv_from_gzip(os.path.basename(file.filename), file.stream))
+
+            elif filename_lower.endswith('.csv'):
+                # Los CSV sueltos se guardan para que DuckDB los escanee en paralelo desde disco
                 filepath = os.path.join(UPLOAD_FOLDER, secure_filename(file.filename))
                 file.save(filepath)
+                if isinstance(file.stream, HashingSpooledFile):
+                    register_upload_hash(filepath, file.stream.sha256)
                 uploaded_files_paths.append(filepath)
+                saved_files_paths.append(filepath)
 
             else:
-                app.logger.warning(f"Archivo ignorado (no es .csv ni .zip): {file.filename}")
+                app.logger.warning(f"Archivo ignorado (no es .csv, .csv.gz ni .zip): {file.filename}")
 
         if not uploaded_files_paths:
             return "Error: No se encontraron archivos .csv válidos dentro de los ZIPs o subidos.", 400
@@ -1060,73 +1387,133 @@ def upload_consolidar():
         app.logger.info(f"Total de CSVs a procesar: {len(uploaded_files_paths)}")
 
         # PROCESAR Y GENERAR CONSOLIDADO
-        consolidated_df = generate_consolidated_data(uploaded_files_paths)
+        cached_masters = get_session_dynamic_masters() if incremental else {}
+        dynamic_masters_used = {}
+        consolidated_df = generate_consolidated_data(
+            uploaded_files_paths,
+            base_df=base_df,
+            cached_dynamic_masters=cached_masters,
+            dynamic_masters_out=dynamic_masters_used
+        )
 
         if consolidated_df is None or consolidated_df.empty:
             return "Error: No se pudo generar el consolidado (posiblemente falta archivo de trama/plano).", 500
 
-        # GUARDAR EN MEMORIA (para validación futura si la implementas)
-        df_global = consolidated_df.copy()
-        app.logger.info(f"✅ DataFrame consolidado guardado en memoria: {df_global.shape}")
+        # GUARDAR EN EL ALMACÉN DE LA SESIÓN (para validación futura y para el modo incremental)
+        set_session_dataset(SESSION_DATASET_KEY, consolidated_df, SESSION_CONSOLIDATED_KEY)
+        set_session_dynamic_masters({
+            master_type: df for master_type, df in dynamic_masters_used.items()
+            if df is not cached_masters.get(master_type)
+        })
+        app.logger.info(f"✅ DataFrame consolidado guardado para la sesión: {consolidated_df.shape}")
 
-        # GENERAR ARCHIVO SEGÚN FORMATO
+        # GENERAR ARCHIVO SEGÚN FORMATO (todos se envían en streaming)
+        headers = {}
         if export_format == 'csv':
+            # CSV generado por bloques de filas (memoria pico constante)
             output_filename = "Consolidado_Final.csv"
-            output_buffer = io.BytesIO()
-            csv_content = consolidated_df.to_csv(index=False, encoding='utf-8-sig')
-            output_buffer.write(csv_content.encode('utf-8-sig'))
-            output_buffer.seek(0)
-            mimetype = 'text/csv; charset=utf-8'
+            mimetype = EXPORT_MIMETYPES['csv']
+            use_gzip = request.accept_encodings['gzip'] > 0
+            if use_gzip:
+                headers['Content-Encoding'] = 'gzip'
+                headers['Vary'] = 'Accept-Encoding'
+            body = stream_csv(consolidated_df, comprimir=use_gzip)
+
+        elif export_format in ('parquet', 'arrow'):
+            # Formatos binarios tipados según config_tipos (sin pasar por texto)
+            output_filename = f"Consolidado_Final.{export_format}"
+            mimetype = EXPORT_MIMETYPES[export_format]
+            export_path = generar_archivo_temporal(consolidated_df, export_format)
+            headers['Content-Length'] = str(os.path.getsize(export_path))
+            body = stream_archivo(export_path)
 
         else:  # Excel por defecto
+            # XLSX escrito fila a fila en memoria constante y enviado en bloques
             output_filename = "Consolidado_Final.xlsx"
-            output_buffer = io.BytesIO()
-            date_only_format = 'yyyy-mm-dd'
-            datetime_format = 'yyyy-mm-dd hh:mm:ss'
-            with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
-                consolidated_df.to_excel(writer, index=False, sheet_name='Consolidado')
-                workbook = writer.book
-                sheet = writer.sheets['Consolidado']
-                for col_name in DATE_COLUMNS:
-                    if col_name in consolidated_df.columns:
-                        col_idx = consolidated_df.columns.get_loc(col_name) + 1
-                        fmt = datetime_format if col_name in ['Fecha_Registro', 'Fecha_Modificacion'] else date_only_format
-                        for row_idx in range(2, sheet.max_row + 1):
-                            cell = sheet.cell(row=row_idx, column=col_idx)
-                            if isinstance(cell.value, pd.Timestamp):
-                                cell.number_format = fmt
-            output_buffer.seek(0)
-            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            mimetype = EXPORT_MIMETYPES['xlsx']
+            export_path = generar_archivo_temporal(consolidated_df, 'xlsx')
+            headers['Content-Length'] = str(os.path.getsize(export_path))
+            body = stream_archivo(export_path)
 
         # LIMPIAR ARCHIVOS TEMPORALES (solo si todo salió bien)
-        limpiar_archivos_especificos(uploaded_files_paths)
-        for temp_dir in temp_dirs_to_cleanup:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir, ignore_errors=True)
-                app.logger.info(f"Directorio temporal eliminado: {temp_dir}")
+        limpiar_archivos_especificos(saved_files_paths)
 
-        # DEVOLVER EL ARCHIVO REAL
-        return send_file(
-            output_buffer,
-            mimetype=mimetype,
-            as_attachment=True,
-            download_name=output_filename
-        )
+        # DEVOLVER EL ARCHIVO EN STREAMING (el temporal se elimina al cerrar la respuesta,
+        # aunque el cliente corte antes del primer bloque)
+        headers['Content-Disposition'] = f'attachment; filename={output_filename}'
+        response = Response(body, mimetype=mimetype, headers=headers)
+        if export_path:
+            response.call_on_close(lambda: eliminar_temporal(export_path))
+        return response
 
     except Exception as e:
         app.logger.error(f"Error inesperado en consolidación: {traceback.format_exc()}")
         # Limpiar en caso de error
-        limpiar_archivos_especificos(uploaded_files_paths)
-        for temp_dir in temp_dirs_to_cleanup:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir, ignore_errors=True)
+        limpiar_archivos_especificos(saved_files_paths)
+        eliminar_temporal(export_path)
         return f"Error interno del servidor: {str(e)}", 500
 
+@app.route('/trabajos/consolidar', methods=['POST'])
+def submit_consolidation_job():
+    """Encola la consolidación y responde de inmediato con el ID del trabajo."""
+    files = [f for f in request.files.getlist('files[]') if f.filename]
+    if not files:
+        return jsonify({'error': 'No se seleccionaron archivos válidos'}), 400
+
+    export_format = request.form.get('export_format', 'xlsx')
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({'error': f'Formato de exportación no soportado: {export_format}'}), 400
+
+    # Filtrar por extensión antes de crear el trabajo (un rechazo no deja trabajos pendientes)
+    validos = []
+    for file in files:
+        if file.filename.lower().endswith(('.zip', '.csv.gz', '.csv')):
+            validos.append(file)
+        else:
+            app.logger.warning(f"Archivo ignorado (no es .csv, .csv.gz ni .zip): {file.filename}")
+    if not validos:
+        return jsonify({'error': 'No se encontraron archivos .csv, .csv.gz o .zip'}), 400
+
+    job_id = crear_trabajo('consolidar', {'export_format': export_format})
+    input_folder = carpeta_entrada(job_id)
+    for file in validos:
+        file.save(os.path.join(input_folder, secure_filename(file.filename)))
+
+    encolar_trabajo(job_id)
+    app.logger.info(f"Trabajo de consolidación encolado: {job_id} ({len(validos)} archivos)")
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'estado_url': url_for('consolidation_job_status', job_id=job_id),
+        'descarga_url': url_for('download_consolidation_job', job_id=job_id)
+    }), 202
+
+@app.route('/trabajos/<job_id>')
+def consolidation_job_status(job_id):
+    job = obtener_trabajo(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify({'success': True, **job})
+
+@app.route('/trabajos/<job_id>/descargar')
+def download_consolidation_job(job_id):
+    job = obtener_trabajo(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    if job['estado'] != ESTADO_COMPLETADO:
+        return jsonify({'error': 'El trabajo aún no está completado', 'estado': job['estado']}), 409
+
+    result = job['resultado']
+    return send_file(
+        os.path.abspath(os.path.join(carpeta_trabajo(job_id), result['archivo'])),
+        mimetype=EXPORT_MIMETYPES[result['formato']],
+        as_attachment=True,
+        download_name=result['archivo']
+    )
+
 # --- RUTAS PARA VALIDACIÓN DE ERRORES ---
 @app.route('/upload_validar', methods=['POST'])
 def upload_validar():
-    global df_global
-    
     if 'file' not in request.files:
         return jsonify({'error': 'No se seleccionó ningún archivo'}), 400
     
@@ -1134,30 +1521,34 @@ def upload_validar():
     if file.filename == '':
         return jsonify({'error': 'No se seleccionó ningún archivo'}), 400
     
-    # ACEPTAR TANTO EXCEL COMO CSV
-    if file and (file.filename.lower().endswith('.xlsx') or file.filename.lower().endswith('.csv')):
+    # ACEPTAR EXCEL, CSV Y LOS FORMATOS BINARIOS DEL CONSOLIDADO (PARQUET / ARROW)
+    if file and file.filename.lower().endswith(('.xlsx', '.csv', '.parquet', '.arrow')):
         try:
             if file.filename.lower().endswith('.xlsx'):
                 # Procesar Excel (comportamiento original)
                 df = pd.read_excel(file)
+            elif file.filename.lower().endswith(('.parquet', '.arrow')):
+                # Ya vienen tipados: se leen directo sin volver a parsear texto
+                formato = os.path.splitext(file.filename.lower())[1][1:]
+                df = leer_dataset_arrow(io.BytesIO(file.read()), formato)
             else:
-                # Procesar CSV
-                # Guardar temporalmente el archivo para detectar separador
+                # Procesar CSV con el mismo perfilado (encoding, BOM, separador) y la misma
+                # lectura en una pasada con el motor C que las tramas
                 temp_path = os.path.join(UPLOAD_FOLDER, secure_filename(file.filename))
                 file.save(temp_path)
-                
-                # Detectar separador y cargar CSV
-                separator = detect_separator(temp_path)
-                df = pd.read_csv(temp_path, sep=separator, encoding='latin1', dtype=str, keep_default_na=False, engine='python')
-                
-                # Limpiar archivo temporal
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+                try:
+                    df = load_and_preprocess_csv(temp_path)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                if df is None:
+                    return jsonify({'error': f'No se pudo leer el archivo CSV {file.filename}'}), 400
             
             # PROCESAR CON LAS FUNCIONES CORREGIDAS
             df = procesar_dataframe(df)
             df = formatear_fechas(df)
-            df_global = df
+            df = compactar_tipos(df)
+            set_session_dataset(SESSION_DATASET_KEY, df)
             data = preparar_datos_para_frontend(df)
             return jsonify({'success': True, 'message': 'Archivo cargado correctamente', 'data': data})
         except Exception as e:
@@ -1165,63 +1556,76 @@ def upload_validar():
             app.logger.error(traceback.format_exc())
             return jsonify({'error': f'Error al procesar el archivo: {str(e)}'}), 400
     else:
-        return jsonify({'error': 'Solo se permiten archivos Excel (.xlsx) o CSV (.csv)'}), 400
+        return jsonify({'error': 'Solo se permiten archivos Excel (.xlsx), CSV (.csv), Parquet (.parquet) o Arrow (.arrow)'}), 400
 
 @app.route('/filter/<filter_type>')
 def apply_filter(filter_type):
-    global df_global
-    if df_global is None:
-        return jsonify({'error': 'No hay datos cargados'}), 400
+    dataset_id = session.get(SESSION_DATASET_KEY)
     
     try:
-        # Asegurarse de que las columnas necesarias estén presentes
-        df_temp = df_global.copy()
-        
-        # Agregar columnas faltantes si es necesario
-        if 'Error' not in df_temp.columns:
-            df_temp['Error'] = ''
-        
         # Aplicar el filtro correspondiente
         if filter_type in ['duplicados', 'fechas_invalidas', 'documentos_invalidos']:
-            conn = get_duckdb_connection()
-            conn.register('df_global', df_temp)
-            
-            if filter_type == 'duplicados':
-                query = """
-                    SELECT *, COUNT(*) OVER (PARTITION BY Id_Cita) as count_duplicates
-                    FROM df_global 
-                    WHERE Id_Cita IN (
-                        SELECT Id_Cita 
+            # DuckDB consulta directamente la tabla Arrow mapeada en memoria (sin copiarla a pandas)
+            with almacen_datasets.abrir_tabla(dataset_id) as tabla:
+                if tabla is None:
+                    return jsonify({'error': 'No hay datos cargados'}), 400
+
+                conn = get_duckdb_connection()
+                conn.register('dataset_arrow', tabla)
+                columns = [name for name in tabla.column_names if not name.startswith('__index_level_')]
+                select_cols = ', '.join(_sql_ident(name) for name in columns)
+                if 'Error' not in columns:
+                    select_cols += ", '' AS Error"
+                conn.execute(f"CREATE TEMP VIEW df_global AS SELECT {select_cols} FROM dataset_arrow")
+
+                if filter_type == 'duplicados':
+                    query = """
+                        SELECT *, COUNT(*) OVER (PARTITION BY Id_Cita) as count_duplicates
                         FROM df_global 
-                        GROUP BY Id_Cita 
-                        HAVING COUNT(*) > 1
-                    )
-                """
-            elif filter_type == 'fechas_invalidas':
-                query = """
-                    SELECT * FROM df_global 
-                    WHERE Fecha_Atencion IS NULL 
-                       OR Fecha_Atencion = ''
-                       OR TRY_CAST(Fecha_Atencion AS DATE) IS NULL
-                """
-            elif filter_type == 'documentos_invalidos':
-                query = """
-                    SELECT * FROM df_global 
-                    WHERE Numero_Documento_Paciente IS NULL 
-                       OR Numero_Documento_Paciente = ''
-                       OR LENGTH(TRIM(Numero_Documento_Paciente)) < 3
-                """
-            
-            df_filtrado = conn.execute(query).df()
-            conn.close()
+                        WHERE Id_Cita IN (
+                            SELECT Id_Cita 
+                            FROM df_global 
+                            GROUP BY Id_Cita 
+                            HAVING COUNT(*) > 1
+                        )
+                    """
+                elif filter_type == 'fechas_invalidas':
+                    query = """
+                        SELECT * FROM df_global 
+                        WHERE Fecha_Atencion IS NULL 
+                           OR Fecha_Atencion = ''
+                           OR TRY_CAST(Fecha_Atencion AS DATE) IS NULL
+                    """
+                elif filter_type == 'documentos_invalidos':
+                    query = """
+                        SELECT * FROM df_global 
+                        WHERE Numero_Documento_Paciente IS NULL 
+                           OR Numero_Documento_Paciente = ''
+                           OR LENGTH(TRIM(Numero_Documento_Paciente)) < 3
+                    """
+
+                df_filtrado = conn.execute(query).df()
+                conn.close()
             
             # Asegurar que tenga columna Error
             if 'Error' not in df_filtrado.columns:
                 df_filtrado['Error'] = 'Error detectado'
                 
+        elif VALIDATION_BACKEND == 'duckdb':
+            # Validadores compilados a SQL sobre la tabla Arrow mapeada (sin pasarla a pandas)
+            with almacen_datasets.abrir_tabla(dataset_id) as tabla:
+                if tabla is None:
+                    return jsonify({'error': 'No hay datos cargados'}), 400
+                df_filtrado = validar_tabla(tabla, filter_type)
+
         else:
+            # Vista tipada del dataset compartida por todos los filtros (una por versión)
+            contexto = obtener_contexto(dataset_id, lambda: almacen_datasets.obtener(dataset_id))
+            if contexto is None:
+                return jsonify({'error': 'No hay datos cargados'}), 400
+
             # Usar las funciones de validación
-            df_filtrado = aplicar_filtro(df_temp, filter_type)
+            df_filtrado = aplicar_filtro(contexto, filter_type)
         
         return procesar_resultado_filtrado(df_filtrado, filter_type)
         
@@ -1231,22 +1635,80 @@ def apply_filter(filter_type):
         return jsonify({'error': f'Error al aplicar filtro: {str(e)}'}), 500
 
 def procesar_resultado_filtrado(df_filtrado, filter_type):
+    # Avisos de la validación que no son errores de fila (p. ej. historial no disponible)
+    avisos = df_filtrado.attrs.get(ATTR_AVISOS, [])
     if df_filtrado.empty:
-        return jsonify({'success': True, 'message': 'No se encontraron errores', 
+        return jsonify({'success': True, 'message': 'No se encontraron errores', 'avisos': avisos,
                        'data': {'columns': [], 'data': [], 'total_records': 0, 'shown_records': 0}})
     
     df_filtrado = formatear_fechas(df_filtrado)
     data = preparar_datos_para_frontend(df_filtrado)
-    app.config['df_filtrado'] = df_filtrado
+    set_session_dataset(SESSION_FILTERED_KEY, df_filtrado)
     return jsonify({'success': True, 
                    'message': f'Filtro {filter_type} aplicado: {len(df_filtrado)} errores encontrados', 
+                   'avisos': avisos,
                    'data': data})
 
+@app.route('/historial_dx/confirmar', methods=['POST'])
+def confirmar_historial_dx():
+    """
+    Registra en el historial de diagnósticos los meses del archivo validado en la sesión
+    (reemplazan a los mismos meses de su establecimiento). Los filtros solo lo consultan.
+    """
+    if not DX_HISTORY_DB:
+        return jsonify({'error': 'El historial de diagnósticos está desactivado (DX_HISTORY_DB)'}), 400
+    dataset_id = session.get(SESSION_DATASET_KEY)
+    try:
+        if VALIDATION_BACKEND == 'duckdb':
+            with almacen_datasets.abrir_tabla(dataset_id) as tabla:
+                if tabla is None:
+                    return jsonify({'error': 'No hay datos cargados'}), 400
+                periodos = confirmar_historial_tabla(tabla)
+        else:
+            contexto = obtener_contexto(dataset_id, lambda: almacen_datasets.obtener(dataset_id))
+            if contexto is None:
+                return jsonify({'error': 'No hay datos cargados'}), 400
+            periodos = confirmar_historial(contexto)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except HistorialNoDisponible as e:
+        return jsonify({'error': str(e)}), 503
+
+    if periodos.empty:
+        return jsonify({'error': 'El archivo no tiene fechas de atención válidas para registrar'}), 400
+    meses = ', '.join(
+        f"{mes} ({establecimiento or 'sin establecimiento'})"
+        for establecimiento, mes in periodos.itertuples(index=False)
+    )
+    app.logger.info(f"Historial de diagnósticos confirmado: {meses}")
+    return jsonify({'success': True, 'periodos': periodos.to_dict('records'),
+                    'message': f'Historial de diagnósticos actualizado con los meses: {meses}'})
+
+@app.route('/historial_dx/eliminar', methods=['POST'])
+def eliminar_historial_dx():
+    """Elimina entradas del historial de diagnósticos por paciente, mes (YYYY-MM) y/o establecimiento."""
+    datos = request.get_json(silent=True) or request.form
+    paciente = (datos.get('paciente') or '').strip()
+    mes = (datos.get('mes') or '').strip()
+    establecimiento = (datos.get('establecimiento') or '').strip()
+    if not paciente and not mes and not establecimiento:
+        return jsonify({'error': 'Indique el paciente (Numero_Documento_Paciente), el mes (YYYY-MM), '
+                                 'el establecimiento (Nombre_Establecimiento) o una combinación'}), 400
+    if mes and not re.fullmatch(r'\d{4}-\d{2}', mes):
+        return jsonify({'error': f'Mes no válido: {mes} (formato YYYY-MM)'}), 400
+    try:
+        eliminadas = eliminar_historial(paciente=paciente or None, mes=mes or None,
+                                        establecimiento=establecimiento or None)
+    except HistorialNoDisponible as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify({'success': True, 'eliminadas': eliminadas,
+                    'message': f'{eliminadas} entradas eliminadas del historial de diagnósticos'})
+
 
 @app.route('/download_errores')
 def download_errores():
     try:
-        df_filtrado = app.config.get('df_filtrado')
+        df_filtrado = get_session_dataset(SESSION_FILTERED_KEY)
         if df_filtrado is None or df_filtrado.empty:
             return jsonify({'error': 'No hay datos filtrados para descargar'}), 400
         
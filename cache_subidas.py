@@ -0,0 +1,145 @@
+# cache_subidas.py
+# Caché por contenido de los archivos subidos ya procesados: si un usuario vuelve a subir
+# el mismo MaestroPaciente/MaestroPersonal (mismo hash), se reutiliza la tabla limpia y
+# tipada en lugar de identificar y parsear el CSV otra vez.
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+
+import pyarrow as pa
+
+from almacen_datasets import df_a_tabla_arrow, tabla_arrow_a_df
+
+logger = logging.getLogger(__name__)
+
+PARSE_CACHE_FOLDER = os.environ.get('PARSE_CACHE_FOLDER', 'cache_subidas')
+PARSE_CACHE_MAX_MB = int(os.environ.get('PARSE_CACHE_MAX_MB', '1024'))
+# Cambiar esta versión invalida la caché cuando cambia la limpieza/parseo de los maestros
+PARSE_CACHE_VERSION = '1'
+
+# Metadato con el tipo de maestro detectado para el archivo
+_META_TIPO = b'dbcheck_tipo_maestro'
+
+# Tamaño en memoria antes de volcar un archivo subido a disco (igual que Werkzeug)
+SPOOL_MAX_BYTES = 500 * 1024
+
+
+class HashingSpooledFile:
+    """
+    Archivo temporal para uploads que calcula el SHA-256 del contenido a medida que
+    Werkzeug lo escribe, sin una segunda lectura.
+    """
+    def __init__(self):
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode='rb+')
+        self._sha = hashlib.sha256()
+
+    def write(self, data):
+        self._sha.update(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._sha.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+def clave_contenido(*partes):
+    """Clave de caché a partir del hash del archivo (y del miembro dentro de un ZIP)."""
+    return hashlib.sha256(':'.join((PARSE_CACHE_VERSION,) + partes).encode('utf-8')).hexdigest()
+
+
+class CacheSubidas:
+    def __init__(self, carpeta, max_bytes):
+        self.carpeta = carpeta
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        os.makedirs(carpeta, exist_ok=True)
+
+    def _ruta(self, clave):
+        return os.path.join(self.carpeta, f"{clave}.arrow")
+
+    def obtener(self, clave):
+        """Devuelve (tipo_maestro, DataFrame) si el contenido ya fue procesado, o None."""
+        ruta = self._ruta(clave)
+        try:
+            with pa.memory_map(ruta, 'r') as mapa:
+                tabla = pa.ipc.open_file(mapa).read_all()
+                tipo = tabla.schema.metadata[_META_TIPO].decode('utf-8')
+                df = tabla_arrow_a_df(tabla)
+            os.utime(ruta)  # Marca de uso reciente para el LRU
+        except (FileNotFoundError, KeyError, pa.ArrowInvalid):
+            with self._lock:
+                self.fallos += 1
+            return None
+        with self._lock:
+            self.aciertos += 1
+        return tipo, df
+
+    def guardar(self, clave, tipo, df):
+        tabla = df_a_tabla_arrow(df)
+        metadata = dict(tabla.schema.metadata or {})
+        metadata[_META_TIPO] = tipo.encode('utf-8')
+        tabla = tabla.replace_schema_metadata(metadata)
+        ruta = self._ruta(clave)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with pa.OSFile(temporal, 'wb') as sink:
+                with pa.ipc.new_file(sink, tabla.schema) as writer:
+                    writer.write_table(tabla)
+            os.replace(temporal, ruta)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar en caché el archivo procesado {clave}: {e}")
+            if os.path.exists(temporal):
+                os.remove(temporal)
+            return
+        self._expulsar()
+
+    def _archivos(self):
+        archivos = []
+        for nombre in os.listdir(self.carpeta):
+            if nombre.endswith('.arrow'):
+                try:
+                    stat = os.stat(os.path.join(self.carpeta, nombre))
+                except FileNotFoundError:
+                    continue
+                archivos.append((stat.st_mtime, stat.st_size, nombre))
+        return archivos
+
+    def _expulsar(self):
+        """Elimina los archivos menos usados hasta quedar bajo el tamaño máximo."""
+        archivos = sorted(self._archivos())
+        total = sum(tamano for _, tamano, _ in archivos)
+        for _, tamano, nombre in archivos:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.carpeta, nombre))
+                total -= tamano
+            except FileNotFoundError:
+                continue
+
+    def estadisticas(self):
+        archivos = self._archivos()
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': round(self.aciertos / consultas, 3) if consultas else None,
+                'archivos_en_cache': len(archivos),
+                'bytes_en_cache': sum(tamano for _, tamano, _ in archivos),
+                'max_bytes': self.max_bytes
+            }
+
+
+cache_subidas = CacheSubidas(PARSE_CACHE_FOLDER, PARSE_CACHE_MAX_MB * 1024 * 1024)
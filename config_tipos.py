@@ -40,6 +40,26 @@ DATE_COLUMNS = [
     'Fecha_Resultado_Hb', 'Fecha_Registro', 'Fecha_Modificacion'
 ]
 
+# Campos de fecha que conservan la hora (el resto de DATE_COLUMNS es solo fecha)
+DATETIME_COLUMNS = ['Fecha_Registro', 'Fecha_Modificacion']
+
+# Campos de texto con pocos valores distintos: se guardan como category (diccionario en Arrow)
+CATEGORICAL_COLUMNS = [
+    'Codigo_Item', 'Id_Ups', 'Tipo_Diagnostico', 'Valor_Lab', 'Lote', 'Genero', 'Id_Turno',
+    'Id_Financiador', 'Id_Condicion_Establecimiento', 'Id_Condicion_Servicio', 'Tipo_Edad',
+    'Id_Etnia', 'Id_Profesion', 'Id_Colegio', 'Id_dosis', 'Id_AplicacionOrigen',
+    'Abrev_Tipo_Doc_Paciente', 'Abrev_Tipo_Doc_Personal', 'Abrev_Tipo_Doc_Registrador',
+    'Codigo_Unico', 'Nombre_Establecimiento', 'renipress', 'Grupo_Edad'
+]
+
+# Prefijos de columnas que también son categóricas (todas las descripciones de maestros)
+CATEGORICAL_PREFIXES = ['Descripcion_']
+
+
+def es_categorica(col):
+    return col in CATEGORICAL_COLUMNS or any(str(col).startswith(p) for p in CATEGORICAL_PREFIXES)
+
+
 # Columnas finales del consolidado (igual que antes)
 FINAL_COLUMNS = [
     'Id_Cita', 'Anio', 'Mes', 'Dia', 'Fecha_Atencion', 'Lote', 'Num_Pag', 'Num_Reg',
@@ -0,0 +1,125 @@
+# edades.py
+# Cálculo vectorizado de edades exactas (años, meses y días de calendario) sobre arreglos
+# datetime64, compartido por la consolidación (calcular_edades_y_grupo) y la validación
+# (procesar_dataframe).
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Rangos de Grupo_Edad en años cumplidos: (mínimo, máximo inclusive, etiqueta)
+GRUPOS_EDAD = [
+    (0, 11, '0 a 11 años'),
+    (12, 17, '12 a 17 años'),
+    (18, 29, '18 a 29 años'),
+    (30, 59, '30 a 59 años'),
+    (60, None, '60 años a más'),
+]
+
+
+def a_dias(valores):
+    """Convierte una serie/arreglo de fechas (o textos ISO) a datetime64[D]; lo inválido queda NaT."""
+    if np.ndim(valores) == 0:
+        valores = [valores]
+    serie = pd.Series(valores) if not isinstance(valores, pd.Series) else valores
+    if not pd.api.types.is_datetime64_any_dtype(serie):
+        serie = pd.to_datetime(serie, errors='coerce')
+    if getattr(serie.dt, 'tz', None) is not None:
+        serie = serie.dt.tz_localize(None)
+    return serie.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+
+
+def _sumar_meses(nacimiento, meses_nacimiento, dia_nacimiento, n):
+    """
+    Fecha de nacimiento + n meses, con el día recortado al último día del mes destino
+    (31/01 + 1 mes = 28/02 o 29/02).
+    """
+    mes_destino = meses_nacimiento + n
+    inicio_mes = mes_destino.astype('datetime64[D]')
+    dias_mes = ((mes_destino + 1).astype('datetime64[D]') - inicio_mes).astype(np.int64)
+    return inicio_mes + (np.minimum(dia_nacimiento, dias_mes) - 1)
+
+
+def edad_exacta(nacimiento, referencia):
+    """
+    Edad de calendario exacta entre dos arreglos datetime64[D] (o una fecha de
+    referencia única), en una sola pasada vectorizada.
+
+    Returns:
+        dict de arreglos int64: 'anios' (años cumplidos), 'meses' (meses cumplidos
+        totales), 'dias' (días restantes tras el último mes cumplido), 'dias_totales',
+        y 'valida' (bool: ambas fechas presentes y referencia >= nacimiento).
+        En las filas no válidas todos los valores son 0.
+    """
+    nacimiento = np.asarray(nacimiento, dtype='datetime64[D]')
+    referencia = np.broadcast_to(np.asarray(referencia, dtype='datetime64[D]'), nacimiento.shape)
+
+    valida = ~np.isnat(nacimiento) & ~np.isnat(referencia)
+    valida &= np.where(valida, referencia >= nacimiento, False)
+
+    # Las filas inválidas se calculan sobre una fecha neutra y luego se ponen en 0
+    nac = np.where(valida, nacimiento, np.datetime64('2000-01-01', 'D'))
+    ref = np.where(valida, referencia, np.datetime64('2000-01-01', 'D'))
+
+    mes_nac = nac.astype('datetime64[M]')
+    dia_nac = (nac - mes_nac.astype('datetime64[D]')).astype(np.int64) + 1
+
+    # Meses de calendario entre ambas fechas; se descuenta uno si aún no se cumple el día
+    meses = (ref.astype('datetime64[M]') - mes_nac).astype(np.int64)
+    ancla = _sumar_meses(nac, mes_nac, dia_nac, meses)
+    no_cumplido = ancla > ref
+    meses = meses - no_cumplido
+    ancla = np.where(no_cumplido, _sumar_meses(nac, mes_nac, dia_nac, meses), ancla)
+
+    cero = np.zeros(nacimiento.shape, dtype=np.int64)
+    return {
+        'anios': np.where(valida, meses // 12, cero),
+        'meses': np.where(valida, meses, cero),
+        'dias': np.where(valida, (ref - ancla).astype(np.int64), cero),
+        'dias_totales': np.where(valida, (ref - nac).astype(np.int64), cero),
+        'valida': valida,
+    }
+
+
+def formato_edad(edad):
+    """Arreglo de textos 'xA-yM-zD' a partir de edad_exacta ('' en las filas no válidas)."""
+    anios = edad['anios'].astype(str).astype(object)
+    meses = (edad['meses'] % 12).astype(str).astype(object)
+    dias = edad['dias'].astype(str).astype(object)
+    texto = anios + 'A-' + meses + 'M-' + dias + 'D'
+    return np.where(edad['valida'], texto, '').astype(object)
+
+
+def grupo_edad(anios, mascara=None):
+    """
+    Etiqueta de Grupo_Edad para cada edad en años ('' fuera de rango, nula o fuera
+    de la máscara).
+    """
+    anios = pd.to_numeric(pd.Series(anios), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    aplicar = ~np.isnan(anios)
+    if mascara is not None:
+        aplicar &= np.asarray(mascara, dtype=bool)
+    condiciones = [
+        aplicar & (anios >= minimo) & (True if maximo is None else anios <= maximo)
+        for minimo, maximo, _ in GRUPOS_EDAD
+    ]
+    return np.select(condiciones, [etiqueta for _, _, etiqueta in GRUPOS_EDAD], default='').astype(object)
+
+
+def calcular_edades(nacimiento, atencion, fecha_actual=None):
+    """
+    Edades del paciente a la fecha de atención y a la fecha actual en una sola pasada.
+
+    Args:
+        nacimiento: Fechas de nacimiento (serie datetime64 o textos)
+        atencion: Fechas de atención (serie datetime64 o textos)
+        fecha_actual: Fecha de referencia "hoy" (por defecto, la fecha del sistema)
+
+    Returns:
+        tuple: (edad a la atención, edad actual), cada una como el dict de edad_exacta
+    """
+    nacimiento = a_dias(nacimiento)
+    atencion = a_dias(atencion)
+    hoy = np.datetime64(pd.Timestamp(fecha_actual or datetime.now()).date(), 'D')
+    return edad_exacta(nacimiento, atencion), edad_exacta(nacimiento, hoy)
@@ -0,0 +1,275 @@
+# exportacion.py
+# Motores de exportación del consolidado (escritura por filas y envío en streaming)
+
+import os
+import tempfile
+import zlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import xlsxwriter
+
+from config_tipos import INTEGER_COLUMNS, DECIMAL_COLUMNS, DATE_COLUMNS, DATETIME_COLUMNS, es_categorica
+from tipos_compactos import compactar_tipos
+
+# Tamaño de bloque con el que se envía un archivo generado al cliente
+STREAM_CHUNK_BYTES = 1024 * 1024
+# Filas que se convierten a objetos Python a la vez al escribir el XLSX
+XLSX_BLOQUE_FILAS = 10000
+# Filas por bloque en la descarga CSV en streaming
+CSV_BLOQUE_FILAS = 50000
+
+FORMATO_FECHA = 'yyyy-mm-dd'
+FORMATO_FECHA_HORA = 'yyyy-mm-dd hh:mm:ss'
+
+
+def _valores_columna(serie):
+    """
+    Convierte una columna a una lista de valores Python listos para xlsxwriter,
+    con None en lugar de NaN/NaT/pd.NA (celda vacía).
+    """
+    valores = serie.astype(object)
+    return valores.where(serie.notna(), None).tolist()
+
+
+def escribir_xlsx_streaming(df, ruta_salida, nombre_hoja='Consolidado',
+                            columnas_fecha=DATE_COLUMNS, columnas_fecha_hora=DATETIME_COLUMNS):
+    """
+    Escribe un DataFrame a XLSX fila por fila en memoria constante.
+
+    Usa xlsxwriter en modo constant_memory: cada fila se vuelca a disco en cuanto se
+    escribe, por lo que el libro nunca se mantiene completo en memoria. Los formatos de
+    fecha se resuelven una sola vez por columna en lugar de recorrer celda por celda.
+
+    Args:
+        df: DataFrame a exportar
+        ruta_salida: Ruta del archivo .xlsx a generar
+        nombre_hoja: Nombre de la hoja
+        columnas_fecha: Columnas que se escriben con formato de fecha
+        columnas_fecha_hora: Columnas que se escriben con formato de fecha y hora
+    """
+    columnas_fecha = set(columnas_fecha or [])
+    columnas_fecha_hora = set(columnas_fecha_hora or [])
+
+    workbook = xlsxwriter.Workbook(ruta_salida, {'constant_memory': True})
+    try:
+        worksheet = workbook.add_worksheet(nombre_hoja)
+        formato_fecha = workbook.add_format({'num_format': FORMATO_FECHA})
+        formato_fecha_hora = workbook.add_format({'num_format': FORMATO_FECHA_HORA})
+
+        # Un escritor por columna, resuelto una sola vez según su tipo
+        escritores = []
+        for col in df.columns:
+            serie = df[col]
+            if pd.api.types.is_datetime64_any_dtype(serie):
+                # Solo las columnas declaradas como fecha pura pierden la hora
+                formato = formato_fecha if col in columnas_fecha and col not in columnas_fecha_hora else formato_fecha_hora
+                escritores.append((worksheet.write_datetime, formato))
+            elif pd.api.types.is_bool_dtype(serie):
+                escritores.append((worksheet.write_boolean, None))
+            elif pd.api.types.is_numeric_dtype(serie):
+                escritores.append((worksheet.write_number, None))
+            else:
+                escritores.append((worksheet.write, None))
+
+        worksheet.write_row(0, 0, [str(col) for col in df.columns])
+
+        fila_idx = 1
+        for inicio in range(0, len(df), XLSX_BLOQUE_FILAS):
+            bloque = df.iloc[inicio:inicio + XLSX_BLOQUE_FILAS]
+            columnas = [_valores_columna(bloque[col]) for col in bloque.columns]
+            for fila in zip(*columnas):
+                for col_idx, valor in enumerate(fila):
+                    if valor is None:
+                        continue
+                    escribir, formato = escritores[col_idx]
+                    if formato is None:
+                        escribir(fila_idx, col_idx, valor)
+                    else:
+                        escribir(fila_idx, col_idx, valor, formato)
+                fila_idx += 1
+    finally:
+        workbook.close()
+
+
+def tipo_arrow_columna(col):
+    """
+    Tipo Arrow de una columna del consolidado según config_tipos.
+    Las columnas categóricas (Descripcion_*, Codigo_Item, ...) se codifican como diccionario.
+    """
+    if col in INTEGER_COLUMNS:
+        return pa.int64()
+    if col in DECIMAL_COLUMNS:
+        return pa.float64()
+    if col in DATETIME_COLUMNS:
+        return pa.timestamp('us')
+    if col in DATE_COLUMNS:
+        return pa.date32()
+    if es_categorica(col):
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def tabla_arrow(df):
+    """
+    Convierte el DataFrame a una tabla Arrow con el esquema de config_tipos.
+    Las columnas que no encajan en su tipo declarado se dejan con el tipo inferido.
+    """
+    columnas = []
+    campos = []
+    for col in df.columns:
+        serie = df[col]
+        tipo = tipo_arrow_columna(col)
+        try:
+            arreglo = pa.array(serie, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Columna object con tipos mezclados: todo lo no nulo se exporta como texto
+            serie = serie.astype(object).where(serie.notna(), None)
+            arreglo = pa.array(serie.map(lambda v: v if v is None else str(v)))
+        try:
+            # safe=False: las fechas solo-fecha pierden una hora que siempre es 00:00
+            arreglo = pc.cast(arreglo, tipo, safe=not pa.types.is_date(tipo))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            tipo = arreglo.type
+        columnas.append(arreglo)
+        campos.append(pa.field(str(col), tipo))
+    return pa.Table.from_arrays(columnas, schema=pa.schema(campos))
+
+
+def escribir_parquet(df, ruta_salida):
+    pq.write_table(tabla_arrow(df), ruta_salida, compression='zstd')
+
+
+def escribir_arrow(df, ruta_salida):
+    tabla = tabla_arrow(df)
+    opciones = pa.ipc.IpcWriteOptions(compression='zstd')
+    with pa.OSFile(ruta_salida, 'wb') as sink:
+        with pa.ipc.new_file(sink, tabla.schema, options=opciones) as writer:
+            writer.write_table(tabla)
+
+
+def escribir_csv(df, ruta_salida):
+    with open(ruta_salida, 'wb') as f:
+        for bloque in stream_csv(df):
+            f.write(bloque)
+
+
+ESCRITORES_EXPORTACION = {
+    'csv': escribir_csv,
+    'xlsx': escribir_xlsx_streaming,
+    'parquet': escribir_parquet,
+    'arrow': escribir_arrow,
+}
+
+
+def escribir_exportacion(df, formato, ruta_salida):
+    """Escribe el DataFrame en 'ruta_salida' con el formato indicado (csv, xlsx, parquet, arrow)."""
+    ESCRITORES_EXPORTACION[formato](df, ruta_salida)
+
+
+def generar_archivo_temporal(df, formato, **kwargs):
+    """
+    Genera el archivo de exportación en un temporal y devuelve su ruta.
+    El archivo debe eliminarse después de enviarlo (ver eliminar_temporal).
+    """
+    fd, ruta = tempfile.mkstemp(prefix='export_', suffix=f'.{formato}')
+    os.close(fd)
+    try:
+        ESCRITORES_EXPORTACION[formato](df, ruta, **kwargs)
+    except Exception:
+        os.remove(ruta)
+        raise
+    return ruta
+
+
+def leer_dataset_arrow(archivo, formato):
+    """
+    Lee un Parquet o Arrow IPC exportado por la aplicación sin volver a parsear texto.
+    Los enteros quedan como Int64, las fechas como datetime64 y los diccionarios de las
+    columnas categóricas pasan directo a category; el resto se decodifica a texto.
+    """
+    if formato == 'parquet':
+        tabla = pq.read_table(archivo)
+    else:
+        tabla = pa.ipc.open_file(archivo).read_all()
+
+    columnas = []
+    for campo, columna in zip(tabla.schema, tabla.columns):
+        if pa.types.is_dictionary(campo.type) and not es_categorica(campo.name):
+            columna = pc.cast(columna, campo.type.value_type)
+        columnas.append(columna)
+    tabla = pa.Table.from_arrays(columnas, names=tabla.column_names)
+
+    df = tabla.to_pandas(
+        date_as_object=False,
+        types_mapper={pa.int64(): pd.Int64Dtype()}.get
+    )
+    return compactar_tipos(df)
+
+
+def _formatos_fecha_csv(df):
+    """
+    Formato de texto de cada columna datetime, decidido sobre la columna completa
+    (igual que to_csv sobre todo el DataFrame) para que no cambie entre bloques.
+    """
+    formatos = {}
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            valores = serie.dropna()
+            solo_fecha = (valores == valores.dt.normalize()).all()
+            formatos[col] = '%Y-%m-%d' if solo_fecha else '%Y-%m-%d %H:%M:%S'
+    return formatos
+
+
+def stream_csv(df, filas_por_bloque=CSV_BLOQUE_FILAS, comprimir=False):
+    """
+    Generador que produce el CSV en bloques de bytes UTF-8 (BOM primero, luego la
+    cabecera y bloques de 'filas_por_bloque' filas), sin armar el archivo en memoria.
+    Con comprimir=True la salida va en gzip (para Content-Encoding: gzip).
+    """
+    bloques = _bloques_csv(df, filas_por_bloque)
+    return _comprimir_gzip(bloques) if comprimir else bloques
+
+
+def _bloques_csv(df, filas_por_bloque):
+    formatos_fecha = _formatos_fecha_csv(df)
+    yield '\ufeff'.encode('utf-8')
+    yield df.iloc[:0].to_csv(index=False).encode('utf-8')
+    for inicio in range(0, len(df), filas_por_bloque):
+        bloque = df.iloc[inicio:inicio + filas_por_bloque]
+        if formatos_fecha:
+            bloque = bloque.assign(**{
+                col: bloque[col].dt.strftime(fmt) for col, fmt in formatos_fecha.items()
+            })
+        yield bloque.to_csv(index=False, header=False).encode('utf-8')
+
+
+def _comprimir_gzip(bloques):
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    for bloque in bloques:
+        comprimido = compresor.compress(bloque)
+        if comprimido:
+            yield comprimido
+    yield compresor.flush()
+
+
+def stream_archivo(ruta, chunk_size=STREAM_CHUNK_BYTES):
+    """
+    Generador que envía un archivo en bloques. No lo elimina: quien arma la respuesta
+    registra eliminar_temporal con Response.call_on_close, que se ejecuta también si la
+    descarga nunca empieza.
+    """
+    with open(ruta, 'rb') as f:
+        while True:
+            bloque = f.read(chunk_size)
+            if not bloque:
+                break
+            yield bloque
+
+
+def eliminar_temporal(ruta):
+    """Elimina un archivo temporal de exportación si todavía existe."""
+    if ruta and os.path.exists(ruta):
+        os.remove(ruta)
@@ -0,0 +1,137 @@
+# fechas.py
+# Parseo de columnas de fecha: el formato se infiere una vez por columna a partir de una
+# muestra y la columna se convierte con un solo to_datetime(format=...); solo los valores
+# que no encajan en ese formato pasan por la cascada de formatos de parse_fecha.
+# La columna parseada queda en '<columna>_dt' y las etapas siguientes la reutilizan.
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Formatos admitidos, en orden de prioridad
+FORMATOS_FECHA = [
+    '%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y', '%m-%d-%Y',
+    '%Y/%m/%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%y', '%m/%d/%y', '%Y%m%d'
+]
+
+# Formato con el que se muestran las fechas en la interfaz
+FORMATO_VISTA = '%d/%m/%Y'
+
+# Valores de texto que se consideran fecha vacía
+VALORES_NULOS = ['', 'None', 'nan', 'NaT']
+
+# Valores distintos que se usan para inferir el formato de una columna
+MUESTRA_INFERENCIA = 1000
+
+SUFIJO_PARSEADA = '_dt'
+
+
+def parse_fecha(fecha_str):
+    """
+    Convierte string de fecha a datetime, manejando múltiples formatos.
+
+    Args:
+        fecha_str: String de fecha en varios formatos posibles
+
+    Returns:
+        datetime o pd.NaT si no se puede parsear
+    """
+    if pd.isna(fecha_str) or fecha_str == '' or fecha_str == 'None' or fecha_str == 'nan' or fecha_str == 'NaT':
+        return pd.NaT
+
+    # Si ya es datetime, retornar directamente
+    if isinstance(fecha_str, (datetime, pd.Timestamp)):
+        return fecha_str
+
+    # Convertir a string y limpiar
+    fecha_str = str(fecha_str).strip()
+
+    # Si está vacío después de limpiar, retornar NaT
+    if not fecha_str:
+        return pd.NaT
+
+    for formato in FORMATOS_FECHA:
+        try:
+            return datetime.strptime(fecha_str, formato)
+        except ValueError:
+            continue
+
+    # Si ninguno funciona, retornar NaT
+    return pd.NaT
+
+
+def inferir_formato(textos, muestra=MUESTRA_INFERENCIA):
+    """
+    Formato de FORMATOS_FECHA que parsea más valores de una muestra de textos distintos
+    (a igualdad, el de mayor prioridad). Devuelve None si ninguno parsea nada.
+    """
+    unicos = pd.Series(textos).dropna()
+    if unicos.empty:
+        return None
+    if len(unicos) > muestra:
+        unicos = unicos.sample(muestra, random_state=0)
+    mejor, aciertos_mejor = None, 0
+    for formato in FORMATOS_FECHA:
+        aciertos = pd.to_datetime(unicos, format=formato, errors='coerce').notna().sum()
+        if aciertos > aciertos_mejor:
+            mejor, aciertos_mejor = formato, aciertos
+            if aciertos == len(unicos):
+                break
+    return mejor
+
+
+def parsear_fechas(serie):
+    """
+    Convierte una columna a datetime64: to_datetime vectorizado con el formato inferido
+    para la columna y parse_fecha solo para los valores que no encajan. Como una columna
+    de fechas repite mucho sus valores, todo el trabajo de texto se hace sobre los
+    valores distintos.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie
+    tipo = pd.api.types.infer_dtype(serie, skipna=True)
+    if tipo in ('datetime', 'datetime64', 'date'):
+        return pd.to_datetime(serie, errors='coerce')
+
+    codigos, unicos = pd.factorize(serie.astype(object))
+    textos = pd.Series(unicos, dtype=object).map(lambda v: v if isinstance(v, str) else str(v)).str.strip()
+    textos = textos.where(~textos.isin(VALORES_NULOS), None)
+
+    formato = inferir_formato(textos)
+    if formato is None:
+        fechas = pd.Series(pd.NaT, index=textos.index, dtype='datetime64[ns]')
+    else:
+        fechas = pd.to_datetime(textos, format=formato, errors='coerce')
+
+    # Residuo: valores no vacíos que el formato de la columna no pudo convertir
+    residuo = fechas.isna() & textos.notna()
+    if residuo.any():
+        fechas[residuo] = pd.to_datetime(
+            pd.Series([parse_fecha(v) for v in textos[residuo]], index=textos[residuo].index, dtype=object),
+            errors='coerce'
+        )
+
+    # Los nulos tienen código -1: apuntan al NaT agregado al final
+    valores = np.append(fechas.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT', 'ns'))
+    return pd.Series(valores[codigos], index=serie.index, name=serie.name)
+
+
+def columna_fecha(df, col):
+    """
+    Devuelve la columna 'col' parseada a datetime64, reutilizando '<col>_dt' si ya fue
+    parseada en una etapa anterior; si no, la parsea y la deja guardada en el DataFrame.
+    """
+    col_dt = col + SUFIJO_PARSEADA
+    if col_dt in df.columns and pd.api.types.is_datetime64_any_dtype(df[col_dt]):
+        return df[col_dt]
+    df[col_dt] = parsear_fechas(df[col])
+    return df[col_dt]
+
+
+def formatear_vista(serie_dt, formato=FORMATO_VISTA):
+    """Texto de una columna datetime64 para la interfaz ('' en las fechas vacías)."""
+    codigos, unicos = pd.factorize(serie_dt)
+    textos = np.append(unicos.strftime(formato).to_numpy(dtype=object), '')
+    return pd.Series(textos[codigos], index=serie_dt.index, name=serie_dt.name, dtype=object)
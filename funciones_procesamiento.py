@@ -1,7 +1,9 @@
 import pandas as pd
-from datetime import datetime
 import numpy as np
 
+from edades import a_dias, edad_exacta, formato_edad
+from fechas import parse_fecha, columna_fecha, formatear_vista
+
 # Columnas base para mostrar en la validación de errores
 COLUMNAS_BASE = [
     "Id_Cita", "Anio", "Mes", "Fecha_Atencion", "Lote", "Num_Pag", "Num_Reg", "Id_Ups",
@@ -14,46 +16,6 @@ COLUMNAS_BASE = [
     "Valor_Lab", "Codigo_Item", "id_ups", "Hemoglobina", "Observaciones", "Error"
 ]
 
-def parse_fecha(fecha_str):
-    """
-    Convierte string de fecha a datetime, manejando múltiples formatos.
-    
-    Args:
-        fecha_str: String de fecha en varios formatos posibles
-    
-    Returns:
-        datetime o pd.NaT si no se puede parsear
-    """
-    if pd.isna(fecha_str) or fecha_str == '' or fecha_str == 'None' or fecha_str == 'nan' or fecha_str == 'NaT':
-        return pd.NaT
-    
-    # Si ya es datetime, retornar directamente
-    if isinstance(fecha_str, (datetime, pd.Timestamp)):
-        return fecha_str
-    
-    # Convertir a string y limpiar
-    fecha_str = str(fecha_str).strip()
-    
-    # Si está vacío después de limpiar, retornar NaT
-    if not fecha_str:
-        return pd.NaT
-    
-    # Intentar diferentes formatos de fecha
-    formatos = [
-        '%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y', '%m-%d-%Y',
-        '%Y/%m/%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S',
-        '%d/%m/%y', '%m/%d/%y', '%Y%m%d'
-    ]
-    
-    for formato in formatos:
-        try:
-            return datetime.strptime(fecha_str, formato)
-        except ValueError:
-            continue
-    
-    # Si ninguno funciona, retornar NaT
-    return pd.NaT
-
 def calcular_edad_formato(fecha_nac, fecha_atencion):
     """
     Calcula la edad en formato Años-Meses-Días.
@@ -65,38 +27,12 @@ def calcular_edad_formato(fecha_nac, fecha_atencion):
     Returns:
         str: Edad formateada (ej: "25A-6M-15D") o string vacío si no se puede calcular
     """
-    try:
-        # Parsear fechas si son strings
-        if isinstance(fecha_nac, str):
-            fecha_nac_dt = parse_fecha(fecha_nac)
-        else:
-            fecha_nac_dt = fecha_nac
-            
-        if isinstance(fecha_atencion, str):
-            fecha_atencion_dt = parse_fecha(fecha_atencion)
-        else:
-            fecha_atencion_dt = fecha_atencion
-        
-        # Verificar si alguna fecha es NaT o None
-        if pd.isna(fecha_nac_dt) or pd.isna(fecha_atencion_dt):
-            return ""
-        
-        # Calcular diferencia
-        if fecha_atencion_dt < fecha_nac_dt:
-            return ""  # Fecha de atención anterior a fecha de nacimiento
-        
-        delta = fecha_atencion_dt - fecha_nac_dt
-        total_dias = delta.days
-        
-        años = total_dias // 365
-        meses = (total_dias % 365) // 30
-        dias = (total_dias % 365) % 30
-        
-        return f"{años}A-{meses}M-{dias}D"
-    
-    except Exception as e:
-        print(f"Error calculando edad: {e}")
-        return ""
+    if isinstance(fecha_nac, str):
+        fecha_nac = parse_fecha(fecha_nac)
+    if isinstance(fecha_atencion, str):
+        fecha_atencion = parse_fecha(fecha_atencion)
+    edad = edad_exacta(a_dias(fecha_nac), a_dias(fecha_atencion))
+    return formato_edad(edad)[0]
 
 def formatear_fechas(df):
     """
@@ -120,13 +56,11 @@ def formatear_fechas(df):
                 # Si toda la columna es NaN, crear una columna vacía formateada
                 df[col] = ''
             else:
-                # Convertir a datetime usando parse_fecha
-                df[col + '_dt'] = df[col].apply(parse_fecha)
+                # Columna datetime (parseada una sola vez y guardada en col + '_dt')
+                fechas = columna_fecha(df, col)
                 
                 # Formatear para visualización, manejando NaT
-                df[col] = df[col + '_dt'].apply(
-                    lambda x: x.strftime('%d/%m/%Y') if not pd.isna(x) else ''
-                )
+                df[col] = formatear_vista(fechas)
     
     return df
 
@@ -153,26 +87,17 @@ def procesar_dataframe(df):
         df.get("Nombres_Personal", pd.Series(index=df.index, dtype=str)).fillna('')
     ).str.strip()
     
-    # Asegurar que tenemos las columnas de fecha como datetime para el cálculo
-    # Primero procesar las fechas si no se han procesado
-    if 'Fecha_Nacimiento_Paciente_dt' not in df.columns and 'Fecha_Nacimiento_Paciente' in df.columns:
-        df['Fecha_Nacimiento_Paciente_dt'] = df['Fecha_Nacimiento_Paciente'].apply(parse_fecha)
-    
-    if 'Fecha_Atencion_dt' not in df.columns and 'Fecha_Atencion' in df.columns:
-        df['Fecha_Atencion_dt'] = df['Fecha_Atencion'].apply(parse_fecha)
-    
-    # Calcular edad usando las columnas datetime
-    df["Edad_Reg"] = df.apply(
-        lambda row: calcular_edad_formato(
-            row.get("Fecha_Nacimiento_Paciente_dt", pd.NaT), 
-            row.get("Fecha_Atencion_dt", pd.NaT)
-        ), axis=1
-    )
-    
-    # Limpiar columnas temporales si existen
-    columnas_a_eliminar = [col for col in df.columns if col.endswith('_dt')]
-    if columnas_a_eliminar:
-        df = df.drop(columns=columnas_a_eliminar)
+    # Calcular edad exacta (vectorizada) usando las columnas datetime. Las columnas
+    # '_dt' parseadas se conservan para que formatear_fechas y los validadores no
+    # vuelvan a parsearlas.
+    if 'Fecha_Nacimiento_Paciente' in df.columns and 'Fecha_Atencion' in df.columns:
+        edad = edad_exacta(
+            a_dias(columna_fecha(df, 'Fecha_Nacimiento_Paciente')),
+            a_dias(columna_fecha(df, 'Fecha_Atencion'))
+        )
+        df["Edad_Reg"] = formato_edad(edad)
+    else:
+        df["Edad_Reg"] = ""
     
     return df
 
@@ -0,0 +1,256 @@
+# historial_dx.py
+# Historial persistente (DuckDB) del primer diagnóstico 'D' de cada mes por establecimiento,
+# paciente y familia de diagnóstico crónico. Cada validación de secuencia solo consulta el
+# historial (de todos los establecimientos) para detectar un 'D' repetido respecto de otros
+# meses validados antes (sin volver a subirlos). Cuando el usuario confirma el archivo
+# validado, registrar_en_historial reemplaza los meses que trae, solo de su establecimiento,
+# con sus propios 'D': confirmar un mes corregido corrige el historial sin tocar lo que
+# validaron otros establecimientos. eliminar_historial borra entradas por paciente, mes o
+# establecimiento.
+
+import os
+import time
+import logging
+import threading
+
+import duckdb
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Archivo DuckDB del historial ('' desactiva el historial)
+DX_HISTORY_DB = os.environ.get('DX_HISTORY_DB', 'historial_dx.duckdb')
+
+# Segundos que se espera a que otro proceso (otro worker de gunicorn) libere el archivo
+DX_HISTORY_LOCK_TIMEOUT = float(os.environ.get('DX_HISTORY_LOCK_TIMEOUT', '30'))
+
+# Documentos que no identifican a un paciente: no se guardan ni se consultan
+DOCUMENTOS_VACIOS = ['', 'nan', 'None']
+
+# Establecimiento de los archivos sin columna de establecimiento y de las entradas
+# migradas de versiones anteriores del historial
+SIN_ESTABLECIMIENTO = ''
+
+_lock = threading.Lock()
+
+
+class HistorialNoDisponible(Exception):
+    """El archivo del historial siguió bloqueado por otro proceso más de DX_HISTORY_LOCK_TIMEOUT."""
+
+
+_SQL_TABLA = """
+    CREATE TABLE IF NOT EXISTS historial_dx (
+        establecimiento VARCHAR,
+        paciente VARCHAR,
+        familia VARCHAR,
+        mes VARCHAR,
+        fecha DATE,
+        id_cita VARCHAR,
+        PRIMARY KEY (establecimiento, paciente, familia, mes)
+    )
+"""
+
+# Historiales anteriores (sin establecimiento y, los primeros, sin mes): sus entradas
+# quedan SIN_ESTABLECIMIENTO
+_SQL_MIGRAR = [
+    """
+    CREATE TABLE historial_dx_establecimiento (
+        establecimiento VARCHAR, paciente VARCHAR, familia VARCHAR, mes VARCHAR, fecha DATE,
+        id_cita VARCHAR,
+        PRIMARY KEY (establecimiento, paciente, familia, mes)
+    )
+    """,
+    "INSERT INTO historial_dx_establecimiento SELECT ?, paciente, familia, {mes}, fecha, id_cita FROM historial_dx",
+    "DROP TABLE historial_dx",
+    "ALTER TABLE historial_dx_establecimiento RENAME TO historial_dx",
+]
+
+# Meses del archivo en el historial: los de su establecimiento y los SIN_ESTABLECIMIENTO
+# (de origen desconocido, los reemplaza el primer archivo que se confirma con ese mes)
+_SQL_PERIODO_ARCHIVO = """
+    EXISTS (
+        SELECT 1 FROM periodos p
+        WHERE p.mes = h.mes AND (p.establecimiento = h.establecimiento OR h.establecimiento = ?)
+    )
+"""
+
+# 'D' del archivo cuyo paciente tiene en el historial, fuera de los meses del archivo (de
+# cualquier establecimiento), un 'D' de la misma familia en otra cita y en una fecha
+# anterior o igual
+_SQL_POSTERIORES = f"""
+    SELECT DISTINCT r.fila
+    FROM registros r
+    JOIN historial_dx h ON h.paciente = r.paciente AND h.familia = r.familia
+    WHERE NOT {_SQL_PERIODO_ARCHIVO}
+      AND h.id_cita <> r.id_cita
+      AND (r.fecha IS NULL OR h.fecha <= r.fecha)
+"""
+
+# Los meses del archivo quedan con sus propios primeros 'D': se borran las entradas que
+# el archivo ya no trae y el resto se sobrescribe (DuckDB no admite borrar e insertar la
+# misma clave primaria en una transacción)
+_SQL_BORRAR_REEMPLAZADOS = f"""
+    DELETE FROM historial_dx h
+    WHERE {_SQL_PERIODO_ARCHIVO}
+      AND NOT EXISTS (
+          SELECT 1 FROM primeros p
+          WHERE p.establecimiento = h.establecimiento AND p.paciente = h.paciente
+            AND p.familia = h.familia AND p.mes = h.mes
+      )
+"""
+_SQL_GUARDAR_PRIMEROS = """
+    INSERT INTO historial_dx SELECT establecimiento, paciente, familia, mes, fecha, id_cita FROM primeros
+    ON CONFLICT (establecimiento, paciente, familia, mes) DO UPDATE
+        SET fecha = excluded.fecha, id_cita = excluded.id_cita
+"""
+
+
+def _conectar():
+    """
+    Abre el historial esperando (hasta DX_HISTORY_LOCK_TIMEOUT) a que otro proceso lo
+    libere: DuckDB solo permite un proceso con el archivo abierto para escribir.
+    """
+    limite = time.monotonic() + DX_HISTORY_LOCK_TIMEOUT
+    espera = 0.05
+    while True:
+        try:
+            conn = duckdb.connect(DX_HISTORY_DB)
+            break
+        except duckdb.IOException as e:
+            if time.monotonic() >= limite:
+                logger.warning(f"No se pudo abrir el historial de diagnósticos {DX_HISTORY_DB}: {e}")
+                raise HistorialNoDisponible(
+                    "El historial de diagnósticos está ocupado por otra validación. "
+                    "Vuelva a intentarlo en unos segundos."
+                ) from e
+            time.sleep(espera)
+            espera = min(espera * 2, 1.0)
+    conn.execute(_SQL_TABLA)
+    columnas = {fila[0] for fila in conn.execute("DESCRIBE historial_dx").fetchall()}
+    if 'establecimiento' not in columnas:
+        mes = "mes" if 'mes' in columnas else "strftime(fecha, '%Y-%m')"
+        conn.execute("BEGIN TRANSACTION")
+        for sql in _SQL_MIGRAR:
+            conn.execute(sql.format(mes=mes), [SIN_ESTABLECIMIENTO] if '?' in sql else None)
+        conn.execute("COMMIT")
+    return conn
+
+
+def _tabla_registros(registros):
+    """'D' con documento de paciente, su posición en registros ('fila') y su mes."""
+    registros = registros[["establecimiento", "paciente", "familia", "fecha", "id_cita"]].reset_index(drop=True)
+    registros = registros[~registros["paciente"].isin(DOCUMENTOS_VACIOS)]
+    registros.insert(0, "fila", registros.index)
+    registros.insert(4, "mes", registros["fecha"].dt.strftime('%Y-%m'))
+    return registros
+
+
+def posteriores_al_historial(registros, periodos):
+    """
+    Compara los 'D' de un archivo con el historial, sin modificarlo.
+
+    Args:
+        registros: DataFrame con establecimiento, paciente, familia, fecha (datetime64) e
+            id_cita de cada 'D', ordenado por familia, paciente y fecha
+        periodos: DataFrame con los pares (establecimiento, mes 'YYYY-MM') de Fecha_Atencion
+            que trae el archivo; sus entradas en el historial no se comparan (el archivo
+            las reemplaza al confirmarse)
+
+    Returns:
+        np.ndarray bool: True en los registros posteriores a un 'D' de otro mes del
+        historial
+
+    Raises:
+        HistorialNoDisponible: si el archivo siguió bloqueado por otro proceso
+    """
+    posteriores = np.zeros(len(registros), dtype=bool)
+    # Sin archivo todavía no hay nada validado (la consulta no lo crea)
+    if not DX_HISTORY_DB or not os.path.exists(DX_HISTORY_DB):
+        return posteriores
+
+    registros = _tabla_registros(registros)
+    periodos = periodos[["establecimiento", "mes"]].astype(object)
+
+    with _lock:
+        conn = _conectar()
+        try:
+            conn.register('registros', registros)
+            conn.register('periodos', periodos)
+            filas = conn.execute(_SQL_POSTERIORES, [SIN_ESTABLECIMIENTO]).fetchnumpy()["fila"]
+        finally:
+            conn.close()
+
+    posteriores[np.asarray(filas, dtype=np.int64)] = True
+    return posteriores
+
+
+def registrar_en_historial(registros, periodos):
+    """
+    Reemplaza en el historial los meses del archivo (de su establecimiento) con sus
+    primeros 'D'. Confirmar otra vez el mismo archivo no cambia el historial.
+
+    Args:
+        registros, periodos: como en posteriores_al_historial
+
+    Returns:
+        int: número de entradas guardadas
+
+    Raises:
+        HistorialNoDisponible: si el archivo siguió bloqueado por otro proceso
+    """
+    if not DX_HISTORY_DB:
+        return 0
+
+    registros = _tabla_registros(registros)
+    primeros = registros[registros["fecha"].notna()].drop_duplicates(["establecimiento", "familia", "paciente", "mes"])
+    periodos = periodos[["establecimiento", "mes"]].astype(object)
+
+    with _lock:
+        conn = _conectar()
+        try:
+            conn.register('primeros', primeros)
+            conn.register('periodos', periodos)
+            conn.execute("BEGIN TRANSACTION")
+            conn.execute(_SQL_BORRAR_REEMPLAZADOS, [SIN_ESTABLECIMIENTO])
+            conn.execute(_SQL_GUARDAR_PRIMEROS)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    logger.info(
+        f"Historial de diagnósticos: {len(primeros)} entradas guardadas para "
+        f"{len(periodos)} meses por establecimiento"
+    )
+    return len(primeros)
+
+
+def eliminar_historial(paciente=None, mes=None, establecimiento=None):
+    """
+    Elimina las entradas del historial de un paciente, de un mes ('YYYY-MM'), de un
+    establecimiento o de su combinación.
+
+    Returns:
+        int: número de entradas eliminadas
+    """
+    if not paciente and not mes and not establecimiento:
+        raise ValueError("Indique el paciente, el mes, el establecimiento o una combinación")
+    if not DX_HISTORY_DB:
+        return 0
+    condiciones, parametros = [], []
+    for columna, valor in (("paciente", paciente), ("mes", mes), ("establecimiento", establecimiento)):
+        if valor:
+            condiciones.append(f"{columna} = ?")
+            parametros.append(str(valor).strip())
+
+    with _lock:
+        conn = _conectar()
+        try:
+            eliminadas = conn.execute(
+                f"DELETE FROM historial_dx WHERE {' AND '.join(condiciones)}", parametros
+            ).fetchone()[0]
+        finally:
+            conn.close()
+    logger.info(
+        f"Historial de diagnósticos: {eliminadas} entradas eliminadas "
+        f"(paciente={paciente}, mes={mes}, establecimiento={establecimiento})"
+    )
+    return eliminadas
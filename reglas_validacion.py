@@ -0,0 +1,178 @@
+# reglas_validacion.py
+# Reglas de validación declarativas: las reglas simples de los validadores (códigos de
+# ítem + condiciones sobre otras columnas + mensaje) se leen de data/reglas_validacion.json
+# y se compilan en una tabla indexada por Codigo_Item, de modo que cada regla solo evalúa
+# las filas de sus códigos. El archivo se vuelve a leer cuando cambia, sin reiniciar.
+# Las reglas que necesitan agrupar (por cita, por paciente) siguen en validadores_errores.
+
+import os
+import json
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+VALIDATION_RULES_FILE = os.environ.get(
+    'VALIDATION_RULES_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'reglas_validacion.json')
+)
+
+OPERADORES = ('en', 'no_en', 'vacio', 'nulo', 'mayor_que')
+
+# Tipo del valor que acepta cada operador (se comprueba al compilar, no al validar)
+_TIPOS_VALOR = {'en': list, 'no_en': list, 'vacio': bool, 'nulo': bool, 'mayor_que': (int, float)}
+
+
+def _evaluar_condicion(serie, operador, valor):
+    """Máscara booleana (numpy) de una condición sobre una columna; NA cuenta como False."""
+    if operador == 'en':
+        mascara = serie.isin(valor)
+    elif operador == 'no_en':
+        mascara = ~serie.isin(valor)
+    elif operador == 'nulo':
+        mascara = serie.isna() if valor else serie.notna()
+    elif operador == 'vacio':
+        mascara = serie.isna() | (serie == "")
+        if not valor:
+            mascara = ~mascara
+    else:  # mayor_que
+        mascara = serie > valor
+    if isinstance(mascara, pd.Series):
+        return mascara.to_numpy(dtype=bool, na_value=False)
+    return np.asarray(mascara, dtype=bool)
+
+
+class Regla:
+    def __init__(self, orden, especificacion):
+        self.orden = orden
+        self.codigos = [str(c) for c in especificacion.get('codigos', [])]
+        self.mensaje = especificacion['mensaje']
+        self.condiciones = []
+        for columna, operadores in especificacion.get('condiciones', {}).items():
+            for operador, valor in operadores.items():
+                if operador not in OPERADORES:
+                    raise ValueError(f"Operador '{operador}' no válido en la regla '{self.mensaje}'")
+                if not isinstance(valor, _TIPOS_VALOR[operador]) or (operador == 'mayor_que' and isinstance(valor, bool)):
+                    raise ValueError(f"Valor {valor!r} no válido para '{operador}' en la regla '{self.mensaje}'")
+                self.condiciones.append((columna, operador, valor))
+        self.columnas = {columna for columna, _, _ in self.condiciones}
+
+    def evaluar(self, datos, filas=None):
+        """Máscara de la regla sobre las posiciones 'filas' de datos (todas si es None)."""
+        mascara = np.ones(len(datos) if filas is None else len(filas), dtype=bool)
+        for columna, operador, valor in self.condiciones:
+            serie = datos[columna] if filas is None else datos[columna].iloc[filas]
+            mascara &= _evaluar_condicion(serie, operador, valor)
+        return mascara
+
+
+class ReglasFiltro:
+    """Reglas compiladas de un filtro: Codigo_Item -> reglas, más las reglas sin código."""
+    def __init__(self, especificaciones):
+        self.reglas = [Regla(orden, espec) for orden, espec in enumerate(especificaciones)]
+        self.por_codigo = {}
+        self.globales = []
+        for regla in self.reglas:
+            if not regla.codigos:
+                self.globales.append(regla)
+            for codigo in regla.codigos:
+                self.por_codigo.setdefault(codigo, []).append(regla)
+
+
+def compilar_reglas(especificacion):
+    """Compila el JSON de reglas en {filtro: ReglasFiltro} (las claves '_...' son comentarios)."""
+    return {
+        filtro: ReglasFiltro(reglas)
+        for filtro, reglas in especificacion.items()
+        if not filtro.startswith('_')
+    }
+
+
+class CatalogoReglas:
+    """
+    Reglas compiladas del archivo VALIDATION_RULES_FILE. Se recompilan cuando cambia la
+    fecha de modificación del archivo; si la nueva versión tiene errores se mantiene la
+    anterior.
+    """
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._filtros = None
+
+    def filtros(self):
+        mtime = os.stat(self.ruta).st_mtime_ns
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    with open(self.ruta, encoding='utf-8') as f:
+                        self._filtros = compilar_reglas(json.load(f))
+                    logger.info(f"Reglas de validación cargadas desde {self.ruta}")
+                except Exception as e:
+                    # Cualquier error de forma (tipos incluidos) deja las reglas anteriores;
+                    # sin reglas previas no hay con qué validar y el error se propaga
+                    if self._filtros is None:
+                        logger.error(f"Reglas de validación inválidas en {self.ruta}: {e}")
+                        raise
+                    logger.error(f"Reglas de validación inválidas en {self.ruta}, se mantienen las anteriores: {e}")
+                self._mtime = mtime
+            return self._filtros
+
+
+catalogo_reglas = CatalogoReglas(VALIDATION_RULES_FILE)
+
+
+class GruposCodigo:
+    """Posiciones (ascendentes) de las filas de cada Codigo_Item."""
+    def __init__(self, serie):
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            codigos, valores = serie.cat.codes.to_numpy(), serie.cat.categories
+        else:
+            codigos, valores = pd.factorize(serie)
+        self._indice = {valor: i for i, valor in enumerate(valores)}
+        validos = np.flatnonzero(codigos >= 0)
+        self._orden = validos[np.argsort(codigos[validos], kind='stable')]
+        self._limites = np.concatenate(([0], np.cumsum(np.bincount(codigos[validos], minlength=len(valores)))))
+
+    def filas(self, codigo):
+        i = self._indice.get(codigo)
+        if i is None:
+            return self._orden[:0]
+        return self._orden[self._limites[i]:self._limites[i + 1]]
+
+
+def aplicar_reglas(filtro, contexto, marcas):
+    """
+    Evalúa las reglas declarativas de 'filtro' sobre el contexto de validación y marca
+    las filas que las cumplen. Cada regla con códigos solo lee las filas de esos códigos;
+    como las marcas se acumulan por bit, el orden de evaluación no importa.
+    """
+    reglas = catalogo_reglas.filtros().get(filtro)
+    if reglas is None:
+        return
+    datos = contexto.datos
+    columnas = set(datos.columns)
+    grupos = contexto.grupos_codigo()
+
+    for regla in reglas.reglas:
+        faltantes = regla.columnas - set(datos.columns)
+        if faltantes:
+            print(f"Regla '{regla.mensaje}' omitida, faltan columnas: {sorted(faltantes)}")
+            continue
+        # Catálogo en el orden del archivo: el texto de una fila con varios errores no
+        # depende de qué códigos trae el archivo
+        marcas.registrar(regla.mensaje)
+        if not regla.codigos:
+            marcas.marcar(regla.evaluar(datos), regla.mensaje)
+
+    # Solo los códigos presentes en los datos: el resto de reglas no cuesta nada
+    for codigo, reglas_codigo in reglas.por_codigo.items():
+        filas = grupos.filas(codigo)
+        if not len(filas):
+            continue
+        for regla in reglas_codigo:
+            if regla.columnas <= columnas:
+                marcas.marcar(filas[regla.evaluar(datos, filas)], regla.mensaje)
@@ -0,0 +1,247 @@
+# tareas.py
+# Trabajos en segundo plano (consolidación asíncrona) con backend intercambiable:
+# - Ejecutor: 'local' (ThreadPoolExecutor dentro del worker web) o 'celery' (workers aparte)
+# - Estado:   archivos JSON en JOBS_FOLDER (por defecto con el ejecutor local, compartidos por
+#             todos los workers de gunicorn) o redis (REDIS_URL con JOBS_BACKEND=celery).
+#             REDIS_URL=fakeredis://... es solo para pruebas: cada proceso tendría su propio
+#             redis en memoria, así que se rechaza cuando la app corre en gunicorn.
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    from celery import Celery
+except ImportError:
+    Celery = None
+
+logger = logging.getLogger(__name__)
+
+JOBS_FOLDER = os.environ.get('JOBS_FOLDER', 'jobs')
+JOBS_BACKEND = os.environ.get('JOBS_BACKEND', 'local')
+JOBS_MAX_WORKERS = int(os.environ.get('JOBS_MAX_WORKERS', '2'))
+JOBS_TTL_SECONDS = int(os.environ.get('JOBS_TTL_SECONDS', str(24 * 3600)))
+REDIS_URL = os.environ.get('REDIS_URL')
+
+ESTADO_PENDIENTE = 'pendiente'
+ESTADO_EN_PROCESO = 'en_proceso'
+ESTADO_COMPLETADO = 'completado'
+ESTADO_ERROR = 'error'
+
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+
+
+# --- ALMACENES DE ESTADO ---
+class AlmacenTrabajosArchivo:
+    """
+    Estado de cada trabajo en JOBS_FOLDER/<job_id>/estado.json. Al estar en disco lo
+    pueden leer todos los workers de gunicorn del mismo host.
+    """
+    def _ruta(self, job_id):
+        return os.path.join(JOBS_FOLDER, job_id, 'estado.json')
+
+    def guardar(self, job_id, estado):
+        ruta = self._ruta(job_id)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(estado, f, ensure_ascii=False)
+        os.replace(temporal, ruta)
+
+    def obtener(self, job_id):
+        try:
+            with open(self._ruta(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def eliminar(self, job_id):
+        pass  # El estado se borra junto con la carpeta del trabajo
+
+
+class AlmacenTrabajosRedis:
+    """Estado de cada trabajo como JSON en redis, con expiración JOBS_TTL_SECONDS."""
+    def __init__(self, cliente):
+        self.cliente = cliente
+
+    def guardar(self, job_id, estado):
+        self.cliente.set(f"dbcheck:job:{job_id}", json.dumps(estado, ensure_ascii=False), ex=JOBS_TTL_SECONDS)
+
+    def obtener(self, job_id):
+        valor = self.cliente.get(f"dbcheck:job:{job_id}")
+        return json.loads(valor) if valor else None
+
+    def eliminar(self, job_id):
+        self.cliente.delete(f"dbcheck:job:{job_id}")
+
+
+def _crear_almacen():
+    if REDIS_URL and REDIS_URL.startswith('fakeredis://'):
+        # Un estado por proceso: con varios workers el sondeo de otro worker daría 404
+        if 'gunicorn' in sys.modules:
+            raise RuntimeError("REDIS_URL=fakeredis:// es solo para pruebas; en gunicorn use redis:// o el almacén de archivos")
+        import fakeredis
+        return AlmacenTrabajosRedis(fakeredis.FakeRedis())
+    if REDIS_URL and redis is not None and JOBS_BACKEND == 'celery':
+        return AlmacenTrabajosRedis(redis.Redis.from_url(REDIS_URL))
+    return AlmacenTrabajosArchivo()
+
+
+almacen = _crear_almacen()
+
+# Funciones de trabajo registradas por nombre (ver registrar_tarea)
+_tareas = {}
+
+# Trabajo en ejecución en el hilo actual (para progreso y mensajes)
+_contexto = threading.local()
+
+
+def registrar_tarea(nombre):
+    """Decorador que registra la función que ejecuta un tipo de trabajo."""
+    def decorador(funcion):
+        _tareas[nombre] = funcion
+        return funcion
+    return decorador
+
+
+def carpeta_trabajo(job_id):
+    return os.path.join(JOBS_FOLDER, job_id)
+
+
+def carpeta_entrada(job_id):
+    return os.path.join(JOBS_FOLDER, job_id, 'entrada')
+
+
+def obtener_trabajo(job_id):
+    # Los IDs son uuid4 hex: evita rutas arbitrarias en JOBS_FOLDER
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+        return None
+    return almacen.obtener(job_id)
+
+
+def _actualizar(job_id, **campos):
+    estado = almacen.obtener(job_id) or {}
+    estado.update(campos)
+    estado['actualizado'] = time.time()
+    almacen.guardar(job_id, estado)
+    return estado
+
+
+def crear_trabajo(nombre, parametros=None):
+    """
+    Crea un trabajo pendiente con su carpeta de entrada y devuelve su ID.
+    Los archivos de entrada deben guardarse en carpeta_entrada(job_id) antes de encolarlo.
+    """
+    purgar_trabajos_vencidos()
+    job_id = uuid.uuid4().hex
+    os.makedirs(carpeta_entrada(job_id), exist_ok=True)
+    ahora = time.time()
+    almacen.guardar(job_id, {
+        'job_id': job_id,
+        'tarea': nombre,
+        'parametros': parametros or {},
+        'estado': ESTADO_PENDIENTE,
+        'etapa': 'en_cola',
+        'progreso': 0,
+        'mensajes': [],
+        'resultado': None,
+        'error': None,
+        'creado': ahora,
+        'actualizado': ahora
+    })
+    return job_id
+
+
+def reportar_progreso(etapa, progreso):
+    """Actualiza etapa y porcentaje del trabajo en curso (sin efecto fuera de un trabajo)."""
+    job_id = getattr(_contexto, 'job_id', None)
+    if job_id:
+        _actualizar(job_id, etapa=etapa, progreso=int(progreso))
+
+
+def registrar_mensaje(mensaje, categoria='info'):
+    """Agrega un mensaje al trabajo en curso (equivalente a flash fuera de un request)."""
+    job_id = getattr(_contexto, 'job_id', None)
+    if job_id:
+        estado = almacen.obtener(job_id) or {}
+        _actualizar(job_id, mensajes=estado.get('mensajes', []) + [{'categoria': categoria, 'mensaje': mensaje}])
+
+
+def ejecutar_trabajo(job_id):
+    """
+    Ejecuta un trabajo registrado. La función de la tarea recibe (job_id, parametros)
+    y devuelve un dict con el resultado (por ejemplo, el artefacto generado).
+    """
+    estado = almacen.obtener(job_id)
+    if estado is None:
+        logger.error(f"Trabajo no encontrado: {job_id}")
+        return
+    _contexto.job_id = job_id
+    try:
+        _actualizar(job_id, estado=ESTADO_EN_PROCESO, etapa='iniciando', progreso=0)
+        resultado = _tareas[estado['tarea']](job_id, estado.get('parametros', {}))
+        _actualizar(job_id, estado=ESTADO_COMPLETADO, etapa='listo', progreso=100, resultado=resultado)
+    except Exception as e:
+        logger.error(f"Error en trabajo {job_id}: {traceback.format_exc()}")
+        _actualizar(job_id, estado=ESTADO_ERROR, error=str(e))
+    finally:
+        _contexto.job_id = None
+        # Los archivos de entrada ya no se necesitan (el artefacto queda en la carpeta del trabajo)
+        shutil.rmtree(carpeta_entrada(job_id), ignore_errors=True)
+
+
+def purgar_trabajos_vencidos():
+    """Elimina las carpetas de trabajos con más de JOBS_TTL_SECONDS de antigüedad."""
+    limite = time.time() - JOBS_TTL_SECONDS
+    for job_id in os.listdir(JOBS_FOLDER):
+        ruta = carpeta_trabajo(job_id)
+        try:
+            if os.path.isdir(ruta) and os.path.getmtime(ruta) < limite:
+                shutil.rmtree(ruta, ignore_errors=True)
+                almacen.eliminar(job_id)
+        except OSError:
+            continue
+
+
+# --- EJECUTORES ---
+class EjecutorLocal:
+    """Ejecuta los trabajos en hilos del propio proceso web."""
+    def __init__(self, max_workers):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='trabajo')
+
+    def encolar(self, job_id):
+        self.pool.submit(ejecutar_trabajo, job_id)
+
+
+class EjecutorCelery:
+    """Encola los trabajos en celery (broker REDIS_URL); los ejecuta el servicio worker."""
+    def __init__(self, celery_app):
+        self.tarea = celery_app.task(name='tareas.ejecutar_trabajo')(ejecutar_trabajo)
+
+    def encolar(self, job_id):
+        self.tarea.delay(job_id)
+
+
+celery_app = None
+if JOBS_BACKEND == 'celery':
+    if Celery is None or not REDIS_URL:
+        raise RuntimeError("JOBS_BACKEND=celery requiere el paquete celery y REDIS_URL")
+    celery_app = Celery('dbcheck', broker=REDIS_URL)
+    ejecutor = EjecutorCelery(celery_app)
+else:
+    ejecutor = EjecutorLocal(JOBS_MAX_WORKERS)
+
+
+def encolar_trabajo(job_id):
+    ejecutor.encolar(job_id)
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# Los módulos de la aplicación están en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import historial_dx
+import validadores_errores
+
+
+@pytest.fixture
+def historial(tmp_path, monkeypatch):
+    """Historial de diagnósticos vacío en un archivo temporal."""
+    ruta = str(tmp_path / "historial_dx.duckdb")
+    monkeypatch.setattr(historial_dx, "DX_HISTORY_DB", ruta)
+    monkeypatch.setattr(validadores_errores, "DX_HISTORY_DB", ruta)
+    return ruta
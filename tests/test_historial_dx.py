@@ -0,0 +1,93 @@
+import os
+
+import duckdb
+import pandas as pd
+import pytest
+
+from almacen_datasets import df_a_tabla_arrow
+from validacion_sql import confirmar_historial_tabla, validar_tabla
+from validadores_errores import ContextoValidacion, aplicar_filtro, confirmar_historial
+
+# Los dos backends de validación comparten el historial: (validar, confirmar)
+BACKENDS = {
+    "pandas": (
+        lambda df: aplicar_filtro(df, "Error_secuencia_Dx"),
+        lambda df: confirmar_historial(ContextoValidacion(df)),
+    ),
+    "duckdb": (
+        lambda df: validar_tabla(df_a_tabla_arrow(df), "Error_secuencia_Dx"),
+        lambda df: confirmar_historial_tabla(df_a_tabla_arrow(df)),
+    ),
+}
+
+
+def trama(establecimiento, filas):
+    """Archivo mínimo para Error_secuencia_Dx: (Id_Cita, Codigo_Item, Tipo_Diagnostico, documento, fecha)."""
+    df = pd.DataFrame(filas, columns=[
+        "Id_Cita", "Codigo_Item", "Tipo_Diagnostico", "Numero_Documento_Paciente", "Fecha_Atencion"
+    ])
+    df["Fecha_Atencion"] = pd.to_datetime(df["Fecha_Atencion"])
+    df["Nombre_Establecimiento"] = establecimiento
+    return df
+
+
+def entradas(ruta):
+    conn = duckdb.connect(ruta)
+    try:
+        return conn.execute(
+            "SELECT establecimiento, paciente, mes, id_cita FROM historial_dx ORDER BY ALL"
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request):
+    validar, confirmar = BACKENDS[request.param]
+    return (lambda df: sorted(validar(df)["Id_Cita"])), confirmar
+
+
+def test_validar_no_modifica_el_historial(historial, backend):
+    errores, confirmar = backend
+    marzo = trama("ESTABLECIMIENTO A", [("a1", "D509", "D", "111", "2024-03-05")])
+    abril = trama("ESTABLECIMIENTO A", [("a2", "D509", "D", "111", "2024-04-02")])
+
+    assert errores(marzo) == []
+    assert errores(abril) == []
+    assert not os.path.exists(historial)
+
+    confirmar(marzo)
+    assert errores(abril) == ["a2"]
+    assert errores(abril) == ["a2"]
+    assert entradas(historial) == [("ESTABLECIMIENTO A", "111", "2024-03", "a1")]
+
+
+def test_dos_establecimientos_en_el_mismo_mes(historial, backend):
+    errores, confirmar = backend
+    marzo_a = trama("ESTABLECIMIENTO A", [("a1", "D509", "D", "111", "2024-03-05")])
+    marzo_b = trama("ESTABLECIMIENTO B", [("b1", "I10X", "D", "222", "2024-03-07")])
+
+    confirmar(marzo_a)
+    confirmar(marzo_b)
+    # Validar el mismo mes en B no borra lo que validó A
+    assert entradas(historial) == [
+        ("ESTABLECIMIENTO A", "111", "2024-03", "a1"),
+        ("ESTABLECIMIENTO B", "222", "2024-03", "b1"),
+    ]
+
+    # El historial se consulta entre establecimientos, también en el mismo mes
+    marzo_b_con_111 = trama("ESTABLECIMIENTO B", [
+        ("b1", "I10X", "D", "222", "2024-03-07"),
+        ("b2", "D509", "D", "111", "2024-03-20"),
+    ])
+    assert errores(marzo_b_con_111) == ["b2"]
+    confirmar(marzo_b_con_111)
+
+    # Confirmar el mes corregido en A solo reemplaza las entradas de A
+    marzo_a_corregido = trama("ESTABLECIMIENTO A", [("a1", "D509", "R", "111", "2024-03-05")])
+    assert errores(marzo_a_corregido) == []
+    confirmar(marzo_a_corregido)
+    assert entradas(historial) == [
+        ("ESTABLECIMIENTO B", "111", "2024-03", "b2"),
+        ("ESTABLECIMIENTO B", "222", "2024-03", "b1"),
+    ]
@@ -0,0 +1,75 @@
+# tipos_compactos.py
+# Representación compacta del texto del consolidado: las columnas categóricas de
+# config_tipos se guardan como category (códigos enteros + pocas cadenas) y, con
+# ARROW_STRINGS=1, el resto de columnas de texto como cadenas Arrow.
+
+import os
+
+import pandas as pd
+
+from config_tipos import es_categorica
+
+# Cadenas Arrow para las columnas de texto no categóricas (opcional)
+ARROW_STRINGS = os.environ.get('ARROW_STRINGS', '0') == '1'
+
+# Variante con nulos NaN y máscaras bool de numpy: se comporta como las columnas object
+TIPO_TEXTO_ARROW = pd.StringDtype('pyarrow_numpy')
+
+# Atributo del DataFrame con las columnas compactadas cuyos nulos eran None (al pasar a
+# texto para validar se escriben 'None', como con las columnas object)
+ATTR_NULOS_NONE = 'nulos_none'
+
+
+def compactar_tipos(df):
+    """
+    Convierte las columnas de texto categóricas a category y, si ARROW_STRINGS está
+    activo, las demás columnas de texto a cadenas Arrow. Las columnas que no son texto
+    puro (fechas, números, tipos mezclados) no se tocan.
+    """
+    nulos_none = set(df.attrs.get(ATTR_NULOS_NONE, []))
+    for col in df.columns:
+        serie = df[col]
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            # Categorías ordenadas: ordenar por la columna equivale a ordenar el texto
+            if not serie.cat.categories.is_monotonic_increasing:
+                df[col] = serie.cat.reorder_categories(serie.cat.categories.sort_values())
+            continue
+        if serie.dtype != object or pd.api.types.infer_dtype(serie, skipna=True) not in ('string', 'empty'):
+            continue
+        if es_categorica(col):
+            nueva = serie.astype('category')
+        elif ARROW_STRINGS:
+            nueva = serie.astype(TIPO_TEXTO_ARROW)
+        else:
+            continue
+        nulos = serie[serie.isna()]
+        if len(nulos) and nulos.iloc[0] is None:
+            nulos_none.add(col)
+        df[col] = nueva
+    df.attrs[ATTR_NULOS_NONE] = sorted(c for c in nulos_none if c in df.columns)
+    return df
+
+
+def texto_validacion(serie, nulo_none=False):
+    """
+    Equivalente a serie.astype(str).str.strip() (los nulos pasan a 'nan', o a 'None' si
+    la columna original tenía None). Una columna category se convierte solo sobre sus
+    categorías y sigue siendo category.
+    """
+    texto_nulo = 'None' if nulo_none else 'nan'
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        categorias = serie.cat.categories.astype(str).str.strip()
+        codigos = serie.cat.codes.to_numpy()
+        if (codigos < 0).any():
+            categorias = categorias.append(pd.Index([texto_nulo]))
+            codigos = codigos.copy()
+            codigos[codigos < 0] = len(categorias) - 1
+        # Categorías que quedan iguales tras el strip se unen; se mantienen ordenadas
+        nuevos_codigos, unicas = pd.factorize(categorias, sort=True)
+        return pd.Series(
+            pd.Categorical.from_codes(nuevos_codigos[codigos], categories=unicas),
+            index=serie.index, name=serie.name
+        )
+    if isinstance(serie.dtype, pd.StringDtype):
+        return serie.fillna(texto_nulo).str.strip()
+    return serie.astype(str).str.strip()
@@ -0,0 +1,355 @@
+# validacion_sql.py
+# Backend DuckDB de los validadores (VALIDATION_BACKEND=duckdb): cada filtro se compila a
+# SQL sobre la tabla Arrow del dataset (memory map, sin pasarla a pandas) y DuckDB
+# devuelve solo las filas con error y su regla; únicamente esas filas se convierten a
+# DataFrame. Las columnas se tipan en SQL igual que en el contexto de pandas (texto sin
+# espacios con 'nan'/'None' en los nulos, números con TRY_CAST), las reglas declarativas
+# salen de reglas_validacion.json y los mensajes se registran en el mismo orden, así que
+# el resultado coincide con el de validadores_errores.
+
+import os
+import json
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+
+from config_tipos import INTEGER_COLUMNS, DECIMAL_COLUMNS, STRING_COLUMNS
+from fechas import SUFIJO_PARSEADA, parsear_fechas
+from reglas_validacion import catalogo_reglas
+from almacen_datasets import tabla_arrow_a_df, _META_NULOS_NONE
+from validadores_errores import (
+    ATTR_AVISOS, COLUMNA_ESTABLECIMIENTO, COLUMNAS_VALIDACION, DIAG_SECUENCIA, MarcasError,
+    columna_id_cita, establecimientos_archivo, marcar_secuencia, periodos_archivo,
+    preparar_filas_error, registrar_secuencia
+)
+
+# 'pandas' (por defecto) o 'duckdb'
+VALIDATION_BACKEND = os.environ.get('VALIDATION_BACKEND', 'pandas')
+
+# Caracteres que quita str.strip() en los textos de validación
+_ESPACIOS = " \t\n\r\x0b\x0c\xa0"
+
+_COLUMNA_FILA = '__fila'
+_COLUMNA_FECHA = '__fecha_atencion'
+
+
+def _ident(nombre):
+    return '"' + str(nombre).replace('"', '""') + '"'
+
+def _literal(valor):
+    if isinstance(valor, str):
+        return "'" + valor.replace("'", "''") + "'"
+    return repr(valor)
+
+def _es_numerica(col):
+    return col in INTEGER_COLUMNS or col in DECIMAL_COLUMNS
+
+
+class VistaValidacion:
+    """
+    Vista SQL 'validacion' con las columnas de COLUMNAS_VALIDACION tipadas como en
+    ContextoValidacion, más 'fila' (posición en la tabla).
+    """
+    def __init__(self, conn, tabla):
+        self.conn = conn
+        self.tabla = tabla
+        self.id_cita = columna_id_cita(tabla.column_names)
+        nulos_none = set(json.loads((tabla.schema.metadata or {}).get(_META_NULOS_NONE, b'[]')))
+
+        registrada = tabla.append_column(_COLUMNA_FILA, pa.array(np.arange(tabla.num_rows, dtype=np.int64)))
+        fecha = self._fecha_atencion()
+        if fecha is not None:
+            registrada = registrada.append_column(_COLUMNA_FECHA, fecha)
+        conn.register('dataset_arrow', registrada)
+        expresiones = [f"{_ident(_COLUMNA_FILA)} AS fila"]
+        self.columnas = []
+        for col in COLUMNAS_VALIDACION + DECIMAL_COLUMNS:
+            nombre = self.id_cita if col == 'Id_Cita' else col
+            if col in self.columnas or nombre not in tabla.column_names:
+                continue
+            expresiones.append(f"{self._expresion(col, nombre, nombre in nulos_none)} AS {_ident(col)}")
+            self.columnas.append(col)
+
+        # Si no se encontró Id_Cita, cada fila es su propia cita
+        if self.id_cita is None:
+            print("⚠️ ADVERTENCIA: No se encontró columna Id_Cita, creando columna dummy")
+            expresiones.append(f"'DUMMY_' || CAST({_ident(_COLUMNA_FILA)} AS VARCHAR) AS \"Id_Cita\"")
+            self.columnas.append('Id_Cita')
+
+        conn.execute(f"CREATE OR REPLACE TEMP VIEW validacion AS SELECT {', '.join(expresiones)} FROM dataset_arrow")
+
+    def _expresion(self, col, nombre, nulo_none):
+        tipo = self.tabla.schema.field(nombre).type
+        origen = _ident(nombre)
+        if col == 'Fecha_Atencion':
+            parseada = col + SUFIJO_PARSEADA
+            if parseada in self.tabla.column_names and pa.types.is_timestamp(self.tabla.schema.field(parseada).type):
+                return _ident(parseada)
+            if pa.types.is_timestamp(tipo) or pa.types.is_date(tipo):
+                return f"CAST({origen} AS TIMESTAMP)"
+            return _ident(_COLUMNA_FECHA)
+        if _es_numerica(col):
+            if pa.types.is_integer(tipo) or pa.types.is_floating(tipo):
+                return f"CAST({origen} AS DOUBLE)"
+            return f"TRY_CAST(trim(CAST({origen} AS VARCHAR), {_literal(_ESPACIOS)}) AS DOUBLE)"
+        if col in STRING_COLUMNS:
+            nulo = 'None' if nulo_none else 'nan'
+            return f"COALESCE(trim(CAST({origen} AS VARCHAR), {_literal(_ESPACIOS)}), {_literal(nulo)})"
+        return origen
+
+    def _fecha_atencion(self):
+        """
+        Fecha_Atencion de texto parseada con fechas.parsear_fechas (formato inferido por
+        columna, como en pandas); None si ya hay una columna de fechas que reutilizar.
+        """
+        nombres = self.tabla.column_names
+        parseada = 'Fecha_Atencion' + SUFIJO_PARSEADA
+        if 'Fecha_Atencion' not in nombres:
+            return None
+        if parseada in nombres and pa.types.is_timestamp(self.tabla.schema.field(parseada).type):
+            return None
+        tipo = self.tabla.schema.field('Fecha_Atencion').type
+        if pa.types.is_timestamp(tipo) or pa.types.is_date(tipo):
+            return None
+        fechas = parsear_fechas(self.tabla.column('Fecha_Atencion').to_pandas())
+        return pa.array(fechas.to_numpy(dtype='datetime64[ns]'), type=pa.timestamp('ns'))
+
+    def requiere(self, *columnas):
+        """KeyError (como en pandas) si falta alguna columna."""
+        faltantes = [col for col in columnas if col not in self.columnas]
+        if faltantes:
+            raise KeyError(faltantes[0])
+
+    def posiciones(self, sql):
+        """Posiciones devueltas por una consulta que selecciona 'fila'."""
+        return self.conn.execute(sql).fetchnumpy()["fila"].astype(np.int64)
+
+
+# ================== REGLAS DECLARATIVAS ==================
+
+def _sql_condicion(columna, operador, valor):
+    x = _ident(columna)
+    numerica = _es_numerica(columna)
+    if operador in ('en', 'no_en'):
+        # isin no iguala textos con números
+        valores = [v for v in valor if isinstance(v, str) != numerica and not isinstance(v, bool)]
+        dentro = f"COALESCE({x} IN ({', '.join(_literal(v) for v in valores)}), FALSE)" if valores else "FALSE"
+        return dentro if operador == 'en' else f"NOT {dentro}"
+    if operador == 'nulo':
+        return f"{x} IS NULL" if valor else f"{x} IS NOT NULL"
+    if operador == 'vacio':
+        vacio = f"{x} IS NULL" if numerica else f"({x} IS NULL OR {x} = '')"
+        return vacio if valor else f"NOT {vacio}"
+    # mayor_que
+    if numerica:
+        return f"COALESCE({x} > {_literal(valor)}, FALSE)"
+    return f"COALESCE(TRY_CAST({x} AS DOUBLE) > {_literal(valor)}, FALSE)"
+
+def sql_regla(regla):
+    """Condición WHERE de una regla compilada de reglas_validacion."""
+    condiciones = [_sql_condicion(columna, operador, valor) for columna, operador, valor in regla.condiciones]
+    if regla.codigos:
+        condiciones.insert(0, f"\"Codigo_Item\" IN ({', '.join(_literal(c) for c in regla.codigos)})")
+    return ' AND '.join(condiciones) or 'TRUE'
+
+def aplicar_reglas_sql(filtro, vista, marcas):
+    """
+    Equivalente SQL de reglas_validacion.aplicar_reglas: una sola lectura de la tabla que
+    deja pasar solo las filas de los códigos del filtro (o de sus reglas sin código) y
+    devuelve una columna booleana por regla.
+    """
+    reglas = catalogo_reglas.filtros().get(filtro)
+    if reglas is None:
+        return
+    vista.requiere('Codigo_Item')
+    aplicables = []
+    for regla in reglas.reglas:
+        faltantes = regla.columnas - set(vista.columnas)
+        if faltantes:
+            print(f"Regla '{regla.mensaje}' omitida, faltan columnas: {sorted(faltantes)}")
+            continue
+        marcas.registrar(regla.mensaje)
+        aplicables.append(regla)
+    if not aplicables:
+        return
+
+    codigos = sorted({codigo for regla in aplicables for codigo in regla.codigos})
+    candidatas = [f"({sql_regla(regla)})" for regla in aplicables if not regla.codigos]
+    if codigos:
+        candidatas.insert(0, f"\"Codigo_Item\" IN ({', '.join(_literal(c) for c in codigos)})")
+    condiciones = ', '.join(f"{sql_regla(regla)} AS r{i}" for i, regla in enumerate(aplicables))
+    aciertos = vista.conn.execute(
+        f"SELECT fila, {condiciones} FROM validacion WHERE {' OR '.join(candidatas)}"
+    ).fetchnumpy()
+    filas = aciertos["fila"]
+    for i, regla in enumerate(aplicables):
+        marcas.marcar(filas[np.asarray(aciertos[f"r{i}"], dtype=bool)], regla.mensaje)
+
+
+# ================== REGLAS CON AGRUPACIÓN ==================
+
+def errores_generales_sql(vista, marcas):
+    vista.requiere('Id_Ups', 'Ficha_Familiar', 'Id_Condicion_Establecimiento', 'Id_Condicion_Servicio')
+    # Primer registro de cada cita con al menos un registro que no es Continuador
+    filas = vista.posiciones("""
+        SELECT min(fila) AS fila FROM validacion
+        GROUP BY "Id_Cita"
+        HAVING bool_or("Id_Ups" = '302101' AND NOT starts_with("Ficha_Familiar", 'APP')
+                       AND ("Id_Condicion_Establecimiento" <> 'C' OR "Id_Condicion_Servicio" <> 'C'))
+    """)
+    if len(filas):
+        marcas.marcar(filas, "Condición de establecimiento y servicio deben ser 'C' (Continuadores)")
+    aplicar_reglas_sql("generales", vista, marcas)
+
+def errores_adolescente_sql(vista, marcas):
+    vista.requiere('Codigo_Item', 'Valor_Lab', 'Anio_Actual_Paciente')
+    filas = vista.posiciones("""
+        SELECT fila FROM validacion
+        WHERE "Id_Cita" NOT IN (
+                SELECT "Id_Cita" FROM validacion
+                WHERE "Codigo_Item" IN ('D509', 'O990', 'Z3591', 'Z3592', 'Z3593', 'Z3594'))
+          AND "Codigo_Item" = '99199.26'
+          AND "Valor_Lab" <> 'TA'
+          AND "Anio_Actual_Paciente" BETWEEN 12 AND 17
+    """)
+    marcas.marcar(filas, "VERIFICAR SUPLEMENTACION EN ADOLESCENTES QUE NO SEAN TA")
+
+_MENSAJES_90675 = [
+    "FALTA AGREGAR PRE O POS",
+    "FALTA AGREGAR VALOR NUMÉRICO (1,2,3,4,5)",
+    "Valor_Lab inválido",
+    "Debe tener un valor numérico y un PRE/POST",
+    "Demasiados registros 90675 - Solo 2 permitidos",
+]
+
+def errores_inmunizaciones_sql(vista, marcas):
+    aplicar_reglas_sql("inmunizaciones", vista, marcas)
+    vista.requiere('Valor_Lab')
+    registros = vista.conn.execute("""
+        WITH r AS (
+            SELECT fila, "Id_Cita", "Valor_Lab" AS valor,
+                   "Valor_Lab" IN ('1', '2', '3', '4', '5') AS es_num,
+                   "Valor_Lab" IN ('PRE', 'POS') AS es_pp
+            FROM validacion WHERE "Codigo_Item" = '90675'
+        )
+        SELECT fila, valor, es_num, es_pp,
+               CASE
+                   WHEN n = 1 AND tiene_num THEN 0
+                   WHEN n = 1 AND tiene_pp THEN 1
+                   WHEN n = 1 THEN 2
+                   WHEN n = 2 AND NOT (tiene_num AND tiene_pp) THEN 3
+                   WHEN n > 2 THEN 4
+               END AS regla
+        FROM (
+            SELECT *, count(*) OVER c AS n, bool_or(es_num) OVER c AS tiene_num,
+                   bool_or(es_pp) OVER c AS tiene_pp
+            FROM r WINDOW c AS (PARTITION BY "Id_Cita")
+        )
+        ORDER BY fila
+    """).df()
+    if registros.empty:
+        return
+    for i, mensaje in enumerate(_MENSAJES_90675):
+        marcas.marcar(registros.loc[registros["regla"] == i, "fila"].to_numpy(), mensaje)
+    invalidos = registros[~(registros["es_num"] | registros["es_pp"])]
+    for val, filas in invalidos.groupby("valor", sort=False)["fila"]:
+        marcas.marcar(filas.to_numpy(), f"Valor '{val}' inválido - Use 1,2,3,4,5 o PRE,POS")
+
+def _registros_secuencia_sql(vista):
+    """'D' de las familias con su error del archivo y pares (establecimiento, mes), como registros_secuencia."""
+    vista.requiere('Codigo_Item', 'Tipo_Diagnostico', 'Numero_Documento_Paciente', 'Fecha_Atencion')
+    familias = ', '.join(
+        f"({_literal(codigo)}, {i})"
+        for i, config in enumerate(DIAG_SECUENCIA.values()) for codigo in config["codes"]
+    )
+    registros = vista.conn.execute(f"""
+        WITH familias("Codigo_Item", familia) AS (VALUES {familias}),
+        r AS (
+            SELECT v.fila AS pos, v."Codigo_Item", v."Numero_Documento_Paciente" AS documento,
+                   v."Id_Cita" AS id_cita, v."Fecha_Atencion" AS fecha,
+                   year(v."Fecha_Atencion") * 12 + month(v."Fecha_Atencion") AS anio_mes, f.familia
+            FROM validacion v JOIN familias f ON f."Codigo_Item" = v."Codigo_Item"
+            WHERE v."Tipo_Diagnostico" = 'D'
+        )
+        SELECT pos, documento, id_cita, fecha, familia,
+               (count(*) OVER (PARTITION BY familia, documento, anio_mes, "Codigo_Item") > 1
+                AND count(*) OVER (PARTITION BY familia, documento, anio_mes, "Codigo_Item", id_cita) = 1)
+               OR (row_number() OVER p > 1 AND id_cita <> first_value(id_cita) OVER p) AS error
+        FROM r
+        WINDOW p AS (PARTITION BY familia, documento ORDER BY fecha NULLS LAST, pos)
+        ORDER BY familia, documento, fecha NULLS LAST, pos
+    """).df()
+    columna = COLUMNA_ESTABLECIMIENTO
+    codigos, nombres = establecimientos = establecimientos_archivo(
+        vista.tabla.column(columna).to_pandas() if columna in vista.tabla.column_names else None,
+        vista.tabla.num_rows
+    )
+    registros["establecimiento"] = nombres[codigos[registros["pos"].to_numpy(dtype=np.int64)]]
+    fechas = vista.conn.execute('SELECT "Fecha_Atencion" FROM validacion ORDER BY fila').df()["Fecha_Atencion"]
+    return registros, periodos_archivo(establecimientos, fechas)
+
+def errores_secuencia_dx_sql(vista, marcas):
+    registros, periodos = _registros_secuencia_sql(vista)
+    marcar_secuencia(marcas, registros, registros["error"].to_numpy(dtype=bool), vista.id_cita is not None,
+                     periodos)
+
+
+def _solo_reglas(filtro):
+    return lambda vista, marcas: aplicar_reglas_sql(filtro, vista, marcas)
+
+FILTER_FUNCTIONS_SQL = {
+    'generales': errores_generales_sql,
+    'dental': _solo_reglas('dental'),
+    'adolescente': errores_adolescente_sql,
+    'obstetricia': _solo_reglas('obstetricia'),
+    'inmunizaciones': errores_inmunizaciones_sql,
+    'cred': _solo_reglas('cred'),
+    'nutricion': _solo_reglas('nutricion'),
+    'psicologia': _solo_reglas('psicologia'),
+    'Error_secuencia_Dx': errores_secuencia_dx_sql,
+}
+
+
+def validar_tabla(tabla, filter_type):
+    """
+    Aplica un filtro de errores con DuckDB sobre la tabla Arrow de un dataset.
+
+    Returns:
+        pd.DataFrame: las filas con error, igual que validadores_errores.aplicar_filtro
+    """
+    if filter_type not in FILTER_FUNCTIONS_SQL:
+        raise ValueError(f"Tipo de filtro no válido: {filter_type}")
+
+    marcas = MarcasError(tabla.num_rows)
+    conn = duckdb.connect()
+    try:
+        vista = VistaValidacion(conn, tabla)
+        funcion = FILTER_FUNCTIONS_SQL[filter_type]
+        if filter_type == 'Error_secuencia_Dx':
+            funcion(vista, marcas)
+        else:
+            try:
+                funcion(vista, marcas)
+            except Exception as e:
+                print(f"Error en validación {filter_type}: {e}")
+    finally:
+        conn.close()
+
+    posiciones = marcas.posiciones()
+    filas = preparar_filas_error(tabla_arrow_a_df(tabla.take(posiciones)), columna_id_cita(tabla.column_names))
+    filas.index = posiciones
+    filas['Error'] = marcas.mensajes(posiciones)
+    filas.attrs[ATTR_AVISOS] = marcas.avisos
+    return filas
+
+
+def confirmar_historial_tabla(tabla):
+    """Registra los meses de la tabla Arrow en el historial de diagnósticos, como confirmar_historial."""
+    conn = duckdb.connect()
+    try:
+        vista = VistaValidacion(conn, tabla)
+        registros, periodos = _registros_secuencia_sql(vista)
+    finally:
+        conn.close()
+    return registrar_secuencia(registros, vista.id_cita is not None, periodos)
@@ -1,102 +1,250 @@
+import os
+import threading
+from collections import OrderedDict
+
 import pandas as pd
 import numpy as np
 from config_tipos import INTEGER_COLUMNS, DECIMAL_COLUMNS, STRING_COLUMNS
-
-def convertir_tipos_validacion(df):
+from fechas import SUFIJO_PARSEADA, parsear_fechas
+from tipos_compactos import texto_validacion, ATTR_NULOS_NONE
+from reglas_validacion import GruposCodigo, aplicar_reglas
+from historial_dx import (
+    DX_HISTORY_DB, SIN_ESTABLECIMIENTO, HistorialNoDisponible, posteriores_al_historial,
+    registrar_en_historial
+)
+
+# Columnas que leen los validadores: el contexto de validación solo tipa estas (más las
+# decimales, para que las filas con error conserven el tipo de la columna completa)
+COLUMNAS_VALIDACION = [
+    'Id_Cita', 'Id_Ups', 'Ficha_Familiar', 'Id_Condicion_Establecimiento',
+    'Id_Condicion_Servicio', 'Codigo_Item', 'Valor_Lab', 'Tipo_Diagnostico', 'Genero',
+    'Mes', 'Anio_Actual_Paciente', 'Lote', 'Numero_Documento_Paciente', 'Fecha_Atencion'
+]
+
+# Columna del establecimiento: el historial de diagnósticos reemplaza los meses validados
+# por establecimiento
+COLUMNA_ESTABLECIMIENTO = 'Nombre_Establecimiento'
+
+# Separador de los mensajes cuando una fila tiene varios errores
+SEPARADOR_ERRORES = ' | '
+
+# Avisos de una validación para la respuesta (df.attrs de las filas con error):
+# lista de {'categoria': 'info' | 'warning', 'mensaje': str}
+ATTR_AVISOS = 'avisos_validacion'
+
+# Contextos de validación que se mantienen en memoria (uno por versión de dataset)
+VALIDATION_CONTEXTS_MAX = int(os.environ.get('VALIDATION_CONTEXTS_MAX', '4'))
+
+
+def _convertir_columna(serie, col, nulo_none=False):
+    """Tipo de validación de una columna según config_tipos (sin cambios si no figura)."""
+    # Convertir columnas enteras usando la configuración centralizada
+    if col in INTEGER_COLUMNS:
+        serie = pd.to_numeric(serie, errors='coerce').astype('Int64')
+    # Convertir columnas decimales usando la configuración centralizada
+    if col in DECIMAL_COLUMNS:
+        serie = pd.to_numeric(serie, errors='coerce')
+    # Columnas de texto - asegurar que sean strings (las category siguen siendo category)
+    if col in STRING_COLUMNS:
+        serie = texto_validacion(serie, nulo_none)
+    return serie
+
+def convertir_tipos_validacion(df, omitir=()):
     """
     Convierte las columnas a los tipos correctos para las validaciones
     """
     df = df.copy()
-    
-    # Convertir columnas enteras usando la configuración centralizada
-    for col in INTEGER_COLUMNS:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64')
-    
-    # Convertir columnas decimales usando la configuración centralizada
-    for col in DECIMAL_COLUMNS:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    
-    # Columnas de texto - asegurar que sean strings
-    for col in STRING_COLUMNS:
-        if col in df.columns:
-            df[col] = df[col].astype(str).fillna('').str.strip()
-    
+    nulos_none = set(df.attrs.get(ATTR_NULOS_NONE, []))
+    for col in df.columns:
+        if col not in omitir:
+            df[col] = _convertir_columna(df[col], col, col in nulos_none)
     return df
 
-def errores_generales(df):
+def columna_id_cita(columnas):
+    """Nombre real de la columna Id_Cita (puede tener BOM), o None si no existe."""
+    for col in columnas:
+        if 'Id_Cita' in col:
+            return col
+    return None
+
+def preparar_filas_error(filas, id_cita, omitir=()):
+    """Filas con error para mostrar: Id_Cita sin BOM y tipos de validación (salvo 'omitir')."""
+    if id_cita is not None and id_cita != 'Id_Cita':
+        filas = filas.rename(columns={id_cita: 'Id_Cita'})
+    return convertir_tipos_validacion(filas, omitir=omitir)
+
+
+class ContextoValidacion:
+    """
+    Vista tipada y reducida a COLUMNAS_VALIDACION de un dataset, construida una sola vez
+    por versión y compartida por todos los validadores, que la leen sin modificarla y
+    devuelven sus errores como MarcasError (posiciones + bitmask).
+    """
+    def __init__(self, df):
+        self.origen = df
+        self.id_cita = columna_id_cita(df.columns)
+        nulos_none = set(df.attrs.get(ATTR_NULOS_NONE, []))
+        filas = pd.RangeIndex(len(df))
+        datos = {}
+        for col in COLUMNAS_VALIDACION + DECIMAL_COLUMNS:
+            nombre = self.id_cita if col == 'Id_Cita' else col
+            if col in datos or nombre not in df.columns:
+                continue
+            if col == 'Fecha_Atencion':
+                # Se reutiliza Fecha_Atencion_dt si ya fue parseada al cargar
+                parseada = col + SUFIJO_PARSEADA
+                if parseada in df.columns and pd.api.types.is_datetime64_any_dtype(df[parseada]):
+                    serie = df[parseada]
+                else:
+                    serie = parsear_fechas(df[col])
+            else:
+                serie = _convertir_columna(df[nombre], col, nombre in nulos_none)
+            datos[col] = serie.set_axis(filas)
+
+        # Si no se encontró Id_Cita, cada fila es su propia cita
+        if self.id_cita is None:
+            print("⚠️ ADVERTENCIA: No se encontró columna Id_Cita, creando columna dummy")
+            datos['Id_Cita'] = pd.Series('DUMMY_' + filas.astype(str), index=filas)
+
+        self.datos = pd.DataFrame(datos, index=filas)
+        self._grupos_codigo = None
+
+    def grupos_codigo(self):
+        """Filas de cada Codigo_Item, para las reglas declarativas (se calcula una vez)."""
+        if self._grupos_codigo is None:
+            self._grupos_codigo = GruposCodigo(self.datos["Codigo_Item"])
+        return self._grupos_codigo
+
+    def filas_con_error(self, marcas):
+        """
+        DataFrame con las filas del dataset que tienen error (con los tipos de validación)
+        y sus mensajes en la columna Error.
+        """
+        posiciones = marcas.posiciones()
+        tipadas = [col for col in self.datos.columns if col != 'Fecha_Atencion']
+        filas = preparar_filas_error(self.origen.iloc[posiciones], self.id_cita, omitir=tipadas)
+        tipadas = [col for col in tipadas if col in filas.columns]
+        for col in tipadas:
+            filas[col] = self.datos[col].iloc[posiciones].set_axis(filas.index)
+        filas['Error'] = marcas.mensajes(posiciones)
+        filas.attrs[ATTR_AVISOS] = marcas.avisos
+        return filas
+
+
+class MarcasError:
+    """
+    Errores de una validación como bitmask por fila: cada mensaje distinto recibe un bit
+    en el catálogo y marcar una fila hace OR de ese bit, así que una fila acumula todos
+    sus errores sin importar el orden de las reglas. Los textos solo se arman para las
+    filas con error (ver mensajes).
+    """
+    def __init__(self, n):
+        self.bits = np.zeros((n, 1), dtype=np.uint64)
+        self.catalogo = []
+        self._indice = {}
+        self.avisos = []
+
+    def avisar(self, mensaje, categoria='info'):
+        """Aviso para el usuario que no es un error de fila (ver ATTR_AVISOS)."""
+        self.avisos.append({'categoria': categoria, 'mensaje': mensaje})
+
+    def registrar(self, mensaje):
+        """Bit del mensaje en el catálogo (se agrega si es nuevo): (palabra, máscara)."""
+        i = self._indice.get(mensaje)
+        if i is None:
+            i = len(self.catalogo)
+            self.catalogo.append(mensaje)
+            self._indice[mensaje] = i
+            # Más de 64 mensajes distintos: otra palabra de 64 bits por fila
+            if i >= 64 * self.bits.shape[1]:
+                self.bits = np.hstack([self.bits, np.zeros((len(self.bits), 1), dtype=np.uint64)])
+        return i // 64, np.uint64(1 << (i % 64))
+
+    def marcar(self, filas, mensaje):
+        """Marca las filas de una máscara booleana (NA = no marcar) o de una lista de posiciones."""
+        if isinstance(filas, pd.Series) and pd.api.types.is_bool_dtype(filas.dtype):
+            filas = filas.to_numpy(dtype=bool, na_value=False)
+        palabra, bit = self.registrar(mensaje)
+        self.bits[np.asarray(filas), palabra] |= bit
+
+    def posiciones(self):
+        """Posiciones de las filas con al menos un error."""
+        return np.flatnonzero(self.bits.any(axis=1))
+
+    def mensajes(self, posiciones):
+        """Texto de Error de las filas indicadas: sus mensajes en el orden del catálogo."""
+        if not len(posiciones):
+            return np.array([], dtype=object)
+        combinaciones, inversa = np.unique(self.bits[posiciones], axis=0, return_inverse=True)
+        textos = np.array([
+            SEPARADOR_ERRORES.join(
+                mensaje for i, mensaje in enumerate(self.catalogo)
+                if int(combinacion[i // 64]) >> (i % 64) & 1
+            )
+            for combinacion in combinaciones
+        ], dtype=object)
+        return textos[inversa.ravel()]
+
+
+_contextos = OrderedDict()
+_contextos_lock = threading.Lock()
+
+def obtener_contexto(clave, cargar):
+    """
+    Contexto de validación de la versión de dataset 'clave', construido con el DataFrame
+    que devuelve cargar() la primera vez. Devuelve None si cargar() no encuentra datos.
+    """
+    with _contextos_lock:
+        if clave in _contextos:
+            _contextos.move_to_end(clave)
+            return _contextos[clave]
+    df = cargar()
+    if df is None:
+        return None
+    contexto = ContextoValidacion(df)
+    with _contextos_lock:
+        _contextos[clave] = contexto
+        while len(_contextos) > VALIDATION_CONTEXTS_MAX:
+            _contextos.popitem(last=False)
+    return contexto
+
+def errores_generales(ctx):
     """
     Detecta errores generales en el DataFrame consolidado.
     """
-    df = convertir_tipos_validacion(df)
-    df["Error"] = ""
+    df = ctx.datos
+    marcas = MarcasError(len(df))
 
     try:
-        # Buscar la columna Id_Cita (puede tener BOM)
-        id_cita_column = None
-        for col in df.columns:
-            if 'Id_Cita' in col:
-                id_cita_column = col
-                break
-        
-        if id_cita_column is None:
-            # Aplicar mask1 directamente sin agrupar por Id_Cita
-            mask1 = (df["Id_Ups"] == "302101") & (~df["Ficha_Familiar"].str.startswith("APP", na=False)) & ((df["Id_Condicion_Establecimiento"] != "C") | (df["Id_Condicion_Servicio"] != "C"))
-            df.loc[mask1, "Error"] = "Condición de establecimiento y servicio deben ser 'C' (Continuadores)"
-        else:
-            # Condición: si el establecimiento o servicio no son "C"
-            mask1 = (df["Id_Ups"] == "302101") & (~df["Ficha_Familiar"].str.startswith("APP", na=False)) & ((df["Id_Condicion_Establecimiento"] != "C") | (df["Id_Condicion_Servicio"] != "C"))
-            
-            if mask1.sum() > 0:
-                # Obtener las citas que tienen al menos un registro que cumple mask1
-                citas_con_error = df[mask1][id_cita_column].unique()
-                
-                # Crear máscara para el PRIMER registro de cada cita problemática
-                mask_citas_problematicas = df[id_cita_column].isin(citas_con_error)
-                mask_primer_registro = mask_citas_problematicas & ~df.duplicated(subset=[id_cita_column], keep="first")
-                
-                # Asignar el error SOLO al primer registro de cada cita problemática
-                df.loc[mask_primer_registro, "Error"] = "Condición de establecimiento y servicio deben ser 'C' (Continuadores)"
-
-        mask2 = (df["Codigo_Item"] == "Z019") & (df["Valor_Lab"] == "DNT") & (df["Mes"] > 7)
-        df.loc[mask2, "Error"] = "EL VALOR LAB TIENE QUE SER DIFERENTE DNT"
-     
-        mask3 = (df["Codigo_Item"].isin(["85018", "85018.01"]) & (df["Valor_Lab"].isna() | (df["Valor_Lab"] == "")))
-        df.loc[mask3, "Error"] = "Verificar el numero de Dosaje"
-
-        mask4 = (df["Codigo_Item"].isin(["C0011", "C0011.01"])) & (df["Tipo_Diagnostico"] == "R")
-        df.loc[mask4, "Error"] = "Visita Domiciliaria no puede Tipo_Dx R"
-
-        mask5 = (df["Codigo_Item"] == "99199.22") & (df["Mes"] > 8) & (df["Valor_Lab"].isin(["N", "A"]) | df["Valor_Lab"].isna())
-        df.loc[mask5, "Error"] = "Deben de tener valores de sistólica y diastólica"
-
-        mask6 = (df["Codigo_Item"].isin(["99381.01","99381","99382","99383","88141","85018","59430","99403", "99199.17","99402.08","99199.22","D1310","D1330"])) & (df["Tipo_Diagnostico"] != "D")
-        df.loc[mask6, "Error"] = "El tipo de Diagnostico no puede ser R"
-
-        mask7 = (df["Codigo_Item"] == "84152") & (df["Genero"] == "F")
-        df.loc[mask7, "Error"] = "Diagnostico solo para varones"
-
-        mask8 = (df["Codigo_Item"] == "O260") & (df["Genero"] == "M")
-        df.loc[mask8, "Error"] = "Diagnostico solo para mujeres"
-
-        mask9 = (df["Codigo_Item"] == "Z010") & ((~df["Valor_Lab"].isin(["N", "A"])) | (df["Valor_Lab"] == ""))
-        df.loc[mask9, "Error"] = "El Valor Lab debe ser N o A"
-
-        mask10 = (df["Codigo_Item"] == "84153") & (df["Genero"] == "F")
-        df.loc[mask10, "Error"] = "Cambiar por el codigo 84152"
+        # Condición: si el establecimiento o servicio no son "C"
+        # (sin Id_Cita en el archivo cada fila es su propia cita y se marca directamente)
+        mask1 = (df["Id_Ups"] == "302101") & (~df["Ficha_Familiar"].str.startswith("APP", na=False)) & ((df["Id_Condicion_Establecimiento"] != "C") | (df["Id_Condicion_Servicio"] != "C"))
+
+        if mask1.sum() > 0:
+            # Obtener las citas que tienen al menos un registro que cumple mask1
+            citas_con_error = df[mask1]["Id_Cita"].unique()
+
+            # Crear máscara para el PRIMER registro de cada cita problemática
+            mask_citas_problematicas = df["Id_Cita"].isin(citas_con_error)
+            mask_primer_registro = mask_citas_problematicas & ~df.duplicated(subset=["Id_Cita"], keep="first")
+
+            # Asignar el error SOLO al primer registro de cada cita problemática
+            marcas.marcar(mask_primer_registro, "Condición de establecimiento y servicio deben ser 'C' (Continuadores)")
+
+        # Resto de reglas: declarativas
+        aplicar_reglas("generales", ctx, marcas)
 
     except Exception as e:
         print(f"Error en validación general: {e}")
 
-    return df[df["Error"] != ""].copy()
+    return marcas
 
-def errores_adolescente(df):
+def errores_adolescente(ctx):
     """
     Detecta errores específicos para el servicio de Adolescente.
     """
-    df = convertir_tipos_validacion(df)
-    df["Error"] = ""
+    df = ctx.datos
+    marcas = MarcasError(len(df))
 
     try:
         # 1. Excluir citas que ya tienen D509 o O990 (estas NO se revisan para esta regla)
@@ -114,434 +262,367 @@ def errores_adolescente(df):
         )
 
         # 3. Marcar error solo donde mask1 es True
-        df.loc[mask1, "Error"] = "VERIFICAR SUPLEMENTACION EN ADOLESCENTES QUE NO SEAN TA"
+        marcas.marcar(mask1, "VERIFICAR SUPLEMENTACION EN ADOLESCENTES QUE NO SEAN TA")
 
     except Exception as e:
         print(f"Error en validación adolescente: {e}")
 
-    return df[df["Error"] != ""].copy()
+    return marcas
 
-def errores_obstetricia(df):
+def errores_obstetricia(ctx):
     """
-    Detecta errores específicos para el servicio de Obstetricia.
+    Detecta errores específicos para el servicio de Obstetricia
+    (reglas 'obstetricia' de reglas_validacion.json).
     """
-    df = convertir_tipos_validacion(df)
-    df["Error"] = ""
+    marcas = MarcasError(len(ctx.datos))
 
     try:
-        mask1 = (df["Codigo_Item"] == "99208.13") & (df["Tipo_Diagnostico"] == "R") & (df["Valor_Lab"] != "4")
-        df.loc[mask1, "Error"] = "El codigo 99208.13 con DX R solo acepta el campo LAB con valor 4"
-
-        mask2 = (df["Codigo_Item"] == "99208.13") & (df["Tipo_Diagnostico"] == "D") & (df["Valor_Lab"] != "1")
-        df.loc[mask2, "Error"] = "El codigo 99208.13 con DX D solo acepta el campo LAB con valor 1 o cambiar el Diagnostico a R SI EL LAB ES 4"
-
-        mask3 = (df["Codigo_Item"] == "99208.02") & (df["Tipo_Diagnostico"] == "D") & (df["Valor_Lab"] != "10")
-        df.loc[mask3, "Error"] = "El codigo 99208.02 con DX D solo acepta el campo LAB con valor 10 si el valor lab es 30, corregir DX R"
-
-        mask4 = (df["Codigo_Item"] == "99208.02") & (df["Tipo_Diagnostico"] == "R") & (df["Valor_Lab"] != "30")
-        df.loc[mask4, "Error"] = "El codigo 99208.02 con DX R solo acepta el campo LAB con valor 30 si el valor es 10 poner D"
-
-        mask5 = (df["Codigo_Item"] == "99208.06") & (df["Tipo_Diagnostico"] == "R") & (df["Valor_Lab"] != "30")
-        df.loc[mask5, "Error"] = "El codigo 99208.06 con DX R solo acepta el campo LAB con valor 30"
-
-        mask6 = (df["Codigo_Item"] == "99208.04") & (df["Tipo_Diagnostico"].isin(["D", "R"])) & (df["Valor_Lab"] != "1")
-        df.loc[mask6, "Error"] = "El codigo 99208.04 solo acepta el campo LAB con valor 1"
-
-        mask7 = (df["Codigo_Item"] == "99208.05") & (df["Tipo_Diagnostico"].isin(["D", "R"])) & (df["Valor_Lab"] != "1")
-        df.loc[mask7, "Error"] = "El codigo 99208.05 solo acepta el campo LAB con valor 1"
-
-        mask8 = (df["Codigo_Item"] == "99208.06") & (df["Tipo_Diagnostico"] == "D") & (df["Valor_Lab"] != "10")
-        df.loc[mask8, "Error"] = "El codigo 99208.06 con DX D solo acepta el campo LAB con valor 10"
-
-        mask9 = (df["Codigo_Item"] == "92100") & (~df["Valor_Lab"].isin(["N", "A"]))
-        df.loc[mask9, "Error"] = "EL Valor_Lab tiene que ser N o A"
-
-        mask10 = (
-            df["Codigo_Item"].isin(["86703", "87342", "86780", "87340", "86703.01", "86703.02", "86318.01", "86803.01"]) &
-            (df["Tipo_Diagnostico"] == "D") &
-            (~df["Valor_Lab"].isin(["RP", "RN"]))
-        )
-        df.loc[mask10, "Error"] = "El campo LAB debe ser RN= Resultado Negativo o RP= Resultado Positivo"
-
-        mask11 = (df["Codigo_Item"] == "59401.06") & (~df["Valor_Lab"].isin(["1", "2", "3","TA"]))
-        df.loc[mask11, "Error"] = "Plan de Parto debe tener valor_lab 1,2,3 o TA"
-
-        mask12 = (((df["Codigo_Item"] == "80055.01") & ((df["Valor_Lab"] != "1") | (df["Valor_Lab"].isna()))) |
-                ((df["Codigo_Item"] == "80055.02") & ((df["Valor_Lab"] != "2") | (df["Valor_Lab"].isna()))))
-        df.loc[mask12, "Error"] = "Corregir la primera bateria 80055.01 Con lab 1 y segunda bateria 80055.02 con lab 2"
-
-        mask13 = df["Codigo_Item"].isin(["86703.01", "86703.02", "86780", "86318.01", "87342"]) & (~df["Valor_Lab"].isin(["RN", "RP"]))
-        df.loc[mask13, "Error"] = "Valor_Lab solo debe de Tener RN y RP"
-
-        mask14 = (df["Codigo_Item"].isin(["88141","88141.01", "99386.03"]) & (~df["Valor_Lab"].isin(["N", "A"]) & df["Valor_Lab"].notna() & (df["Valor_Lab"] != "")))
-        df.loc[mask14, "Error"] = "El Valor debe de ser Normal, Anormal o vacio"
-
-        mask15 = (df["Codigo_Item"] == "99208.14") & (~df["Valor_Lab"].isin(["RSA", "RSM", "RSR"]))
-        df.loc[mask15, "Error"] = "EL Valor_Lab tiene que ser RSA,RSR o RSM"
-
-        mask16 = df["Codigo_Item"].isin(["59430"]) & (~df["Valor_Lab"].isin(["1", "2"]))
-        df.loc[mask16, "Error"] = "EL Valor_Lab tiene que tener valores 1 o 2"
-
-        mask17 = (df["Codigo_Item"] == "59401.05") & (~df["Valor_Lab"].isin(["1", "2","3","4"]))
-        df.loc[mask17, "Error"] = "EL Valor_Lab tiene que ser 1,2,3 o 4"
-
-        mask18 = (df["Codigo_Item"] == "99401.33") & ~(df["Valor_Lab"].isin(["1", "2"]) | (df["Valor_Lab"] == "") | df["Valor_Lab"].isna())
-        df.loc[mask18, "Error"] = "EL Valor_Lab tiene que tener 1,2 o vacio"
-
-        mask19 = (df["Codigo_Item"] == "99401.34") & ~(df["Valor_Lab"].isin(["1", "2","rma","rsa"]) | (df["Valor_Lab"] == "") | df["Valor_Lab"].isna())
-        df.loc[mask19, "Error"] = "EL Valor_Lab tiene que tener 1,2,rma,rsa o vacio"
-
-        mask20 = df["Codigo_Item"].isin(["87621"]) & (~df["Valor_Lab"].isin(["1", "2","N","A"]))
-        df.loc[mask20, "Error"] = "EL Valor_Lab tiene que tener valores 1, 2, 'N', 'A'"
-
-        mask21 = (df["Genero"] == "M") & (df["Valor_Lab"].isin(["Z349", "Z3593", "Z359", "Z3491", "Z3592", "88141", "84152", "Z320", "N952", "O990", "Z374", "N951", "Z391", "C530", "M800", "O987", "Z014", "O261", "Z392", "Z641", "O479", "Z370", "N939", "N771", "O240", "B373", "O260", "N872", "N72X", "Z373"]))
-        df.loc[mask21, "Error"] = "El genero debe de ser Femenino"
-
-        mask22 = (df["Genero"] == "F") & (df["Codigo_Item"].isin(["N40X", "N433", "C61X", "N481"]))
-        df.loc[mask22, "Error"] = "El genero debe de ser Masculino"
-
-        mask23 = (df["Codigo_Item"].isin(["99386.03"]) & (~df["Valor_Lab"].isin(["N", "A"])))
-        df.loc[mask23, "Error"] = "El Valor debe de ser Normal o Anormal"
-
+        aplicar_reglas("obstetricia", ctx, marcas)
     except Exception as e:
         print(f"Error en validación obstetricia: {e}")
 
-    return df[df["Error"] != ""].copy()
+    return marcas
 
-def errores_dental(df):
+def errores_dental(ctx):
     """
-    Detecta errores específicos para el servicio Dental.
+    Detecta errores específicos para el servicio Dental
+    (reglas 'dental' de reglas_validacion.json).
     """
-    df = convertir_tipos_validacion(df)
-    df["Error"] = ""
+    marcas = MarcasError(len(ctx.datos))
 
     try:
-        mask1 = df["Codigo_Item"].isin([
-            "D5110", "D5213", "D5120", "D5214", "D5130", "D5225", "D5140",
-            "D5226", "D5211", "D5860", "D5212", "D5861"]) & (df["Valor_Lab"].isna() | (df["Valor_Lab"] == ""))
-        df.loc[mask1, "Error"] = "El Valor_Lab no puede estar vacio"
-
-        mask2 = df["Codigo_Item"].isin(["D1310", "D1330"]) & (df["Valor_Lab"].isna() | (df["Valor_Lab"] == ""))
-        df.loc[mask2, "Error"] = "El Valor_Lab no puede estar vacio"
-
-        mask3 = df["Codigo_Item"].isin(["D1206"]) & (df["Valor_Lab"].isna() | (df["Valor_Lab"] == ""))
-        df.loc[mask3, "Error"] = "El Valor_Lab no puede estar vacio tiene que ser 1 o 2"
-
-        mask4 = df["Codigo_Item"].isin(["D1351"]) & (~df["Valor_Lab"].isin(["1", "2", "3","4","FIN"]))
-        df.loc[mask4, "Error"] = "El Valor_Lab solo debe llevar lab 1, 2, 3, 4 o FIN"
-
+        aplicar_reglas("dental", ctx, marcas)
     except Exception as e:
         print(f"Error en validación dental: {e}")
 
-    return df[df["Error"] != ""].copy()
+    return marcas
 
-def errores_inmunizaciones(df):
+def errores_inmunizaciones(ctx):
     """
     Detecta errores específicos para el servicio de Inmunizaciones.
     """
-    df = convertir_tipos_validacion(df)
-    df["Error"] = ""
+    df = ctx.datos
+    marcas = MarcasError(len(df))
 
     try:
-        mask1 = df["Codigo_Item"] == "90676"
-        df.loc[mask1, "Error"] = "Vacuna Antirrabica es 90675"
-
-        # Buscar y normalizar Id_Cita
-        id_cita_column = None
-        for col in df.columns:
-            if 'Id_Cita' in col:
-                id_cita_column = col
-                if col != 'Id_Cita':
-                    df.rename(columns={col: 'Id_Cita'}, inplace=True)
-                break
-        
-        if id_cita_column is None:
-            df['Id_Cita'] = 'DUMMY_' + df.index.astype(str)
+        aplicar_reglas("inmunizaciones", ctx, marcas)
+
+        # VALIDACIÓN PARA CÓDIGO 90675: conteo y tipos de valor por cita en una sola
+        # agregación, devuelta a cada registro
+        numericos = ['1', '2', '3', '4', '5']
+        pre_post = ['PRE', 'POS']
+
+        filas = ctx.grupos_codigo().filas("90675")
+        if len(filas):
+            valores = df["Valor_Lab"].iloc[filas].astype(str).str.strip()
+            registros = pd.DataFrame({
+                "Id_Cita": df["Id_Cita"].iloc[filas].to_numpy(),
+                "es_num": valores.isin(numericos).to_numpy(),
+                "es_pp": valores.isin(pre_post).to_numpy(),
+            })
+            por_cita = registros.groupby("Id_Cita", sort=False, observed=True)
+            count = por_cita["es_num"].transform("size").to_numpy()
+            tiene_num = por_cita["es_num"].transform("any").to_numpy()
+            tiene_pp = por_cita["es_pp"].transform("any").to_numpy()
 
-        # VALIDACIÓN PARA CÓDIGO 90675
-        citas_con_90675 = df[df["Codigo_Item"] == "90675"]["Id_Cita"].unique()
-        
-        for cita in citas_con_90675:
-            registros = df[(df["Id_Cita"] == cita) & (df["Codigo_Item"] == "90675")]
-            valores = registros["Valor_Lab"].astype(str).str.strip().unique()
-            
-            numericos = ['1', '2', '3', '4', '5']
-            pre_post = ['PRE', 'POS']
-            
-            tiene_num = any(v in numericos for v in valores)
-            tiene_pp = any(v in pre_post for v in valores)
-            count = len(registros)
-            
             # Aplicar reglas
-            if count == 1:
-                if tiene_num:
-                    df.loc[registros.index, "Error"] = "FALTA AGREGAR PRE O POS"
-                elif tiene_pp:
-                    df.loc[registros.index, "Error"] = "FALTA AGREGAR VALOR NUMÉRICO (1,2,3,4,5)"
-                else:
-                    df.loc[registros.index, "Error"] = "Valor_Lab inválido"
-                    
-            elif count == 2:
-                if not (tiene_num and tiene_pp):
-                    df.loc[registros.index, "Error"] = "Debe tener un valor numérico y un PRE/POST"
-                    
-            elif count > 2:
-                df.loc[registros.index, "Error"] = "Demasiados registros 90675 - Solo 2 permitidos"
-            
-            # Validar valores individuales
-            for idx in registros.index:
-                val = str(df.loc[idx, "Valor_Lab"]).strip()
-                if val not in numericos + pre_post:
-                    df.loc[idx, "Error"] = f"Valor '{val}' inválido - Use 1,2,3,4,5 o PRE,POS"
+            uno = count == 1
+            marcas.marcar(filas[uno & tiene_num], "FALTA AGREGAR PRE O POS")
+            marcas.marcar(filas[uno & ~tiene_num & tiene_pp], "FALTA AGREGAR VALOR NUMÉRICO (1,2,3,4,5)")
+            marcas.marcar(filas[uno & ~tiene_num & ~tiene_pp], "Valor_Lab inválido")
+            marcas.marcar(filas[(count == 2) & ~(tiene_num & tiene_pp)], "Debe tener un valor numérico y un PRE/POST")
+            marcas.marcar(filas[count > 2], "Demasiados registros 90675 - Solo 2 permitidos")
+
+            # Validar valores individuales (un mensaje por valor inválido distinto)
+            invalidos = ~(registros["es_num"] | registros["es_pp"]).to_numpy()
+            for val in pd.unique(valores[invalidos]):
+                marcas.marcar(filas[invalidos & (valores == val).to_numpy()], f"Valor '{val}' inválido - Use 1,2,3,4,5 o PRE,POS")
 
     except Exception as e:
         print(f"Error en validación inmunizaciones: {e}")
 
-    return df[df["Error"] != ""].copy()
+    return marcas
 
-def errores_cred(df):
+def errores_cred(ctx):
     """
-    Detecta errores específicos para el servicio de Area de Cred.
+    Detecta errores específicos para el servicio de Area de Cred
+    (reglas 'cred' de reglas_validacion.json).
     """
-    df = convertir_tipos_validacion(df)
-    df["Error"] = ""
+    marcas = MarcasError(len(ctx.datos))
 
     try:
-        mask1 = ((df["Codigo_Item"].isin(["99199.17", "99199.19"])) & 
-                (~df["Valor_Lab"].isin(["1", "2", "3", "4", "5", "6", "7","TA"])) &
-                (df["Valor_Lab"] != ""))
-        df.loc[mask1, "Error"] = "Verificar el numero de suplementacion"
-
-        mask2 = ((df["Codigo_Item"].isin(["85018", "85018.01"])) & (df["Lote"] == "CED") & (df["Valor_Lab"].isna() | (df["Valor_Lab"] == "")))
-        df.loc[mask2, "Error"] = "Lab Vacio, tiene que ir numero de tamizaje"
-
-        mask3 = ((df["Codigo_Item"].isin(["85018", "85018.01"])) & (df["Hemoglobina"].isna()) & (df["Lote"] == "CED") & (df["Valor_Lab"] != ""))
-        df.loc[mask3, "Error"] = "Lab Vacio, No tiene Valor de Hemoglobina"
-
-        mask4 = ((df["Codigo_Item"].isin(["99801"])) & (df["Lote"] == "CED") & (df["Valor_Lab"].isna() | (df["Valor_Lab"] == "")))
-        df.loc[mask4, "Error"] = "Plan de Atencion integral Vacio"
+        aplicar_reglas("cred", ctx, marcas)
+    except Exception as e:
+        print(f"Error en validación cred: {e}")
 
-        mask5 = ((df["Codigo_Item"].isin(["99381.01","99381","99382","99383"])) & (df["Lote"] == "CED") & (df["Valor_Lab"].isna() | (df["Valor_Lab"] == "")))
-        df.loc[mask5, "Error"] = "Nro de Control Vacio"
+    return marcas
 
-        mask6 = ((df["Codigo_Item"] == "R620") & (df["Lote"] == "CED") & (~df["Valor_Lab"].isin(["MOT","LEN"])))
-        df.loc[mask6, "Error"] = "VALORES DEBEN SER MOT O LEN"
+def errores_nutricion(ctx):
+    """
+    Detecta errores específicos para el servicio de Nutrición
+    (reglas 'nutricion' de reglas_validacion.json).
+    """
+    marcas = MarcasError(len(ctx.datos))
 
-        mask7 = ((df["Codigo_Item"].isin(["99199.28"])) & (~df["Valor_Lab"].isin(["1","2"])))
-        df.loc[mask7, "Error"] = "Desparasitación solo debe ser 1 o 2"
+    try:
+        aplicar_reglas("nutricion", ctx, marcas)
+    except Exception as e:
+        print(f"Error en validación nutricion: {e}")
 
-        #
-       # Sólo evaluar filas con Codigo_Item == "Z001"
-        mask8 = ((df["Codigo_Item"] == "Z001") & ((df["Tipo_Diagnostico"] != "D") | (df["Valor_Lab"].fillna("") != "")))
-        df.loc[mask8, "Error"] = ("Error: Para Z001 solo es válido Tipo_Diagnostico='D' y Valor_Lab vacío")
+    return marcas
 
-        mask9 = ((df["Codigo_Item"] == "99199.27") & (~df["Valor_Lab"].isin(["VA1", "VA2"])))
-        df.loc[mask9, "Error"] = "Suplementacion con vitamina A es VA1 o VA2"
+def errores_psicologia(ctx):
+    """
+    Detecta errores específicos para el servicio de Psicología
+    (reglas 'psicologia' de reglas_validacion.json).
+    """
+    marcas = MarcasError(len(ctx.datos))
 
+    try:
+        aplicar_reglas("psicologia", ctx, marcas)
     except Exception as e:
-        print(f"Error en validación cred: {e}")
+        print(f"Error en validación psicologia: {e}")
+
+    return marcas
+
+# Familias de diagnósticos crónicos de errores_secuencia_dx
+# ================== CONFIGURACIÓN CENTRALIZADA ==================
+DIAG_SECUENCIA = {
+    "ANEMIA": {
+        "type": "exact",
+        "codes": ["D509"],
+        "nombre": "ANEMIA"
+    },
+    "HIPERTENSION": {
+        "type": "exact",
+        "codes": ["I10X"],
+        "nombre": "HIPERTENSIÓN ARTERIAL"
+    },
+    "DIABETES": {
+        "type": "exact",
+        "codes": ["E111","E112","E113","E114","E115","E116","E117","E118","E119",
+                  "E141","E142","E143","E144","E145","E146","E147","E148","E149"],
+        "nombre": "DIABETES MELLITUS"
+    },
+    "VIOLENCIA": {
+        "type": "exact",
+        "codes": ["T740","T741","T742","T743","T748","T749",
+                  "Y040","Y050","Y058","Y060","Y061","Y062","Y068",
+                  "Y070","Y071","Y072","Y078","Y079"],
+        "nombre": "VIOLENCIA (FÍSICA, SEXUAL, PSICOLÓGICA, MALTRATO)"
+    },
+    "DEPRESION": {
+        "type": "exact",
+        "codes": ["F314","F317","F319","F320","F321","F322","F323","F328","F329",
+                  "F330","F331","F332","F334","F339","F341","F413"],
+        "nombre": "DEPRESIÓN"
+    },
+    "AUTISMO": {
+        "type": "exact",
+        "codes": ["F840","F841","F845","F848","F849"],
+        "nombre": "TRASTORNO DEL ESPECTRO AUTISTA"
+    },
+    "SINDROME_DOWN": {
+        "type": "exact",
+        "codes": ["Q900","Q909"],
+        "nombre": "SÍNDROME DE DOWN"
+    },
+    "CONDUCTA_SUICIDA": {
+        "type": "exact",
+        "codes": ["X780","X788","X849"],
+        "nombre": "INTENTO/CONDUCTA SUICIDA"
+    },
+    "ANSIEDAD": {
+        "type": "exact",
+        "codes": ["F400","F401","F402","F408","F409","F410","F411","F412","F413","F418","F419",
+                  "F420","F421","F422","F428","F429","F430","F431","F432","F438","F439",
+                  "F440","F445","F447","F448","F449","F450","F451","F452","F458","F459","F489"],
+        "nombre": "TRASTORNOS DE ANSIEDAD"
+    },
+    "HEPATITIS": {
+        "type": "exact",
+        "codes": ["B160","B169","B180","B181"],
+        "nombre": "HEPATITIS B"
+    }
+}
+# ==================================================================
 
-    return df[df["Error"] != ""].copy()
+def mensaje_secuencia(config):
+    return (f"{config['nombre']} con Tipo D inválido: "
+            f"solo se permite un único 'D' por paciente en todo su historial. "
+            f"Duplicados en el mismo mes o 'D' posteriores al primero son error.")
 
-def errores_nutricion(df):
+def establecimientos_archivo(serie, n):
     """
-    Detecta errores específicos para el servicio de Nutrición.
+    Establecimiento de cada una de las n filas como (códigos, nombres), al estilo de
+    pd.factorize: nombres[códigos] es el texto sin espacios (SIN_ESTABLECIMIENTO si falta
+    o si el archivo no trae la columna, serie None).
     """
-    df = convertir_tipos_validacion(df)
-    df["Error"] = ""
+    if serie is None:
+        return np.full(n, -1, dtype=np.int64), np.array([SIN_ESTABLECIMIENTO], dtype=object)
+    codigos, nombres = pd.factorize(serie)
+    nombres = [str(nombre).strip() for nombre in np.asarray(nombres, dtype=object)]
+    # El código -1 (vacío) toma el último nombre
+    nombres = np.array([
+        SIN_ESTABLECIMIENTO if nombre in ('nan', 'None') else nombre for nombre in nombres
+    ] + [SIN_ESTABLECIMIENTO], dtype=object)
+    return codigos.astype(np.int64), nombres
+
+def periodos_archivo(establecimientos, fechas):
+    """
+    Pares (establecimiento, mes 'YYYY-MM') distintos del archivo, sin las fechas vacías.
 
-    try:
-        mask1 = ((df["Codigo_Item"] == "R628") & (~df["Valor_Lab"].isin(["TP","PR"])))
-        df.loc[mask1, "Error"] = "EL R628 maneja campo lab TP, verificar si el codigo es z724 P/E y T/E"
+    Args:
+        establecimientos: (códigos, nombres) de establecimientos_archivo
+        fechas: Fecha_Atencion de cada fila (datetime64)
+    """
+    codigos, nombres = establecimientos
+    meses = np.asarray(fechas, dtype='datetime64[ns]').astype('datetime64[M]')
+    validas = ~np.isnat(meses)
+    pares = pd.DataFrame({
+        "codigo": codigos[validas],
+        "mes": meses[validas].astype(np.int64),
+    }).drop_duplicates()
+    return pd.DataFrame({
+        "establecimiento": nombres[pares["codigo"].to_numpy()],
+        "mes": pares["mes"].to_numpy().astype('datetime64[M]').astype(str).astype(object),
+    }).drop_duplicates().sort_values(["establecimiento", "mes"], ignore_index=True)
+
+def _registros_historial(registros):
+    """'D' de registros con las columnas del historial (la familia por su clave)."""
+    claves = np.array(list(DIAG_SECUENCIA), dtype=object)
+    return pd.DataFrame({
+        "establecimiento": registros["establecimiento"].to_numpy(),
+        "paciente": registros["documento"].to_numpy(),
+        "familia": claves[registros["familia"].to_numpy(dtype=np.int64)],
+        "fecha": registros["fecha"].to_numpy(dtype='datetime64[ns]'),
+        "id_cita": registros["id_cita"].to_numpy(),
+    })
+
+def marcar_secuencia(marcas, registros, errores_archivo, con_historial, periodos):
+    """
+    Paso final de errores_secuencia_dx, común a pandas y DuckDB: suma los 'D' posteriores
+    al historial persistente (solo lo consulta) y marca los errores con el mensaje de su
+    familia.
 
-        mask2 = ((df["Codigo_Item"].isin(["D509","O990"])) & (df["Tipo_Diagnostico"].isin(["D", "R"])) & (~df["Valor_Lab"].isin(["LEV", "MOD", "SEV","PR"])))
-        df.loc[mask2, "Error"] = "El Valor de Anemia es 'LEV', 'MOD', 'SEV'"
+    Args:
+        registros: 'D' de las familias ordenados por familia, paciente y fecha, con las
+            columnas pos, documento, id_cita, fecha, establecimiento y familia (posición en
+            DIAG_SECUENCIA)
+        errores_archivo: máscara (en el orden de registros) de los errores del archivo
+        con_historial: False si el archivo no tiene Id_Cita real
+        periodos: pares (establecimiento, mes) del archivo (ver periodos_archivo), que no se
+            comparan con el historial porque el archivo los reemplaza al confirmarse
+    """
+    familias = list(DIAG_SECUENCIA.items())
 
-    except Exception as e:
-        print(f"Error en validación nutricion: {e}")
+    # 3. 'D' posteriores al primer 'D' de otros meses validados antes (historial
+    # persistente; sin Id_Cita real no se puede saber si es la misma cita)
+    historial_error = False
+    if con_historial and DX_HISTORY_DB:
+        try:
+            historial_error = posteriores_al_historial(_registros_historial(registros), periodos)
+        except HistorialNoDisponible as e:
+            marcas.avisar(f"No se revisaron los 'D' de meses ya validados. {e}", 'warning')
 
-    return df[df["Error"] != ""].copy()
+    errores = registros[np.asarray(errores_archivo, dtype=bool) | historial_error]
+    for i, filas in errores.groupby("familia")["pos"]:
+        marcas.marcar(filas.to_numpy(), mensaje_secuencia(familias[i][1]))
+    return marcas
 
-def errores_psicologia(df):
+def registrar_secuencia(registros, con_historial, periodos):
     """
-    Detecta errores específicos para el servicio de Psicología.
-    """
-    df = convertir_tipos_validacion(df)
-    df["Error"] = ""
+    Confirmación de un archivo validado, común a pandas y DuckDB: sus meses reemplazan a
+    los mismos (establecimiento, mes) del historial de diagnósticos.
 
-    try:
-        mask1 = ((df["Codigo_Item"].isin(["F700", "F710", "F791", "F711", "F721", "F709", "F719", "F701", "F799", "F729", "F720", "F708", "F789", "F790", "F798", "F718", "F739", "F781", "F788"])) & (df["Tipo_Diagnostico"].isin(["D"])))
-        df.loc[mask1, "Error"] = "Cambiar el Tipo de Dx Retraso mental a R"
+    Args:
+        registros, con_historial, periodos: como en marcar_secuencia
 
-       
-    except Exception as e:
-        print(f"Error en validación psicologia: {e}")
+    Returns:
+        pd.DataFrame: los pares (establecimiento, mes) registrados
 
-    return df[df["Error"] != ""].copy()
+    Raises:
+        ValueError: si el archivo no tiene Id_Cita real
+        HistorialNoDisponible: si el historial siguió bloqueado por otro proceso
+    """
+    if not con_historial:
+        raise ValueError("El archivo no tiene Id_Cita: no se puede registrar en el historial de diagnósticos")
+    registrar_en_historial(_registros_historial(registros), periodos)
+    return periodos
 
-def errores_secuencia_dx(df):
+def registros_secuencia(ctx):
+    """
+    'D' de las familias de DIAG_SECUENCIA (ver marcar_secuencia) y pares (establecimiento,
+    mes) del archivo.
+    """
+    # Id_Cita ya viene normalizada (BOM, columna dummy) y Fecha_Atencion como datetime
+    df = ctx.datos
+
+    # Tabla (código, familia): un código puede estar en más de una familia (F413)
+    tabla_familias = pd.DataFrame(
+        [(codigo, i) for i, config in enumerate(DIAG_SECUENCIA.values()) for codigo in config["codes"]],
+        columns=["Codigo_Item", "familia"]
+    )
+
+    # Solo los 'D' pueden ser error (y solo ellos definen el primer 'D' y los duplicados)
+    mask = df["Codigo_Item"].isin(tabla_familias["Codigo_Item"]) & (df["Tipo_Diagnostico"] == "D")
+    # (sin 'D' igual se sigue: al confirmar, los meses del archivo reemplazan al historial)
+    posiciones = np.flatnonzero(mask.to_numpy(dtype=bool, na_value=False))
+
+    codigos, nombres = establecimientos = establecimientos_archivo(ctx.origen.get(COLUMNA_ESTABLECIMIENTO), len(df))
+    fechas = df["Fecha_Atencion"].iloc[posiciones]
+    documentos = df["Numero_Documento_Paciente"].iloc[posiciones].astype(object)
+    citas = df["Id_Cita"].iloc[posiciones].astype(object)
+    registros = pd.DataFrame({
+        "pos": posiciones,
+        "Codigo_Item": df["Codigo_Item"].iloc[posiciones].astype(object).to_numpy(),
+        "documento": documentos.to_numpy(),
+        "id_cita": citas.to_numpy(),
+        "paciente": pd.factorize(documentos)[0],
+        "cita": pd.factorize(citas)[0],
+        "fecha": fechas.to_numpy(),
+        "establecimiento": nombres[codigos[posiciones]],
+        "anio_mes": (fechas.dt.year * 12 + fechas.dt.month).fillna(-1).astype(np.int64).to_numpy(),
+    }).merge(tabla_familias, on="Codigo_Item")
+
+    # Un solo ordenamiento: por familia, paciente y fecha (las fechas vacías al final;
+    # a igual fecha, el registro que aparece primero en el archivo)
+    registros = registros.sort_values(["familia", "paciente", "fecha", "pos"], na_position="last", kind="stable")
+    return registros, periodos_archivo(establecimientos, df["Fecha_Atencion"])
+
+def errores_secuencia_dx(ctx):
     """
     Valida secuencia de diagnósticos crónicos y condiciones especiales:
     → Solo se permite UN ÚNICO 'D' por paciente en todo el historial.
     Reglas:
       • Duplicados 'D' en el mismo mes → todos son error (EXCEPTO mismos Id_Cita)
       • 'D' posterior al primer 'D' cronológico → error (EXCEPTO mismos Id_Cita)
+      • 'D' posterior al primer 'D' de otros meses ya validados (historial_dx) → error
+        (EXCEPTO la misma Id_Cita). Validar no modifica el historial: los meses del
+        archivo se registran al confirmarlo (confirmar_historial)
     """
-    df = convertir_tipos_validacion(df).copy()
-    
-    # SOLUCIÓN ROBUSTA: Buscar y normalizar la columna Id_Cita
-    id_cita_column = None
-    for col in df.columns:
-        if 'Id_Cita' in col:
-            id_cita_column = col
-            # Renombrar si tiene BOM o formato diferente
-            if col != 'Id_Cita':
-                df.rename(columns={col: 'Id_Cita'}, inplace=True)
-                id_cita_column = 'Id_Cita'
-            break
-    
-    # Si no se encontró Id_Cita, crear una columna dummy con valores únicos
-    if id_cita_column is None:
-        print("⚠️ ADVERTENCIA: No se encontró columna Id_Cita, creando columna dummy")
-        df['Id_Cita'] = 'DUMMY_' + df.index.astype(str)
-        id_cita_column = 'Id_Cita'
-    
-    # Asegurar que Id_Cita sea string
-    df['Id_Cita'] = df['Id_Cita'].astype(str).fillna('').str.strip()
-    
-    if "Error" not in df.columns:
-        df["Error"] = ""
-
-    # ================== CONFIGURACIÓN CENTRALIZADA ==================
-    DIAG_SECUENCIA = {
-        "ANEMIA": {
-            "type": "exact",
-            "codes": ["D509"],
-            "nombre": "ANEMIA"
-        },
-        "HIPERTENSION": {
-            "type": "exact",
-            "codes": ["I10X"],
-            "nombre": "HIPERTENSIÓN ARTERIAL"
-        },
-        "DIABETES": {
-            "type": "exact",
-            "codes": ["E111","E112","E113","E114","E115","E116","E117","E118","E119",
-                      "E141","E142","E143","E144","E145","E146","E147","E148","E149"],
-            "nombre": "DIABETES MELLITUS"
-        },
-        "VIOLENCIA": {
-            "type": "exact",
-            "codes": ["T740","T741","T742","T743","T748","T749",
-                      "Y040","Y050","Y058","Y060","Y061","Y062","Y068",
-                      "Y070","Y071","Y072","Y078","Y079"],
-            "nombre": "VIOLENCIA (FÍSICA, SEXUAL, PSICOLÓGICA, MALTRATO)"
-        },
-        "DEPRESION": {
-            "type": "exact",
-            "codes": ["F314","F317","F319","F320","F321","F322","F323","F328","F329",
-                      "F330","F331","F332","F334","F339","F341","F413"],
-            "nombre": "DEPRESIÓN"
-        },
-        "AUTISMO": {
-            "type": "exact",
-            "codes": ["F840","F841","F845","F848","F849"],
-            "nombre": "TRASTORNO DEL ESPECTRO AUTISTA"
-        },
-        "SINDROME_DOWN": {
-            "type": "exact",
-            "codes": ["Q900","Q909"],
-            "nombre": "SÍNDROME DE DOWN"
-        },
-        "CONDUCTA_SUICIDA": {
-            "type": "exact",
-            "codes": ["X780","X788","X849"],
-            "nombre": "INTENTO/CONDUCTA SUICIDA"
-        },
-        "ANSIEDAD": {
-            "type": "exact",
-            "codes": ["F400","F401","F402","F408","F409","F410","F411","F412","F413","F418","F419",
-                      "F420","F421","F422","F428","F429","F430","F431","F432","F438","F439",
-                      "F440","F445","F447","F448","F449","F450","F451","F452","F458","F459","F489"],
-            "nombre": "TRASTORNOS DE ANSIEDAD"
-        },
-        "HEPATITIS": {
-            "type": "exact",
-            "codes": ["B160","B169","B180","B181"],
-            "nombre": "HEPATITIS B"
-        }
-    }
-    # ==================================================================
-
-    # Asegurar formato correcto de fecha (tus datos vienen en dd/mm/yyyy)
-    df["Fecha_Atencion"] = pd.to_datetime(df["Fecha_Atencion"], format='%d/%m/%Y', errors='coerce')
+    marcas = MarcasError(len(ctx.datos))
+    registros, periodos = registros_secuencia(ctx)
 
-    for key, config in DIAG_SECUENCIA.items():
-        # Construir máscara
-        mask = df["Codigo_Item"].isin(config["codes"]) & (df["Tipo_Diagnostico"] != "P")
-        if not mask.any():
-            continue
+    # 1. Duplicados en el mismo mes (EXCLUYENDO mismos Id_Cita)
+    claves_mes = ["familia", "paciente", "anio_mes", "Codigo_Item"]
+    en_mes = registros.groupby(claves_mes, sort=False)["pos"].transform("size")
+    en_mes_cita = registros.groupby(claves_mes + ["cita"], sort=False)["pos"].transform("size")
+    dup_mes_error = (en_mes > 1) & (en_mes_cita == 1)
 
-        sub = df[mask].copy()
-        sub["Anio_Mes"] = sub["Fecha_Atencion"].dt.to_period('M')
-        sub = sub.sort_values(["Numero_Documento_Paciente", "Fecha_Atencion"])
+    # 2. 'D' posteriores al primero (EXCLUYENDO mismos Id_Cita del primer diagnóstico):
+    # el primer 'D' cronológico de cada paciente es la primera fila de su grupo
+    por_paciente = registros.groupby(["familia", "paciente"], sort=False)["cita"]
+    primer_id_cita = por_paciente.transform("first")
+    posteriores_error = (por_paciente.cumcount() > 0) & (registros["cita"] != primer_id_cita)
 
-        es_D = sub["Tipo_Diagnostico"] == "D"
-        if not es_D.any():
-            continue
+    return marcar_secuencia(marcas, registros, dup_mes_error | posteriores_error, ctx.id_cita is not None, periodos)
 
-        # Primer 'D' cronológico por paciente
-        primer_D_idx = sub[es_D].groupby("Numero_Documento_Paciente")["Fecha_Atencion"].idxmin()
+def confirmar_historial(ctx):
+    """Registra los meses del archivo en el historial de diagnósticos (ver registrar_secuencia)."""
+    registros, periodos = registros_secuencia(ctx)
+    return registrar_secuencia(registros, ctx.id_cita is not None, periodos)
 
-        # Detectar errores
-        errores = pd.Series(False, index=sub.index)
-
-        # 1. Duplicados en el mismo mes (EXCLUYENDO mismos Id_Cita)
-        dup_mes = sub[es_D].duplicated(
-            subset=["Numero_Documento_Paciente", "Anio_Mes", "Codigo_Item"], 
-            keep=False
-        )
-        
-        # Excluir los que tienen el mismo Id_Cita (válidos)
-        mismos_id_cita = sub[es_D].duplicated(
-            subset=["Numero_Documento_Paciente", "Anio_Mes", "Codigo_Item", "Id_Cita"], 
-            keep=False
-        )
-        
-        # Solo son error los duplicados que NO tienen el mismo Id_Cita
-        dup_mes_error = dup_mes & ~mismos_id_cita
-        errores |= (es_D & dup_mes_error)
-
-        # 2. 'D' posteriores al primero (EXCLUYENDO mismos Id_Cita del primer diagnóstico)
-        posteriores = es_D & (~sub.index.isin(primer_D_idx))
-        
-        # Identificar cuáles de los posteriores tienen el mismo Id_Cita que el primer diagnóstico
-        # Obtener los Id_Cita del primer diagnóstico de cada paciente
-        primer_D_data = sub.loc[primer_D_idx, ["Numero_Documento_Paciente", "Id_Cita"]]
-        primer_D_dict = primer_D_data.set_index("Numero_Documento_Paciente")["Id_Cita"].to_dict()
-        
-        # Para cada registro posterior, verificar si comparte Id_Cita con su primer diagnóstico
-        posteriores_con_mismo_id_cita = pd.Series(False, index=sub.index)
-        
-        for idx in sub[posteriores].index:
-            paciente = sub.loc[idx, "Numero_Documento_Paciente"]
-            id_cita_actual = sub.loc[idx, "Id_Cita"]
-            primer_id_cita = primer_D_dict.get(paciente)
-            
-            if primer_id_cita is not None and id_cita_actual == primer_id_cita:
-                posteriores_con_mismo_id_cita[idx] = True
-        
-        # Excluir del error los que comparten Id_Cita con el primer diagnóstico
-        posteriores_error = posteriores & ~posteriores_con_mismo_id_cita
-        errores |= posteriores_error
-
-        if errores.any():
-            mensaje = (f"{config['nombre']} con Tipo D inválido: "
-                       f"solo se permite un único 'D' por paciente en todo su historial. "
-                       f"Duplicados en el mismo mes o 'D' posteriores al primero son error.")
-            df.loc[sub[errores].index, "Error"] = mensaje
-
-    return df[df["Error"] != ""].copy()
 
 # Diccionario de funciones de validación
 FILTER_FUNCTIONS = {
@@ -562,7 +643,8 @@ def aplicar_filtro(df, filter_type):
     Aplica un filtro de errores específico al DataFrame.
     
     Args:
-        df (pd.DataFrame): DataFrame a validar
+        df (pd.DataFrame | ContextoValidacion): DataFrame a validar, o su contexto de
+            validación ya construido (ver obtener_contexto)
         filter_type (str): Tipo de filtro a aplicar
     
     Returns:
@@ -570,8 +652,9 @@ def aplicar_filtro(df, filter_type):
     """
     if filter_type not in FILTER_FUNCTIONS:
         raise ValueError(f"Tipo de filtro no válido: {filter_type}")
-    
-    return FILTER_FUNCTIONS[filter_type](df)
+
+    contexto = df if isinstance(df, ContextoValidacion) else ContextoValidacion(df)
+    return contexto.filas_con_error(FILTER_FUNCTIONS[filter_type](contexto))
 
 def obtener_funciones_validacion():
     """
@@ -589,11 +672,12 @@ def ejecutar_todos_los_filtros(df):
     Returns:
         pd.DataFrame: DataFrame con todos los errores encontrados por todos los filtros
     """
+    contexto = ContextoValidacion(df)
     todos_errores = []
     
     for nombre_filtro, funcion in FILTER_FUNCTIONS.items():
         try:
-            errores = funcion(df)
+            errores = contexto.filas_con_error(funcion(contexto))
             if not errores.empty:
                 errores['Tipo_Filtro'] = nombre_filtro
                 todos_errores.append(errores)
@@ -603,4 +687,4 @@ def ejecutar_todos_los_filtros(df):
     if todos_errores:
         return pd.concat(todos_errores, ignore_index=True)
     else:
-        return pd.DataFrame()
\ No newline at end of file
+        return pd.DataFrame()